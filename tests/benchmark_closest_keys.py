@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2009-2011, Hoyt Koepke (hoytak@gmail.com)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     - Neither the name 'treedict' nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY Hoyt Koepke ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL Hoyt Koepke BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+# Times TreeDict.getClosestKey() on a tree with many long dotted keys,
+# for misspelled keys as they come up when checking a configuration.
+# Run directly; it is not part of the test suite.
+
+import random, sys, time
+from treedict import TreeDict
+
+words = ["model", "optimizer", "learning_rate", "schedule", "warmup_steps",
+         "layers", "hidden_size", "dropout", "encoder", "decoder", "attention",
+         "num_heads", "batch_size", "dataset", "input_path", "random_seed"]
+
+def makeTree(n_keys, depth):
+    keys = set()
+
+    while len(keys) < n_keys:
+        keys.add(".".join("%s%d" % (random.choice(words), random.randint(0, 9))
+                          for i in range(depth)))
+
+    return TreeDict.fromkeys(sorted(keys), 1)
+
+def misspell(k):
+    l = list(k)
+
+    for i in range(2):
+        l[random.randrange(len(l))] = random.choice("abcdefghijklmnopqrstuvwxyz")
+
+    return "".join(l)
+
+def run(n_keys = 100000, depth = 5, n_queries = 20):
+
+    random.seed(0)
+
+    t = makeTree(n_keys, depth)
+    queries = [misspell(k) for k in random.sample(list(t.iterkeys()), n_queries)]
+
+    print("Tree with %d keys of %d levels; %d misspelled queries.\n"
+          % (n_keys, depth, n_queries))
+    print("%-12s %6s %14s" % ("tree", "n", "ms / query"))
+
+    for frozen in [False, True]:
+        if frozen:
+            t.freeze()
+            t.getClosestKey(queries[0])   # builds the cached key lists
+
+        for n in [0, 10]:
+            start = time.time()
+
+            for q in queries:
+                t.getClosestKey(q, n)
+
+            print("%-12s %6d %14.2f" % ("frozen" if frozen else "not frozen", n,
+                                        1000 * (time.time() - start) / n_queries))
+
+            start = time.time()
+            t.getClosestKeys(queries, n)
+
+            print("%-12s %6d %14.2f   (getClosestKeys)"
+                  % ("frozen" if frozen else "not frozen", n,
+                     1000 * (time.time() - start) / n_queries))
+
+if __name__ == '__main__':
+    run(*[int(a) for a in sys.argv[1:]])
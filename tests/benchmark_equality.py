@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2009-2011, Hoyt Koepke (hoytak@gmail.com)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     - Neither the name 'treedict' nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY Hoyt Koepke ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL Hoyt Koepke BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+# Times comparing two trees with == when they are equal, differ in a
+# single value, or differ in size; unfrozen, frozen, and frozen and
+# diffed (which keeps a digest on each frozen branch).  Run directly;
+# it is not part of the test suite.
+
+import random, sys, time
+from treedict import TreeDict
+
+def makeTree(n_keys, depth):
+    keys = set()
+
+    while len(keys) < n_keys:
+        keys.add(".".join("k%d" % random.randint(0, 20) for i in range(depth)))
+
+    return TreeDict.fromkeys(sorted(keys), 1)
+
+def timeEqual(t1, t2, n_reps):
+    t1 == t2          # the first comparison also hashes the values
+
+    start = time.time()
+
+    for i in range(n_reps):
+        t1 == t2
+
+    return 1000 * (time.time() - start) / n_reps
+
+def run(n_keys = 100000, depth = 5, n_reps = 5):
+
+    random.seed(0)
+
+    t = makeTree(n_keys, depth)
+    last = sorted(t.iterkeys())[-1]
+
+    equal = t.copy(deep=True)
+
+    nearly_equal = t.copy(deep=True)
+    nearly_equal[last] = 2
+
+    different = t.copy(deep=True)
+    different[last + "_extra"] = 1
+
+    print("Trees with %d keys of %d levels.\n" % (n_keys, depth))
+    print("%-20s %-14s %10s" % ("tree", "other", "ms / =="))
+
+    for mode in ["not frozen", "frozen", "frozen and diffed"]:
+        for p in [t, equal, nearly_equal, different]:
+            if mode == "frozen":
+                p.freeze()
+            elif mode == "frozen and diffed":
+                t.diff(p)         # keeps the branch digests
+
+        for name, other in [("equal", equal),
+                            ("nearly equal", nearly_equal),
+                            ("different size", different)]:
+
+            print("%-20s %-14s %10.2f" % (mode, name, timeEqual(t, other, n_reps)))
+
+if __name__ == '__main__':
+    run(*[int(a) for a in sys.argv[1:]])
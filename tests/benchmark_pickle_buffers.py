@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2009-2011, Hoyt Koepke (hoytak@gmail.com)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     - Neither the name 'treedict' nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY Hoyt Koepke ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL Hoyt Koepke BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+# Compares the time and peak memory of pickling a tree of large numpy
+# arrays with protocol 4 and with protocol 5 using out-of-band
+# buffers.  Run directly, optionally with the total size of the arrays
+# in MB (default 1024); it is not part of the test suite.
+
+import sys, time, tracemalloc
+import pickle
+
+import numpy
+from treedict import TreeDict
+
+def makeTree(total_mb, array_mb = 64):
+    t = TreeDict()
+    n = array_mb * 2**20 // 8
+
+    for i in range(max(1, total_mb // array_mb)):
+        t["arrays.a%d" % i] = numpy.random.rand(n)
+
+    return t
+
+def measure(f):
+    tracemalloc.start()
+    start = time.time()
+
+    ret = f()
+
+    elapsed = time.time() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return ret, elapsed, peak / 2.0**20
+
+def run(total_mb = 1024):
+
+    t = makeTree(total_mb)
+
+    print("Tree with %d MB of arrays.\n" % total_mb)
+    print("%-26s %9s %10s %9s %10s"
+          % ("method", "dump (s)", "dump peak", "load (s)", "load peak"))
+
+    def dump4():
+        return (pickle.dumps(t, protocol = 4), None)
+
+    def dump5():
+        buffers = []
+        return (pickle.dumps(t, protocol = 5, buffer_callback = buffers.append), buffers)
+
+    for name, dump in [("protocol 4", dump4),
+                       ("protocol 5, out-of-band", dump5)]:
+
+        (s, buffers), dump_time, dump_peak = measure(dump)
+        t2, load_time, load_peak = measure(lambda: pickle.loads(s, buffers = buffers))
+
+        assert all((t2[k] == v).all() for k, v in t.iteritems())
+        del s, buffers, t2
+
+        print("%-26s %9.3f %7.0f MB %9.3f %7.0f MB"
+              % (name, dump_time, dump_peak, load_time, load_peak))
+
+if __name__ == '__main__':
+    run(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2009-2011, Hoyt Koepke (hoytak@gmail.com)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     - Neither the name 'treedict' nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY Hoyt Koepke ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL Hoyt Koepke BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+# Compares TreeDict.toBytes() / TreeDict.fromBytes() with pickling
+# through protocol 2 and the highest protocol.  Run directly; it is
+# not part of the test suite.
+
+import os, sys, tempfile, time
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+from treedict import TreeDict
+
+def makeTree(n_branches, n_values):
+    t = TreeDict()
+
+    for i in range(n_branches):
+        b = t.makeBranch("branch%d" % i)
+
+        for j in range(n_values):
+            r = j % 4
+
+            if r == 0:
+                b["int%d" % j] = i*n_values + j
+            elif r == 1:
+                b["float%d" % j] = 0.5*j
+            elif r == 2:
+                b["str%d" % j] = "value %d" % (j % 10)
+            else:
+                b["flag%d" % j] = (j % 3 == 0)
+
+    return t
+
+def best(f, repeats):
+    times = []
+    ret = None
+
+    for i in range(repeats):
+        # Free the previous result outside of the timing
+        ret = None
+
+        start = time.time()
+        ret = f()
+        times.append(time.time() - start)
+
+    return min(times), ret
+
+def run(n_branches = 1000, n_values = 100, repeats = 5):
+
+    t = makeTree(n_branches, n_values)
+
+    print("Tree with %d values in %d branches.\n" % (n_branches*n_values, n_branches))
+    print("%-24s %10s %10s %10s" % ("format", "bytes", "dump (s)", "load (s)"))
+
+    methods = [
+        ("pickle, protocol 2",
+         lambda: pickle.dumps(t, protocol = 2), pickle.loads),
+        ("pickle, protocol %d" % pickle.HIGHEST_PROTOCOL,
+         lambda: pickle.dumps(t, protocol = pickle.HIGHEST_PROTOCOL), pickle.loads),
+        ("toBytes / fromBytes",
+         t.toBytes, TreeDict.fromBytes)]
+
+    for name, dump, load in methods:
+        dump_time, s = best(dump, repeats)
+        load_time, t2 = best(lambda: load(s), repeats)
+
+        assert t2 == t
+
+        print("%-24s %10d %10.4f %10.4f" % (name, len(s), dump_time, load_time))
+
+    # A mapped file is only read as it is accessed; time opening it
+    # and reading one value.
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+
+    try:
+        dump_time, s = best(lambda: t.saveMapped(path), repeats)
+        load_time, v = best(lambda: TreeDict.openMapped(path).branch0.int0, repeats)
+
+        assert v == 0
+
+        print("%-24s %10d %10.4f %10.4f" % ("saveMapped / openMapped",
+                                            os.path.getsize(path), dump_time, load_time))
+    finally:
+        os.remove(path)
+
+if __name__ == '__main__':
+    run(*[int(a) for a in sys.argv[1:]])
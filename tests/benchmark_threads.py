@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2009-2011, Hoyt Koepke (hoytak@gmail.com)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     - Neither the name 'treedict' nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY Hoyt Koepke ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL Hoyt Koepke BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+# Times lookups from several reader threads on a shared tree, without
+# locking, with setThreadSafe(), and with setThreadSafe() while another
+# thread keeps changing the tree, as a reloader thread would.  Readers
+# do not wait on each other, so the thread-safe rate should follow the
+# unlocked one as threads are added.  Frozen trees are read without
+# locking and without writing to the tree; on a free-threaded Python
+# build, their rate should grow with the number of threads, up to the
+# number of cores.  Run directly; it is not part of the test suite.
+
+import sys, threading, time
+from treedict import TreeDict
+
+def makeTree(n_branches):
+    t = TreeDict()
+
+    for i in range(n_branches):
+        t["server%d.port" % i] = 8000 + i
+        t["server%d.host" % i] = "host%d" % i
+
+    return t
+
+def reader(t, n_branches, n_lookups):
+    for i in range(n_lookups):
+        t["server%d.port" % (i % n_branches)]
+
+def run(n_branches = 100, n_lookups = 100000):
+
+    print("%d lookups per reader thread; Python %s.\n"
+          % (n_lookups, sys.version.split()[0]))
+    print("%-26s %8s %18s" % ("tree", "threads", "lookups / ms"))
+
+    modes = ["not thread-safe", "thread-safe", "thread-safe with writer",
+             "frozen", "frozen, thread-safe"]
+
+    for mode in modes:
+        for n_threads in [1, 2, 4, 8]:
+            t = makeTree(n_branches)
+
+            if mode.startswith("thread-safe") or mode.endswith("thread-safe"):
+                t.setThreadSafe()
+
+            if mode.startswith("frozen"):
+                t.freeze()
+
+            done = [False]
+
+            def writer():
+                i = 0
+                while not done[0]:
+                    t["server%d.port" % (i % n_branches)] = 8000 + (i % n_branches)
+                    i += 1
+                    time.sleep(0.001)
+
+            threads = [threading.Thread(target=reader, args=(t, n_branches, n_lookups))
+                       for i in range(n_threads)]
+
+            if mode == "thread-safe with writer":
+                w = threading.Thread(target=writer)
+                w.start()
+
+            start = time.time()
+
+            for th in threads:
+                th.start()
+            for th in threads:
+                th.join()
+
+            elapsed = time.time() - start
+
+            if mode == "thread-safe with writer":
+                done[0] = True
+                w.join()
+
+            print("%-26s %8d %18.0f" % (mode, n_threads,
+                                        n_threads * n_lookups / (1000 * elapsed)))
+
+if __name__ == '__main__':
+    run(*[int(a) for a in sys.argv[1:]])
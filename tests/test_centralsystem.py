@@ -26,7 +26,7 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 
-import random, unittest, collections
+import random, unittest, collections, os, sys, subprocess, gc
 from treedict import TreeDict, getTree
 import treedict
 from copy import deepcopy, copy
@@ -62,6 +62,182 @@ class TestCentralSystem(unittest.TestCase):
         
         self.assert_(p1c is not p2)
 
+    def sharedName(self, name):
+        return 'shared-%s-%d-%d' % (name, common._inheritance_level, os.getpid())
+
+    def testShared_01(self):
+        name = self.sharedName('01')
+
+        p = makeTDInstance()
+        p.set('a.x', 1, 'b.y', [1,2], 'c', 'abc')
+        p.freeze()
+
+        treedict.publishShared(name, p)
+
+        try:
+            p2 = treedict.attachShared(name)
+
+            self.assert_(p2 == p)
+            self.assert_(p2.isFrozen())
+            self.assert_(p2.b.isFrozen())
+            self.assert_(p2.b.y == [1,2])
+            self.assert_(p2.hash() == p.hash())
+            self.assertRaises(TypeError, lambda: p2.set('a.x', 2))
+        finally:
+            self.assert_(treedict.unpublishShared(name))
+
+    def testShared_02_registered(self):
+        name = self.sharedName('02')
+
+        p = makeTDInstance()
+        p.x = 1
+        p.freeze()
+
+        p_old = getTree(name)
+
+        treedict.publishShared(name, p)
+
+        try:
+            p2 = treedict.attachShared(name)
+
+            self.assert_(getTree(name) is p2)
+            self.assert_(p2.isRegistered())
+            self.assert_(not p_old.isRegistered())
+            self.assert_(p2.x == 1)
+        finally:
+            treedict.unpublishShared(name)
+
+    def testShared_03_republish(self):
+        name = self.sharedName('03')
+
+        p = makeTDInstance()
+        p.x = 1
+        p.freeze()
+
+        treedict.publishShared(name, p)
+
+        try:
+            p2 = treedict.attachShared(name)
+
+            p3 = p.with_('x', 2)
+            treedict.publishShared(name, p3)
+
+            self.assert_(treedict.attachShared(name).x == 2)
+            self.assert_(p2.x == 1)
+        finally:
+            treedict.unpublishShared(name)
+
+    def testShared_04_not_frozen(self):
+        p = makeTDInstance()
+        p.x = 1
+
+        self.assertRaises(ValueError, lambda: treedict.publishShared(self.sharedName('04'), p))
+
+    def testShared_05_missing(self):
+        name = self.sharedName('05')
+
+        self.assertRaises(KeyError, lambda: treedict.attachShared(name))
+        self.assert_(not treedict.unpublishShared(name))
+
+    def testShared_06_unpublish(self):
+        name = self.sharedName('06')
+
+        p = makeTDInstance()
+        p.x = 1
+        p.freeze()
+
+        treedict.publishShared(name, p)
+        p2 = treedict.attachShared(name)
+
+        self.assert_(treedict.unpublishShared(name))
+        self.assert_(not treedict.unpublishShared(name))
+
+        self.assertRaises(KeyError, lambda: treedict.attachShared(name))
+        self.assert_(p2.x == 1)
+
+    def testShared_07_other_process(self):
+        name = self.sharedName('07')
+
+        p = makeTDInstance()
+        p.set('a.x', 1, 'b.y', 'abc')
+        p.freeze()
+
+        treedict.publishShared(name, p)
+
+        code = ("import treedict; treedict.attachShared(%r); "
+                "t = treedict.getTree(%r); print(t.a.x, t.b.y, t.isFrozen())" % (name, name))
+
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(sys.path)
+
+        try:
+            for i in range(2):
+                out = subprocess.check_output([sys.executable, '-c', code], env = env)
+                self.assert_(out.decode().split() == ['1', 'abc', 'True'])
+        finally:
+            treedict.unpublishShared(name)
+
+    def testShared_08_other_process_pool(self):
+        # Workers of a pool in another process must not remove the
+        # block when that process exits
+
+        name = self.sharedName('08')
+
+        p = makeTDInstance()
+        p.set('a.x', 1)
+        p.freeze()
+
+        treedict.publishShared(name, p)
+
+        code = ("import treedict, multiprocessing\n"
+                "if __name__ == '__main__':\n"
+                "    with multiprocessing.get_context('spawn').Pool(2) as pool:\n"
+                "        print([t.a.x for t in pool.map(treedict.attachShared, [%r] * 2)])\n"
+                % name)
+
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(sys.path)
+
+        try:
+            out = subprocess.check_output([sys.executable, '-c', code], env = env)
+            self.assert_(out.decode().split() == ['[1,', '1]'])
+
+            self.assert_(treedict.attachShared(name).a.x == 1)
+        finally:
+            treedict.unpublishShared(name)
+
+    def testShared_09_attach_again(self):
+        # Each attached tree owns its mapping of the block, which is
+        # released along with the tree
+
+        if not os.path.exists('/proc/self/maps'):
+            return
+
+        def mappings():
+            with open('/proc/self/maps') as f:
+                return sum(1 for line in f if '/treedict_' in line)
+
+        name = self.sharedName('09')
+
+        p = makeTDInstance()
+        p.set('a.x', 1, 'b.y', 2)
+        p.freeze()
+
+        treedict.publishShared(name, p)
+
+        try:
+            n = mappings()
+
+            for i in range(5):
+                self.assert_(treedict.attachShared(name).a.x == 1)
+
+            gc.collect()
+            self.assert_(mappings() <= n + 1)
+
+            self.assert_(treedict.getTree(name).b.y == 2)
+        finally:
+            treedict.unpublishShared(name)
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -26,7 +26,7 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 
-import random, unittest, collections
+import random, unittest, collections, pickle
 from treedict import TreeDict, getTree
 import treedict
 from copy import deepcopy, copy
@@ -409,6 +409,479 @@ class TestCopying(unittest.TestCase):
                         self.assert_(v is not q[k])
                         self.assert_(pbn == bk + '.' + qbn, "pbn='%s' != '%s' = bk+qbn" % (pbn, bk+'.' + qbn))
 
+    def testCopying_14_cow_basic(self):
+        p = makeTDInstance()
+        p.set('a.x', 1, 'a.b.y', 2, 'c', 3)
+
+        q = p.copy(copy_on_write = True)
+
+        self.assert_(q == p)
+        self.assert_(q.a is not p.a)
+        self.assert_(q.a.b is not p.a.b)
+        self.assert_(q.a.b.parentNode() is q.a)
+        self.assert_(q.a.b.rootNode() is q)
+
+        q.a.b.y = 20
+        q.c = 30
+
+        self.assert_(p.a.b.y == 2)
+        self.assert_(p.c == 3)
+
+    def testCopying_14_cow_source_modified(self):
+        p = makeTDInstance()
+        p.set('a.x', 1, 'a.b.y', 2, 'c', 3)
+
+        q = p.copy(copy_on_write = True)
+
+        p.a.b.y = 20
+        p.a.b.z = 4
+        p.c = 30
+
+        self.assert_(q.a.b.y == 2)
+        self.assert_('a.b.z' not in q)
+        self.assert_(q.c == 3)
+
+    def testCopying_14_cow_source_cut(self):
+        p = makeTDInstance()
+        p.set('a.x', 1, 'a.b.y', 2)
+
+        q = p.copy(copy_on_write = True)
+
+        a = p.a
+        del p.a
+        a.b.y = 20
+
+        self.assert_(q.a.b.y == 2)
+        self.assert_('a' not in p)
+
+    def testCopying_14_cow_source_cleared(self):
+        p = makeTDInstance()
+        p.set('a.x', 1, 'a.b.y', 2)
+
+        q = p.copy(copy_on_write = True)
+
+        p.a.clear()
+
+        self.assert_(q.a.x == 1)
+        self.assert_(q.a.b.y == 2)
+
+    def testCopying_14_cow_deep_exclusive(self):
+        p = makeTDInstance()
+        p.a = 1
+
+        self.assertRaises(ValueError, lambda: p.copy(deep = True, copy_on_write = True))
+
+    def testCopying_14_cow_frozen(self):
+        p = makeTDInstance()
+        p.set('a.x', 1, 'a.b.y', 2)
+
+        q = p.copy(freeze = True, copy_on_write = True)
+
+        self.assert_(q.isFrozen())
+        self.assert_(q.a.isFrozen())
+        self.assert_(q.a.b.isFrozen())
+        self.assert_(not p.isFrozen())
+        self.assert_(not q.isMutable())
+        self.assert_(q.hash() == p.hash())
+
+    def testCopying_14_cow_mutable_count(self):
+        p = makeTDInstance()
+        p.a.l = [1]
+        p.a.b.l = [2]
+        p.a.t = (1,2)
+
+        q = p.copy(copy_on_write = True)
+
+        self.assert_(q.a._numMutable() == 1)
+        self.assert_(q.a.b._numMutable() == 1)
+        self.assert_(q.a.l is p.a.l)
+
+    def testCopying_14_cow_order_preserved(self):
+        p = makeTDInstance()
+        p.set('b', 1, 'a.x', 2, 'c', 3, 'a.w', 4)
+
+        q = p.copy(copy_on_write = True)
+
+        self.assert_(q.keys() == p.keys())
+
+        for k in p.keys():
+            self.assert_(q._getSettingOrderPosition(k) == p._getSettingOrderPosition(k))
+
+    def testCopying_14_cow_linked_values(self):
+        p = makeTDInstance()
+        p.a.x = 1
+        p.b = p.a
+        p.c.d = p.a
+
+        q = p.copy(copy_on_write = True)
+
+        self.assert_(q.c.d is q.a)
+        self.assert_(q.b is q.a)
+        self.assert_(q.a is not p.a)
+
+    def testCopying_14_cow_linked_values_after_cut(self):
+        p = makeTDInstance()
+        p.a.x = 1
+        p.b.c = p.a
+
+        q = p.copy(copy_on_write = True)
+
+        a = p.a
+        del p.a
+        a.x = 2
+
+        self.assert_(q.b.c is q.a)
+        self.assert_(q.a.x == 1)
+
+    def testCopying_14_cow_linked_value_outside(self):
+        p = makeTDInstance()
+        p.a.x = 1
+        p.b.c = p.a
+
+        qb = p.b.copy(copy_on_write = True)
+
+        self.assert_(qb.c is p.a)
+
+    def testCopying_14_cow_of_cow(self):
+        p = makeTDInstance()
+        p.set('a.x', 1, 'a.b.y', 2)
+
+        q1 = p.copy(copy_on_write = True)
+        q2 = q1.copy(copy_on_write = True)
+
+        p.a.b.y = 3
+        q1.a.b.y = 4
+
+        self.assert_(q2.a.b.y == 2)
+        self.assert_(q1.a.b.y == 4)
+        self.assert_(p.a.b.y == 3)
+
+    def testCopying_14_cow_pickle(self):
+        p = makeTDInstance()
+        p.set('a.x', 1, 'a.b.y', 2)
+
+        q = p.copy(copy_on_write = True)
+
+        p.a.x = 10
+
+        q2 = pickle.loads(pickle.dumps(q, protocol=-1))
+
+        self.assert_(q2 == q)
+        self.assert_(q2.a.x == 1)
+
+    def testCopying_14_cow_Large_straight(self):
+        p = random_selflinked_tree(0, 100)
+
+        q = p.copy(copy_on_write = True)
+
+        self.assert_(q == p)
+
+        for k, v in p.iteritems(branch_mode='all', recursive = True):
+
+            if type(v) is makeTDInstance:
+
+                pbn = p[k].branchName(add_path = True)
+                qbn = q[k].branchName(add_path = True)
+
+                self.assert_(pbn == qbn, "qbn = %s != %s = pbn" % (qbn, pbn))
+
+                self.assert_(p[k] is not q[k])
+                self.assert_(p[k] == q[k])
+
+    def testCopying_14_cow_Large_matches_copy(self):
+        p = random_selflinked_tree(0, 100)
+
+        q1 = p.copy()
+        q2 = p.copy(copy_on_write = True)
+
+        for k in p.keys(recursive = False, branch_mode = 'only'):
+            p[k].clear()
+
+        self.assert_(q1 == q2)
+        self.assert_(q1.hash() == q2.hash())
+
+    def testCopying_15_deep_shared_memo(self):
+        p = makeTDInstance()
+        l = [1, [2]]
+        p.a = l
+        p.b.c = l
+
+        q = p.copy(deep = True)
+
+        self.assert_(q.a == l)
+        self.assert_(q.a is not l)
+        self.assert_(q.a is q.b.c)
+
+    def testCopying_15_deep_scalar_containers(self):
+        p = makeTDInstance()
+        p.l = [1, 2.0, "3", None]
+        p.d = {"x" : 1, "y" : "2"}
+        p.n = {"x" : [1]}
+
+        q = p.copy(deep = True)
+
+        self.assert_(q == p)
+        self.assert_(q.l is not p.l)
+        self.assert_(q.d is not p.d)
+        self.assert_(q.n["x"] is not p.n["x"])
+
+    def testCopying_15_deepcopy_outer_memo(self):
+        p = makeTDInstance()
+        l = [1, 2]
+        p.a = l
+
+        x = deepcopy([l, p])
+
+        self.assert_(x[0] is x[1].a)
+        self.assert_(x[0] is not l)
+
+    def testCopying_15_deep_value_referencing_ancestor(self):
+        p = makeTDInstance()
+        p.b.x = 1
+        p.b.c.r = p.b
+
+        q = p.copy(deep = True)
+
+        self.assert_(q.b.c.r is q.b)
+        self.assert_(q.b is not p.b)
+
+    def testCopying_15_deep_registered_copier(self):
+
+        class Box(object):
+            def __init__(self, v):
+                self.v = v
+
+        calls = []
+
+        def copyBox(b, memo):
+            calls.append(b)
+            return Box(b.v)
+
+        treedict.registerDeepCopier(Box, copyBox)
+
+        try:
+            p = makeTDInstance()
+            b = Box(1)
+            p.a = b
+            p.c.d = b
+
+            q = p.copy(deep = True)
+
+            self.assert_(len(calls) == 1)
+            self.assert_(q.a is q.c.d)
+            self.assert_(q.a is not b)
+            self.assert_(q.a.v == 1)
+        finally:
+            treedict.registerDeepCopier(Box, None)
+
+    def testCopying_15_deep_numpy(self):
+        try:
+            import numpy
+        except ImportError:
+            return
+
+        p = makeTDInstance()
+        p.a = numpy.arange(5)
+        p.b = numpy.array([[1], "x"], dtype=object)
+
+        q = p.copy(deep = True)
+
+        self.assert_(q.a is not p.a)
+        self.assert_((q.a == p.a).all())
+        self.assert_(q.b[0] is not p.b[0])
+
+    def testCopying_16_project_basic(self):
+        p = makeTDInstance()
+        p.set('a.x', 1, 'a.y', 2, 'b.z', 3, 'c', 4)
+
+        q = p.project(['a.y', 'b'])
+
+        self.assert_(set(q.keys()) == set(['a.y', 'b.z']))
+        self.assert_(q.a.y == 2)
+        self.assert_(q.b.z == 3)
+        self.assert_(q.b is not p.b)
+        self.assert_(q.a.parentNode() is q)
+
+    def testCopying_16_project_single_key(self):
+        p = makeTDInstance()
+        p.set('a.x', 1, 'a.y', 2)
+
+        q = p.project('a.x')
+
+        self.assert_(q.keys() == ['a.x'])
+
+    def testCopying_16_project_order_preserved(self):
+        p = makeTDInstance()
+        p.set('c', 1, 'a.x', 2, 'b', 3, 'a.w', 4, 'd', 5)
+
+        q = p.project(['d', 'a.w', 'c', 'a.x'])
+
+        self.assert_(q.keys() == ['c', 'a.x', 'a.w', 'd'])
+
+        for k in q.keys():
+            self.assert_(q._getSettingOrderPosition(k) == p._getSettingOrderPosition(k))
+
+    def testCopying_16_project_overlapping(self):
+        p = makeTDInstance()
+        p.set('a.x', 1, 'a.b.y', 2)
+
+        q1 = p.project(['a.b.y', 'a'])
+        q2 = p.project(['a', 'a.b.y'])
+
+        self.assert_(q1 == p)
+        self.assert_(q2 == p)
+
+    def testCopying_16_project_bad_key(self):
+        p = makeTDInstance()
+        p.set('a.x', 1)
+
+        self.assertRaises(KeyError, lambda: p.project(['a.y']))
+        self.assertRaises(KeyError, lambda: p.project(['a.x.z']))
+        self.assertRaises(KeyError, lambda: p.project(['b']))
+
+    def testCopying_16_project_deep(self):
+        p = makeTDInstance()
+        p.set('a.x', [1], 'b', 2)
+
+        q1 = p.project(['a'])
+        q2 = p.project(['a'], deep = True)
+
+        self.assert_(q1.a.x is p.a.x)
+        self.assert_(q2.a.x is not p.a.x)
+        self.assert_(q2.a.x == p.a.x)
+
+    def testCopying_16_project_linked_values(self):
+        p = makeTDInstance()
+        p.a.x = 1
+        p.b.c = p.a
+        p.d = 1
+
+        q = p.project(['a', 'b'])
+
+        self.assert_(q.b.c is q.a)
+
+        q.d = 1
+        self.assert_(q == p)
+
+    def testCopying_16_copy_exclude(self):
+        p = makeTDInstance()
+        p.set('a.x', 1, 'a.y', 2, 'b.z', 3, 'c', 4)
+
+        q = p.copy(exclude = ['a.x', 'c'])
+
+        self.assert_(q.keys() == ['a.y', 'b.z'])
+        self.assert_(p.keys() == ['a.x', 'a.y', 'b.z', 'c'])
+
+    def testCopying_16_copy_include_exclude(self):
+        p = makeTDInstance()
+        p.set('a.x', 1, 'a.b.y', 2, 'a.b.z', 3, 'c', 4)
+
+        q = p.copy(include = ['a'], exclude = 'a.b.z', freeze = True)
+
+        self.assert_(q.keys() == ['a.x', 'a.b.y'])
+        self.assert_(q.isFrozen())
+
+    def testCopying_16_copy_bad_arguments(self):
+        p = makeTDInstance()
+        p.a = 1
+
+        self.assertRaises(TypeError, lambda: p.copy(includes = ['a']))
+        self.assertRaises(ValueError, lambda: p.copy(include = ['a'], copy_on_write = True))
+
+    def testCopying_17_with_basic(self):
+        p = makeTDInstance()
+        p.set('a.x', 1, 'a.b.y', 2, 'c.z', 3)
+        p.freeze()
+
+        q = p.with_('a.b.y', 20)
+
+        self.assert_(p.a.b.y == 2)
+        self.assert_(q.a.b.y == 20)
+        self.assert_(q.a.x == 1)
+        self.assert_(q.c.z == 3)
+        self.assert_(q.isFrozen())
+        self.assert_(q.c.isFrozen())
+        self.assert_(q.c is not p.c)
+
+    def testCopying_17_with_new_key(self):
+        p = makeTDInstance()
+        p.set('a.x', 1)
+        p.freeze()
+
+        q = p.with_('d.e', 5)
+
+        self.assert_(q.d.e == 5)
+        self.assert_('d' not in p)
+        self.assert_(q.keys() == ['a.x', 'd.e'])
+
+    def testCopying_17_with_unfrozen_source(self):
+        p = makeTDInstance()
+        p.set('a.x', 1, 'b.y', 2)
+
+        q = p.with_('a.x', 10)
+        p.b.y = 20
+
+        self.assert_(q.b.y == 2)
+        self.assert_(q.a.x == 10)
+        self.assert_(p.a.x == 1)
+
+    def testCopying_17_with_history(self):
+        p = makeTDInstance()
+        p.set('a.x', 0, 'b.y', 0)
+        p.freeze()
+
+        versions = [p]
+
+        for i in range(1, 20):
+            versions.append(versions[-1].with_('a.x', i))
+
+        for i, v in enumerate(versions):
+            self.assert_(v.a.x == i)
+            self.assert_(v.b.y == 0)
+
+    def testCopying_17_with_hash(self):
+        p = makeTDInstance()
+        p.set('a.x', 1, 'b.y', [1,2], 'c.d.e', 3)
+        p.freeze()
+
+        q = p.with_('a.x', 2)
+        r = q.with_('a.x', 1)
+
+        self.assert_(r.hash() == p.hash())
+        self.assert_(q.hash() != p.hash())
+        self.assert_(q.hash('c') == p.hash('c'))
+        self.assert_(q.c.hash() == p.c.hash())
+        self.assert_(r == p)
+
+    def testCopying_17_with_hash_tree_values(self):
+        p = makeTDInstance()
+        p.a.x = 1
+        p.b.c = p.a
+        p.freeze()
+
+        q = p.with_('a.x', 2)
+
+        self.assert_(q.b.c is q.a)
+        self.assert_(q.b.hash() != p.b.hash())
+
+        p2 = makeTDInstance()
+        p2.a.x = 2
+        p2.b.c = p2.a
+
+        self.assert_(q.hash() == p2.hash())
+
+    def testCopying_17_with_makeReport(self):
+        p = makeTDInstance()
+        p.set('a.x', 1, 'b.y', 2)
+        p.freeze()
+
+        q = p.with_('b.y', 3)
+
+        p2 = makeTDInstance()
+        p2.set('a.x', 1, 'b.y', 3)
+
+        self.assert_(q.makeReport() == p2.makeReport())
+
     # Also need tests covering cases where flags are cleared on copied
     # nodes
 
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2009-2011, Hoyt Koepke (hoytak@gmail.com)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     - Neither the name 'treedict' nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY Hoyt Koepke ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL Hoyt Koepke BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import unittest
+from treedict import TreeDict
+
+from common import *
+
+class TestDiff(unittest.TestCase):
+
+    def testDiff_01_basic(self):
+        p1 = makeTDInstance()
+        p1.set('a.x', 1, 'a.y', 2, b = 3)
+
+        p2 = p1.copy()
+        p2.a.y = 20
+        p2.c = 4
+        del p2.b
+
+        d = p1.diff(p2)
+
+        self.assert_(d['added'] == {'c' : 4})
+        self.assert_(d['removed'] == {'b' : 3})
+        self.assert_(d['changed'] == {'a.y' : (2, 20)})
+
+    def testDiff_02_equal(self):
+        p1 = makeTDInstance()
+        p1.set('a.x', 1, 'a.y', [1,2], b = 3)
+
+        p2 = p1.copy(deep = True)
+
+        d = p1.diff(p2)
+
+        self.assert_(d == {'added' : {}, 'removed' : {}, 'changed' : {}})
+        self.assert_(p1.diff(p1) == d)
+
+    def testDiff_03_branches(self):
+        p1 = makeTDInstance()
+        p1.set('a.x', 1, 'b.c.y', 2)
+
+        p2 = makeTDInstance()
+        p2.set('a', 1, 'd.e.z', 3)
+
+        d = p1.diff(p2)
+
+        self.assert_(d['added'] == {'a' : 1, 'd.e.z' : 3})
+        self.assert_(d['removed'] == {'a.x' : 1, 'b.c.y' : 2})
+        self.assert_(d['changed'] == {})
+
+    def testDiff_04_mutable(self):
+        p1 = makeTDInstance()
+        p1.a = [1,2]
+
+        p2 = makeTDInstance()
+        p2.a = [1,2,3]
+
+        self.assert_(p1.diff(p2)['changed'] == {'a' : ([1,2], [1,2,3])})
+
+    def testDiff_05_dangling_ignored(self):
+        p1 = makeTDInstance()
+        p1.a = 1
+        p1.b.c
+
+        p2 = makeTDInstance()
+        p2.a = 1
+
+        self.assert_(p1.diff(p2) == {'added' : {}, 'removed' : {}, 'changed' : {}})
+
+    def testDiff_06_frozen(self):
+        p1 = makeTDInstance()
+
+        for i in range(100):
+            p1["b%d.x" % i] = i
+
+        p1.freeze()
+
+        p2 = p1.copy()
+        p2.b5.x = -1
+        p2.freeze()
+
+        d = p1.diff(p2)
+
+        self.assert_(d['changed'] == {'b5.x' : (5, -1)})
+        self.assert_(d['added'] == {} and d['removed'] == {})
+
+        # Repeated diffs give the same result with the cached digests
+        self.assert_(p1.diff(p2) == d)
+
+    def testDiff_07_versions(self):
+        p = makeTDInstance()
+
+        for i in range(100):
+            p["b%d.x" % i] = i
+
+        p.freeze()
+
+        p2 = p.with_('b7.x', 70).with_('c', 1)
+
+        d = p.diff(p2)
+
+        self.assert_(d['changed'] == {'b7.x' : (7, 70)})
+        self.assert_(d['added'] == {'c' : 1})
+        self.assert_(d['removed'] == {})
+
+    def testDiff_08_copy_on_write(self):
+        p1 = makeTDInstance()
+        p1.set('a.x', 1, 'b.y', 2)
+
+        p2 = p1.copy(copy_on_write = True)
+        p2.a.x = 10
+
+        self.assert_(p1.diff(p2)['changed'] == {'a.x' : (1, 10)})
+
+        p1.b.y = 3
+
+        self.assert_(p1.diff(p2)['changed'] == {'a.x' : (1, 10), 'b.y' : (3, 2)})
+
+    def testPatch_01_basic(self):
+        p1 = makeTDInstance()
+        p1.set('a.x', 1, 'a.y', 2, 'b.c.z', 3, d = 4)
+
+        p2 = makeTDInstance()
+        p2.set('a.x', 1, 'a.y', 20, 'b', 3, 'e.f', 5)
+
+        p1.applyPatch(p1.diff(p2))
+
+        self.assert_(p1 == p2)
+
+    def testPatch_02_prunes_branches(self):
+        p1 = makeTDInstance()
+        p1.set('a.x', 1, 'b.c.z', 3)
+
+        p2 = makeTDInstance()
+        p2.set('a.x', 1)
+
+        p1.applyPatch(p1.diff(p2))
+
+        self.assert_('b' not in p1)
+        self.assert_(p1 == p2)
+
+    def testPatch_03_missing_key(self):
+        p1 = makeTDInstance()
+        p1.set('a.x', 1, 'b', 2)
+
+        patch = {'added' : {'c' : 3}, 'removed' : {'b' : 2, 'q' : 1}, 'changed' : {}}
+
+        self.assertRaises(KeyError, lambda: p1.applyPatch(patch))
+
+        self.assert_(p1.b == 2)
+        self.assert_('c' not in p1)
+
+
+if __name__ == '__main__':
+    unittest.main()
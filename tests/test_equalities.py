@@ -145,5 +145,70 @@ class TestEqualities(unittest.TestCase):
 
         self.assert_(p1 == p2)
 
+    def testEqualityShortcuts_01_identity(self):
+        p = sample_tree()
+        self.assert_(p == p)
+        self.assert_(not (p != p))
+
+    def testEqualityShortcuts_02_frozen_sizes(self):
+        p1 = sample_tree()
+        p2 = p1.copy(deep=True)
+        p3 = p1.copy(deep=True)
+        p3.cwqod.eee = 1
+
+        for p in [p1, p2, p3]:
+            p.freeze()
+
+        # Twice, so the kept counts are used the second time
+        for i in range(2):
+            self.assert_(p1 == p2)
+            self.assert_(p1 != p3)
+            self.assert_(p3 != p1)
+
+    def testEqualityShortcuts_03_digests(self):
+        p1 = makeTDInstance()
+        p1.a.b.c = 1
+        p1.a.b.d = 2
+        p1.x = 3
+
+        p2 = p1.copy(deep=True)
+        p3 = p1.copy(deep=True)
+        p3.a.b.d = 4
+
+        for p in [p1, p2, p3]:
+            p.freeze()
+
+        # diff() keeps the digests of the frozen branches
+        p1.diff(p2)
+        p1.diff(p3)
+
+        self.assert_(p1 == p2)
+        self.assert_(p1.a == p2.a)
+        self.assert_(p1 != p3)
+        self.assert_(p1.a != p3.a)
+        self.assert_(p1.x == p3.x)
+
+    def testEqualityShortcuts_04_copy_on_write(self):
+        p1 = sample_tree()
+        p1.freeze()
+
+        p2 = p1.copy(copy_on_write=True)
+
+        self.assert_(p1 == p2)
+        self.assert_(p1.cwqod == p2.cwqod)
+
+        p2.cwqod.eee = 1
+
+        self.assert_(p1 != p2)
+
+    def testEqualityShortcuts_05_unpickled_dangling(self):
+        import pickle
+
+        p1 = frozen_tree()
+        p2 = pickle.loads(pickle.dumps(p1, protocol=2))
+
+        self.assert_(p1 == p2)
+        self.assert_(p1.size(branch_mode='all') == p2.size(branch_mode='all'))
+
 if __name__ == '__main__':
     unittest.main()
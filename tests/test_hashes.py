@@ -333,6 +333,50 @@ class TestHashes(unittest.TestCase):
 
         self.assert_(p.hash() != p.hash())
 
+    def testPythonHash_01_repeated(self):
+        p1 = sample_tree()
+        p2 = p1.copy(deep=True)
+
+        p1.freeze()
+        p2.freeze()
+
+        h = hash(p1)
+
+        self.assert_(hash(p1) == h)
+        self.assert_(hash(p2) == h)
+        self.assert_(hash(p2) == h)
+
+        d = {p1 : 0}
+        self.assert_(d[p2] == 0)
+
+    def testPythonHash_02_error_not_kept(self):
+        p1 = makeTDInstance()
+        p2 = makeTDInstance()
+
+        p2.a = 1
+        p1.a.b = p2
+        p1.freeze()
+
+        self.assertRaises(TypeError, lambda: hash(p1))
+        self.assertRaises(TypeError, lambda: hash(p1))
+
+        p2.freeze()
+
+        self.assert_(hash(p1) == hash(p1))
+
+    def testPythonHash_03_pickling(self):
+        import pickle
+
+        p1 = sample_tree()
+        p1.freeze()
+
+        h = hash(p1)
+
+        p2 = pickle.loads(pickle.dumps(p1, protocol=-1))
+
+        self.assert_(hash(p2) == h)
+        self.assert_(p2 in {p1 : 0})
+
 
 
 
@@ -35,6 +35,11 @@ from copy import deepcopy, copy
 from hashlib import md5
 import random
 
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
 from common import *
 
 
@@ -1058,6 +1063,68 @@ class TestIteratorsLists(unittest.TestCase):
         self.assertRaises(TypeError, lambda: makeTDInstance().values(branch_mode = 1))
 
 
+    def testFlatten_01_dict(self):
+        p, rid = basic_walking_test()
+
+        for recursive in [True, False]:
+            for branch_mode in ["none", "all", "only"]:
+                d = p.flatten(recursive = recursive, branch_mode = branch_mode)
+                self.assert_(set(d.items()) == rid[(recursive, branch_mode)])
+
+    def testFlatten_02_lists_order(self):
+        p = random_tree(0, 200)
+
+        for recursive in [True, False]:
+            for branch_mode in ["none", "all", "only"]:
+                keys, values = p.flatten('lists', recursive, branch_mode)
+
+                self.assert_(keys == list(p.iterkeys(recursive, branch_mode)))
+                self.assert_(values == list(p.itervalues(recursive, branch_mode)))
+
+    def testFlatten_03_dangling_skipped(self):
+        p = makeTDInstance()
+        p.a.b.c
+        p.x = 1
+
+        self.assert_(p.flatten() == {'x' : 1})
+        self.assert_(p.flatten(branch_mode = 'all') == {'x' : 1})
+
+    def testFlatten_04_cached_keys(self):
+        p = random_tree(0, 100)
+        p.freeze()
+
+        k1, v1 = p.flatten('lists', cache_keys = True)
+        k2, v2 = p.flatten('lists', cache_keys = True)
+
+        self.assert_(k1 == k2 == p.keys())
+        self.assert_(v1 == v2 == p.values())
+
+        # Modifying the returned list must not affect the cache
+        k1.append('bork')
+        self.assert_(p.flatten('lists', cache_keys = True)[0] == p.keys())
+
+        self.assert_(p.flatten(cache_keys = True) == p.flatten())
+
+    def testFlatten_05_cached_keys_unfrozen_ignored(self):
+        p = makeTDInstance()
+        p.a = 1
+
+        self.assert_(p.flatten(cache_keys = True) == {'a' : 1})
+        p.b = 2
+        self.assert_(p.flatten(cache_keys = True) == {'a' : 1, 'b' : 2})
+
+    def testFlatten_06_BadParameters(self):
+        self.assertRaises(ValueError, lambda: makeTDInstance().flatten('bork'))
+        self.assertRaises(TypeError, lambda: makeTDInstance().flatten(branch_mode = 'bork'))
+
+    def testFlatten_07_pickling_drops_cache(self):
+        p = random_tree(0, 50)
+        p.freeze()
+        p.flatten(cache_keys = True)
+
+        p2 = pickle.loads(pickle.dumps(p, protocol=2))
+        self.assert_(p2.flatten(cache_keys = True) == p.flatten())
+
 
 if __name__ == '__main__':
     unittest.main()
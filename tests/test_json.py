@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2009-2011, Hoyt Koepke (hoytak@gmail.com)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     - Neither the name 'treedict' nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY Hoyt Koepke ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL Hoyt Koepke BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import unittest, json
+from treedict import TreeDict
+
+from common import *
+
+class _TrickleReader(object):
+    # Returns the data a few characters at a time, so values are cut
+    # off at every possible place.
+
+    def __init__(self, s, n = 3):
+        self.s = s
+        self.n = n
+        self.pos = 0
+
+    def read(self, size = -1):
+        r = self.s[self.pos : self.pos + self.n]
+        self.pos += self.n
+        return r
+
+class _Writer(object):
+    def __init__(self):
+        self.parts = []
+
+    def write(self, s):
+        self.parts.append(s)
+
+class TestJSON(unittest.TestCase):
+
+    def testJSON_01_basic(self):
+        p = makeTDInstance()
+        p.set('a.x', 1, 'a.y', [1, 2], z = 'abc')
+
+        self.assert_(p.convertTo('json') == '{"a": {"x": 1, "y": [1, 2]}, "z": "abc"}')
+
+    def testJSON_02_matches_nested_dict(self):
+        p = makeTDInstance()
+        p.set('a.b.c', 1, 'a.d', None, e = 2.5, f = {'g' : [1, 'h']}, i = True)
+
+        self.assert_(json.loads(p.convertTo('json')) == p.convertTo('nested_dict'))
+
+    def testJSON_03_order(self):
+        p = makeTDInstance()
+        p.z = 1
+        p.a = 2
+        p.m.x = 3
+
+        self.assert_(p.convertTo('json') == '{"z": 1, "a": 2, "m": {"x": 3}}')
+
+    def testJSON_04_indent(self):
+        p = makeTDInstance()
+        p.set('a.x', 1, 'a.y', [1, 2], z = 'abc')
+
+        s = p.convertTo('json', indent = 2)
+
+        self.assert_(s == json.dumps(json.loads(s), indent = 2, separators = (',', ': ')))
+        self.assert_(json.loads(s) == p.convertTo('nested_dict'))
+
+    def testJSON_05_stream(self):
+        p = makeTDInstance()
+
+        for i in range(5000):
+            p['b%d.x' % (i % 50)] = 'v' * i
+
+        w = _Writer()
+        self.assert_(p.convertTo('json', stream = w) is None)
+        self.assert_(len(w.parts) > 1)
+        self.assert_(''.join(w.parts) == p.convertTo('json'))
+
+    def testJSON_06_non_json_error(self):
+        p = makeTDInstance()
+        p.a.b = set([1])
+
+        self.assertRaises(TypeError, lambda: p.convertTo('json'))
+        self.assertRaises(TypeError, lambda: p.convertTo('json', non_json = 'error'))
+
+    def testJSON_07_non_json_skip(self):
+        p = makeTDInstance()
+        p.a.b = set([1])
+        p.a.c = [1, set([2])]
+        p.d = 1
+
+        self.assert_(json.loads(p.convertTo('json', non_json = 'skip')) == {'a' : {}, 'd' : 1})
+
+    def testJSON_08_non_json_repr(self):
+        p = makeTDInstance()
+        p.a = [1, 2j]
+
+        self.assert_(json.loads(p.convertTo('json', non_json = 'repr')) == {'a' : [1, '2j']})
+
+    def testJSON_09_non_json_function(self):
+        p = makeTDInstance()
+        p.a = set([3, 1, 2])
+
+        s = p.convertTo('json', non_json = sorted)
+        self.assert_(json.loads(s) == {'a' : [1, 2, 3]})
+
+        p2 = TreeDict.fromJSON(s, mapping_function = lambda v: set(v) if isinstance(v, list) else v)
+        self.assert_(p2 == p)
+
+    def testJSON_10_bad_non_json(self):
+        p = makeTDInstance()
+        self.assertRaises(ValueError, lambda: p.convertTo('json', non_json = 'ignore'))
+        self.assertRaises(TypeError, lambda: p.convertTo('json', bad_argument = True))
+
+    def testJSON_11_prune_empty(self):
+        p = makeTDInstance()
+        p.makeBranch('a')
+        p.b.c = 1
+        p.d  # dangling
+
+        self.assert_(json.loads(p.convertTo('json')) == {'a' : {}, 'b' : {'c' : 1}})
+        self.assert_(json.loads(p.convertTo('json', prune_empty = True)) == {'b' : {'c' : 1}})
+
+    def testJSON_12_tree_values(self):
+        p = makeTDInstance()
+        p.a.x = 1
+        p.b = p.a
+        p.c = [p.a]
+
+        self.assert_(json.loads(p.convertTo('json')) ==
+                     {'a' : {'x' : 1}, 'b' : {'x' : 1}, 'c' : [{'x' : 1}]})
+
+    def testJSON_13_recursive(self):
+        p = makeTDInstance()
+        p.a.b = p
+
+        self.assertRaises(ValueError, lambda: p.convertTo('json'))
+
+    def testFromJSON_01_roundtrip(self):
+        p = makeTDInstance()
+        p.set('a.b.c', 1, 'a.d', None, e = 2.5, f = [1, 'h', {'g' : 2}], i = True)
+        p.makeBranch('j')
+
+        self.assert_(TreeDict.fromJSON(p.convertTo('json')) == p)
+        self.assert_(TreeDict.fromJSON(p.convertTo('json', indent = 4)) == p)
+
+    def testFromJSON_02_dict_values(self):
+        # Dictionaries come back as branches
+        p = makeTDInstance()
+        p.a = {'b' : 1}
+
+        p2 = TreeDict.fromJSON(p.convertTo('json'))
+
+        self.assert_(p2.a.parentNode() is p2)
+        self.assert_(p2.a.b == 1)
+
+    def testFromJSON_03_order(self):
+        s = '{"z": 1, "a": {"y": 2, "b": 3}, "m": 4}'
+
+        self.assert_(TreeDict.fromJSON(s).convertTo('json') == s)
+
+    def testFromJSON_04_trickle(self):
+        s = ('{"a": {"x": 12345678, "y": [1.5, -2e10, "abc\\"def"], "z": true},'
+             ' "b": "\\u00e9\\u00e8", "c": null, "d": {}, "e": 1234}')
+
+        p = TreeDict.fromJSON(s)
+
+        for n in [1, 2, 3, 7]:
+            self.assert_(TreeDict.fromJSON(_TrickleReader(s, n)) == p)
+
+        self.assert_(p.a.x == 12345678)
+        self.assert_(p.e == 1234)
+        self.assert_(p.a.y[2] == 'abc"def')
+
+    def testFromJSON_04_trickle_numbers(self):
+        # Numbers cut off where they still parse, as "12." or "-2.5e"
+
+        s = '{"a": 0.1, "b": -2.5e10, "c": 12.75, "d": 1E+5, "e": -0}'
+
+        p = TreeDict.fromJSON(s)
+
+        for n in [1, 2, 3]:
+            self.assert_(TreeDict.fromJSON(_TrickleReader(s, n)) == p)
+
+        self.assert_(p.a == 0.1)
+        self.assert_(p.b == -2.5e10)
+        self.assert_(p.c == 12.75)
+
+    def testFromJSON_05_bytes_stream(self):
+        s = '{"a": "\\u00e9", "b": {"c": 1}}'
+        p = TreeDict.fromJSON(s)
+
+        self.assert_(TreeDict.fromJSON(_TrickleReader(json.dumps(json.loads(s), ensure_ascii = False)
+                                                      .encode('utf-8'), 1)) == p)
+
+    def testFromJSON_06_dotted_keys(self):
+        p = TreeDict.fromJSON('{"a.b": 1, "a": {"c": 2}}')
+
+        self.assert_(p.a.b == 1)
+        self.assert_(p.a.c == 2)
+
+    def testFromJSON_07_invalid(self):
+        for s in ['[1, 2]', '1', '', '{"a": 1,}', '{"a" 1}', '{"a": 1} 2',
+                  '{"a": 1', '{"a": tru}', '{1: 2}']:
+
+            self.assertRaises(ValueError, lambda: TreeDict.fromJSON(s))
+
+    def testFromJSON_08_bad_key(self):
+        self.assertRaises(NameError, lambda: TreeDict.fromJSON('{"1a": 1}'))
+
+if __name__ == '__main__':
+    unittest.main()
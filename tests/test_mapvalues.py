@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2009-2011, Hoyt Koepke (hoytak@gmail.com)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     - Neither the name 'treedict' nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY Hoyt Koepke ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL Hoyt Koepke BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import unittest
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from treedict import TreeDict
+
+from common import *
+
+def _double(v):
+    return 2*v
+
+class TestMapValues(unittest.TestCase):
+
+    def testMapValues_01_basic(self):
+        p = makeTDInstance()
+        p.set('b.x', 1, 'b.c.y', 2, x = 3)
+
+        p2 = p.mapValues(_double)
+
+        self.assert_(p2.flatten() == {'b.x' : 2, 'b.c.y' : 4, 'x' : 6})
+        self.assert_(p.flatten() == {'b.x' : 1, 'b.c.y' : 2, 'x' : 3})
+
+    def testMapValues_02_order_preserved(self):
+        p = random_tree(0, 200)
+
+        p2 = p.mapValues(lambda v: v + ['x'])
+
+        self.assert_(p2.keys() == p.keys())
+        self.assert_(p2.values() == [v + ['x'] for v in p.values()])
+
+        for k in p.iterkeys():
+            self.assert_(p2._getSettingOrderPosition(k) == p._getSettingOrderPosition(k))
+
+        self.assert_(p2.makeReport().count('\n') == p.makeReport().count('\n'))
+
+    def testMapValues_03_keys(self):
+        p = makeTDInstance()
+        p.set('b.x', 1, 'b.c.y', 2, x = 3)
+
+        p2 = p.mapValues(_double, keys = ['b.c.y', 'x', 'x'])
+
+        self.assert_(p2.flatten() == {'b.x' : 1, 'b.c.y' : 4, 'x' : 6})
+
+    def testMapValues_04_bad_keys(self):
+        p = makeTDInstance()
+        p.set('b.x', 1, x = 3)
+
+        self.assertRaises(KeyError, lambda: p.mapValues(_double, keys = ['y']))
+        self.assertRaises(KeyError, lambda: p.mapValues(_double, keys = ['b']))
+        self.assertRaises(KeyError, lambda: p.mapValues(_double, keys = ['x.y']))
+
+    def testMapValues_05_thread_executor(self):
+        p = random_tree(1, 300)
+
+        with ThreadPoolExecutor(4) as ex:
+            p2 = p.mapValues(len, executor = ex, chunksize = 7)
+
+        self.assert_(p2.keys() == p.keys())
+        self.assert_(p2.values() == [len(v) for v in p.values()])
+
+    def testMapValues_06_process_executor(self):
+        p = makeTDInstance()
+
+        for i in range(50):
+            p['a%d.v' % (i % 5)] = i
+
+        with ProcessPoolExecutor(2) as ex:
+            p2 = p.mapValues(_double, executor = ex, chunksize = 8)
+
+        self.assert_(p2.values() == [2*v for v in p.values()])
+
+    def testMapValues_07_mutability_bookkeeping(self):
+        p = makeTDInstance()
+        p.a = 1
+        p.b = [1]
+
+        p2 = p.mapValues(lambda v: [v])
+        self.assert_(p2._numMutable() == 2)
+
+        p3 = p2.mapValues(len)
+        self.assert_(p3._numMutable() == 0)
+        p3.freeze()
+        self.assert_(not p3.isMutable())
+
+    def testMapValues_08_hash_consistency(self):
+        p = makeTDInstance()
+        p.set('b.x', 1, 'b.c.y', 2, x = 3)
+
+        p2 = p.mapValues(_double)
+
+        q = makeTDInstance()
+        q.set('b.x', 2, 'b.c.y', 4, x = 6)
+
+        self.assert_(p2.hash() == q.hash())
+        self.assert_(p2 == q)
+
+    def testMapValues_09_frozen_source(self):
+        p = makeTDInstance()
+        p.set('b.x', 1, x = 3)
+        p.freeze()
+
+        p2 = p.mapValues(_double)
+        self.assert_(p2.x == 6)
+
+    def testMapValues_10_bad_chunksize(self):
+        self.assertRaises(ValueError, lambda: makeTDInstance().mapValues(_double, chunksize = 0))
+
+if __name__ == '__main__':
+    unittest.main()
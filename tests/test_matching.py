@@ -166,6 +166,111 @@ class TestMatching(unittest.TestCase):
         self.assert_(p.getClosestKey('asdfjd.eiudkdkdk', 2) == 
                      ['asdfdjdjd.eiudkdkdk', 'basdfdjdjd.eiudkddk'])
 
+    def _randomTree(self, n):
+        random.seed(0)
+
+        words = ['alpha', 'beta', 'gamma', 'delta', 'x', 'y1', 'param', 'rate']
+
+        def key():
+            return '.'.join(random.choice(words) + random.choice(['', '1', '_a'])
+                            for i in range(random.randint(1, 4)))
+
+        p = makeTDInstance()
+
+        while p.size() < n:
+            k = key()
+            if not any(k.startswith(k2 + '.') or k2.startswith(k + '.') for k2 in p.keys()):
+                p[k] = 1
+
+        queries = [key() for i in range(20)]
+        queries += [q[:-1] + 'z' for q in queries]
+
+        return p, queries
+
+    def testMatch_18_frozen_same(self):
+        p, queries = self._randomTree(300)
+
+        p2 = p.copy()
+        p2.freeze()
+
+        for q in queries:
+            self.assert_(p.getClosestKey(q) == p2.getClosestKey(q))
+
+            for n in [1, 3, 10]:
+                self.assert_(p.getClosestKey(q, n) == p2.getClosestKey(q, n))
+
+            self.assert_(p.getClosestKey(q, 3, branch_mode = 'all')
+                         == p2.getClosestKey(q, 3, branch_mode = 'all'))
+
+    def testMatch_19_frozen_copy_changed(self):
+        p = makeTDInstance()
+        p.alpha.x = 1
+        p.freeze()
+
+        self.assert_(p.getClosestKey('alpah.y') == 'alpha.x')
+
+        p2 = p.copy(freeze = False)
+        p2.alpha.y = 2
+
+        self.assert_(p2.getClosestKey('alpah.y') == 'alpha.y')
+        self.assert_(p.getClosestKey('alpah.y') == 'alpha.x')
+
+    def testMatch_20_structure_frozen(self):
+        p = makeTDInstance()
+        p.alpha.x = 1
+        p.beta.y = 1
+        p.freeze(structure_only = True)
+
+        self.assert_(p.getClosestKey('bta.y') == 'beta.y')
+
+        p.beta.y = 2
+
+        self.assert_(p.getClosestKey('bta.y') == 'beta.y')
+        self.assert_(p.getClosestKey('alpha', 2, branch_mode = 'only') == ['alpha', 'beta'])
+
+    def testMatchMany_01(self):
+        p = makeTDInstance()
+        p.set('alpha.x1', 1, 'alpha.y1', 1, 'beta.x', 1)
+
+        self.assert_(p.getClosestKeys(['alpah.x', 'bet.x']) ==
+                     {'alpah.x' : 'alpha.x1', 'bet.x' : 'beta.x'})
+        self.assert_(p.getClosestKeys(['alpah.x'], 2) == {'alpah.x' : ['alpha.x1', 'alpha.y1']})
+
+    def testMatchMany_02_same_as_single(self):
+        p, queries = self._randomTree(300)
+
+        for frozen in [False, True]:
+            if frozen:
+                p.freeze()
+
+            for n in [0, 1, 3, 10]:
+                d = p.getClosestKeys(queries, n)
+
+                self.assert_(set(d.keys()) == set(queries))
+
+                for q in queries:
+                    self.assert_(d[q] == p.getClosestKey(q, n))
+
+            d = p.getClosestKeys(queries, 2, recursive = False, branch_mode = 'all')
+
+            for q in queries:
+                self.assert_(d[q] == p.getClosestKey(q, 2, recursive = False, branch_mode = 'all'))
+
+    def testMatchMany_03_empty(self):
+        p = makeTDInstance()
+        p.a = 1
+
+        self.assert_(p.getClosestKeys([]) == {})
+        self.assert_(makeTDInstance().getClosestKeys(['a'], 0) == {'a' : None})
+        self.assert_(makeTDInstance().getClosestKeys(['a'], 2) == {'a' : []})
+
+    def testMatchMany_04_bad(self):
+        p = makeTDInstance()
+        p.a = 1
+
+        self.assertRaises(TypeError, lambda: p.getClosestKeys([1]))
+        self.assertRaises(TypeError, lambda: p.getClosestKeys(['a'], branch_mode = 'bad'))
+
 
 
 class TestLevensteinDist(unittest.TestCase):
@@ -189,6 +294,11 @@ class TestLevensteinDist(unittest.TestCase):
     def test13(self): self._test("gambo", "gumbo", 1)
     def test14(self): self._test("ssss", "ssssssss", 4)
     def test15(self): self._test("ssssssss", "ssss", 4)
+    def test16(self): self._test("kitten", "sitting", 3)
+    def test17(self): self._test("flaw", "lawn", 2)
+    def test18(self): self._test("saturday", "sunday", 3)
+    def test19(self): self._test("abcdefghij", "jihgfedcba", 10)
+    def test20(self): self._test("a.b.c.d.e.f", "f.e.d.c.b.a", 6)
 
 
 if __name__ == '__main__':
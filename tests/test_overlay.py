@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2009-2011, Hoyt Koepke (hoytak@gmail.com)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     - Neither the name 'treedict' nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY Hoyt Koepke ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL Hoyt Koepke BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import unittest
+from treedict import TreeDict, OverlayTreeDict
+
+from common import *
+
+def makeLayers():
+    base = makeTDInstance()
+    base.set('run.n', 10, 'run.seed', 0, 'io.path', '/tmp', x = 1)
+
+    site = makeTDInstance()
+    site.set('io.path', '/data', 'io.fast', True)
+
+    job = makeTDInstance()
+    job.set('run.n', 20, y = 2)
+
+    return base, site, job
+
+def flatUpdate(base, *layers):
+    t = base.copy()
+    for l in layers:
+        t.update(l)
+    return t
+
+class TestOverlay(unittest.TestCase):
+
+    def testOverlay_01_lookup(self):
+        base, site, job = makeLayers()
+        o = TreeDict.overlay(base, site, job)
+
+        self.assert_(o.run.n == 20)
+        self.assert_(o.run.seed == 0)
+        self.assert_(o.io.path == '/data')
+        self.assert_(o.io.fast == True)
+        self.assert_(o.x == 1)
+        self.assert_(o.y == 2)
+
+        self.assert_(o.get('run.n') == 20)
+        self.assert_(o['io.path'] == '/data')
+        self.assert_(o.get('nothere', 5) == 5)
+        self.assertRaises(KeyError, lambda: o.get('nothere'))
+        self.assert_('run.seed' in o)
+        self.assert_('run.z' not in o)
+        self.assert_(isinstance(o.run, OverlayTreeDict))
+
+    def testOverlay_02_matches_update(self):
+        base, site, job = makeLayers()
+        o = TreeDict.overlay(base, site, job)
+        t = flatUpdate(base, site, job)
+
+        self.assert_(o.keys() == t.keys())
+        self.assert_(o.items() == t.items())
+        self.assert_(o.keys(recursive = False, branch_mode = 'all')
+                     == t.keys(recursive = False, branch_mode = 'all'))
+        self.assert_(o.size() == t.size())
+        self.assert_(o.materialize() == t)
+
+    def testOverlay_03_hash(self):
+        base, site, job = makeLayers()
+        o = TreeDict.overlay(base, site, job)
+
+        self.assert_(o.hash() == o.materialize().hash())
+        self.assert_(o.hash() == flatUpdate(base, site, job).hash())
+        self.assert_(o.run.hash() == o.run.materialize().hash())
+
+    def testOverlay_04_writes_to_top(self):
+        base, site, job = makeLayers()
+        base_h, site_h, job_h = base.hash(), site.hash(), job.hash()
+
+        o = TreeDict.overlay(base, site, job)
+        r = o.run
+
+        o.run.seed = 5
+        o.z.w = 3
+        o['io.path'] = '/scratch'
+
+        self.assert_(o.run.seed == 5)
+        self.assert_(r.seed == 5)
+        self.assert_(o.z.w == 3)
+        self.assert_(o.io.path == '/scratch')
+        self.assert_(o.topLayer().run.seed == 5)
+
+        self.assert_(base.hash() == base_h)
+        self.assert_(site.hash() == site_h)
+        self.assert_(job.hash() == job_h)
+
+    def testOverlay_05_value_shadows_branch(self):
+        base = makeTDInstance()
+        base.set('a.x', 1, 'b', 2)
+
+        layer = makeTDInstance()
+        layer.set('a', 3, 'b.y', 4)
+
+        o = TreeDict.overlay(base, layer)
+
+        self.assert_(o.a == 3)
+        self.assert_('a.x' not in o)
+        self.assert_(o.b.y == 4)
+        self.assert_(o.materialize() == flatUpdate(base, layer))
+
+    def testOverlay_06_shared_base(self):
+        base, site, job = makeLayers()
+
+        overlays = [TreeDict.overlay(base, job) for i in range(10)]
+
+        for i, o in enumerate(overlays):
+            o.run.n = i
+
+        for i, o in enumerate(overlays):
+            self.assert_(o.run.n == i)
+            self.assert_(o.run.seed == 0)
+
+        self.assert_(base.run.n == 10)
+
+    def testOverlay_07_base_only(self):
+        base, site, job = makeLayers()
+        o = TreeDict.overlay(base)
+
+        self.assert_(o.materialize() == base)
+        self.assert_(o.hash() == base.hash())
+
+    def testOverlay_08_bad_layer(self):
+        self.assertRaises(TypeError, lambda: TreeDict.overlay(makeTDInstance(), {}))
+        self.assertRaises(TypeError, lambda: OverlayTreeDict())
+
+    def testOverlay_09_write_replaces_value(self):
+        # Writes behave as updating the overlay's tree in turn
+
+        base = makeTDInstance()
+        base.set('b.a', 1, 'b.b.d', 2)
+
+        o = TreeDict.overlay(base)
+        t = base.copy()
+
+        for k, v in [('b', 3), ('b.b.c', 4), ('b.e', 5)]:
+            o.set(k, v)
+            t.update({k : v})
+
+            self.assert_(o.keys() == t.keys())
+            self.assert_(o.materialize() == t)
+
+if __name__ == '__main__':
+    unittest.main()
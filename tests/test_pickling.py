@@ -26,7 +26,7 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 
-import random, unittest, collections
+import random, unittest, collections, os, tempfile
 try:
     import cPickle as pickle
 except ImportError:
@@ -131,6 +131,358 @@ class TestPickling(unittest.TestCase):
         self.assertRaises(RuntimeError, lambda: p.set('d', 4))
         p2.d = 4
 
+    def testBytes_01(self):
+        p = sample_tree()
+        p2 = TreeDict.fromBytes(p.toBytes())
+
+        self.assert_(p == p2)
+        self.assert_(p.hash() == p2.hash())
+
+    def testBytes_02_frozen(self):
+        p = frozen_tree()
+        p2 = TreeDict.fromBytes(p.toBytes())
+
+        self.assert_(p2.isFrozen())
+        self.assert_(p == p2)
+
+    def testBytes_03_values(self):
+        p = makeTDInstance()
+
+        p.set(n = None, t = True, f = False,
+              i1 = 0, i2 = -1, i3 = 2**62, i4 = -2**63, i5 = 2**100,
+              x1 = 0.5, x2 = -1e300,
+              s1 = "", s2 = u"\u00e9t\u00e9", s3 = "abc",
+              b = b"\x00\xff",
+              l = [1, (2, "a")], d = {'a' : [1]}, tp = (1, 2.0))
+
+        p2 = TreeDict.fromBytes(p.toBytes())
+
+        self.assert_(p == p2)
+
+        for k, v in p.iteritems():
+            self.assert_(type(p2[k]) is type(v), k)
+
+        self.assert_(p2._numMutable() == p._numMutable())
+
+    def testBytes_04_order(self):
+        p = makeTDInstance()
+        p.set('c', 1, 'a.z', 2, 'b', 3, 'a.y', 4)
+        p.c = 5
+
+        p2 = TreeDict.fromBytes(p.toBytes())
+
+        self.assert_(p2.keys() == p.keys())
+
+        p2.d = 6
+        p.d = 6
+        self.assert_(p2.keys() == p.keys())
+        self.assert_(p2.a.parentNode() is p2)
+
+    def testBytes_05_shared_strings(self):
+        p = makeTDInstance()
+
+        for i in range(100):
+            p["b%d.name" % i] = "a long repeated string value"
+
+        self.assert_(len(p.toBytes()) < 100*len("a long repeated string value"))
+
+    def testBytes_06_dangling(self):
+        p = makeTDInstance()
+        p.a = 1
+        p.b.c
+
+        p2 = TreeDict.fromBytes(p.toBytes())
+
+        self.assert_(p2 == p)
+        self.assert_("b" not in p2)
+
+    def testBytes_07_buffers(self):
+        p = sample_tree()
+        s = p.toBytes()
+
+        self.assert_(TreeDict.fromBytes(bytearray(s)) == p)
+        self.assert_(TreeDict.fromBytes(memoryview(s)) == p)
+
+    def testBytes_08_bad_data(self):
+        s = sample_tree().toBytes()
+
+        self.assertRaises(ValueError, lambda: TreeDict.fromBytes(s[:-1]))
+        self.assertRaises(ValueError, lambda: TreeDict.fromBytes(s + b"\x00"))
+        self.assertRaises(ValueError, lambda: TreeDict.fromBytes(b"xyz"))
+        self.assertRaises(ValueError, lambda: TreeDict.fromBytes(b""))
+
+    def testBytes_09_branch(self):
+        p = makeTDInstance()
+        p.set('a.b.x', 1, 'y', 2)
+
+        p2 = TreeDict.fromBytes(p.a.toBytes())
+
+        self.assert_(p2.isRoot())
+        self.assert_(p2 == p.a)
+
+    def testPickling_P5_buffers(self):
+        if pickle.HIGHEST_PROTOCOL < 5:
+            return
+
+        p = makeTDInstance()
+        p.a.b = b"x" * 100000
+        p.a.c = bytearray(b"y" * 100000)
+        p.d = b"small"
+
+        buffers = []
+        s = pickle.dumps(p, protocol = 5, buffer_callback = buffers.append)
+
+        self.assert_(len(buffers) == 2)
+        self.assert_(len(s) < 1000)
+
+        p2 = pickle.loads(s, buffers = buffers)
+
+        self.assert_(p2 == p)
+        self.assert_(type(p2.a.b) is bytes)
+        self.assert_(type(p2.a.c) is bytearray)
+
+        # In-band, with the buffers written into the stream
+        p3 = pickle.loads(pickle.dumps(p, protocol = 5))
+
+        self.assert_(p3 == p)
+        self.assert_(type(p3.a.b) is bytes)
+        self.assert_(type(p3.a.c) is bytearray)
+
+    def testPickling_P5_numpy(self):
+        try:
+            import numpy
+        except ImportError:
+            return
+
+        if pickle.HIGHEST_PROTOCOL < 5:
+            return
+
+        p = makeTDInstance()
+        p.a.x = numpy.arange(100000)
+
+        buffers = []
+        s = pickle.dumps(p, protocol = 5, buffer_callback = buffers.append)
+
+        self.assert_(len(buffers) == 1)
+
+        p2 = pickle.loads(s, buffers = buffers)
+
+        self.assert_((p2.a.x == p.a.x).all())
+
+    def lazyRoundTrip(self, p, protocol = 2):
+        p.setLazyPickling()
+        return pickle.loads(pickle.dumps(p, protocol = protocol))
+
+    def testLazyPickling_01(self):
+        p = sample_tree()
+        p2 = self.lazyRoundTrip(p)
+
+        self.assert_(p2 == p)
+        self.assert_(p2.hash() == p.hash())
+        self.assert_(p2.keys() == p.keys())
+
+    def testLazyPickling_02_frozen(self):
+        p = frozen_tree()
+        p2 = self.lazyRoundTrip(p)
+
+        self.assert_(p2.isFrozen())
+        self.assert_(p2 == p)
+
+    def testLazyPickling_03_order(self):
+        p = makeTDInstance()
+        p.set('c', 1, 'a.z', 2, 'b', 3, 'a.y', 4)
+        p.c = 5
+        p.a.z = 6
+
+        p2 = self.lazyRoundTrip(p, protocol = 0)
+
+        p.a.w = 7
+        p2.a.w = 7
+        p.d = 8
+        p2.d = 8
+
+        self.assert_(p2.keys() == p.keys())
+        self.assert_(p2.a.parentNode() is p2)
+
+    def testLazyPickling_04_flags(self):
+        p = makeTDInstance()
+        p.set('a.x', 1, 'b.y.z', 2)
+        p.freeze('b')
+
+        p2 = self.lazyRoundTrip(p)
+
+        self.assert_(not p2.isFrozen())
+        self.assert_(p2.b.isFrozen())
+        self.assert_(p2.b.y.isFrozen())
+
+        p2.a.x = 3
+        self.assertRaises(TypeError, lambda: p2.set('b.y.z', 3))
+
+    def testLazyPickling_05_freeze_before_load(self):
+        p = makeTDInstance()
+        p.set('a.b.c', 1)
+
+        p2 = self.lazyRoundTrip(p)
+        p2.freeze()
+
+        self.assert_(p2.a.b.isFrozen())
+        self.assertRaises(TypeError, lambda: p2.set('a.b.c', 2))
+
+    def testLazyPickling_06_dangling(self):
+        p = makeTDInstance()
+        p.a = 1
+        d = p.b.c
+
+        p2 = self.lazyRoundTrip(p)
+
+        self.assert_(p2 == p)
+        self.assert_("b" not in p2)
+
+        p2.b.c.x = 1
+        self.assert_(p2.b.c.x == 1)
+
+    def testLazyPickling_07_kept(self):
+        p = makeTDInstance()
+        p.set('a.x', 1)
+
+        p2 = self.lazyRoundTrip(p)
+        p3 = pickle.loads(pickle.dumps(p2))
+
+        self.assert_(p3 == p)
+
+        p.setLazyPickling(False)
+        self.assert_(pickle.loads(pickle.dumps(p)) == p)
+
+    def testLazyPickling_08_copies(self):
+        p = makeTDInstance()
+        p.set('a.x', 1, 'b.y', [1,2])
+
+        p2 = self.lazyRoundTrip(p)
+        p3 = p2.copy(copy_on_write = True)
+        p3.a.x = 2
+
+        self.assert_(p2.a.x == 1)
+        self.assert_(p3.b.y == [1,2])
+        self.assert_(p2._numMutable() == 0 and p2.b._numMutable() == 1)
+
+    def testLazyPickling_09_branch_values(self):
+        # Values that are branches of the same tree stay linked to them
+
+        p = makeTDInstance()
+        p.set('b.y', 1, 'c.d.e', 2)
+        p.x = p.b
+        p.c.z = p.c.d
+
+        p2 = self.lazyRoundTrip(p)
+
+        self.assert_(p2.x is p2.b)
+        self.assert_(p2.c.z is p2.c.d)
+
+        p2.b.w = 3
+        self.assert_(p2.x.w == 3)
+
+    def testLazyPickling_10_outside_values(self):
+        # Tree values outside the tree are still pickled lazily
+
+        q = makeTDInstance()
+        q.a.v = 1
+
+        p = makeTDInstance()
+        p.b.x = q.a
+
+        s = pickle.dumps(p)
+        p.setLazyPickling()
+
+        self.assert_(pickle.dumps(p) != s)
+        self.assert_(self.lazyRoundTrip(p).b.x.v == 1)
+
+    def mappedRoundTrip(self, p):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+
+        try:
+            p.saveMapped(path)
+            return TreeDict.openMapped(path)
+        finally:
+            os.remove(path)
+
+    def testMapped_01(self):
+        p = sample_tree()
+        p2 = self.mappedRoundTrip(p)
+
+        self.assert_(p2 == p)
+        self.assert_(p2.keys() == p.keys())
+        self.assert_(p2.hash() == p.hash())
+
+    def testMapped_02_frozen(self):
+        p = frozen_tree()
+        p2 = self.mappedRoundTrip(p)
+
+        self.assert_(p2.isFrozen())
+        self.assert_(p2 == p)
+
+    def testMapped_03_frozen_branch(self):
+        p = makeTDInstance()
+        p.set('a.x', 1, 'b.y', 2)
+        p.freeze('b')
+
+        p2 = self.mappedRoundTrip(p)
+
+        self.assert_(not p2.isFrozen())
+        self.assert_(p2.b.isFrozen())
+        self.assertRaises(TypeError, lambda: p2.set('b.y', 3))
+
+        p2.a.x = 10
+        self.assert_(p2.a.x == 10)
+
+    def testMapped_04_values(self):
+        p = makeTDInstance()
+        p.set(n = None, t = True, i = -5, x = 0.25, s = u"\u00e9",
+              b = b"\x01", l = [1, 2])
+        p.br.c = "abc"
+
+        p2 = self.mappedRoundTrip(p)
+
+        self.assert_(p2 == p)
+        self.assert_(p2._numMutable() == p._numMutable())
+
+    def testMapped_05_single_branch(self):
+        p = makeTDInstance()
+
+        for i in range(100):
+            p["b%d.x" % i] = i
+
+        p2 = self.mappedRoundTrip(p)
+
+        self.assert_(p2.b57.x == 57)
+        self.assert_(p2.b57.parentNode() is p2)
+        self.assert_(p2.get("b3.x") == 3)
+        self.assert_(p2.size() == 100)
+
+    def testMapped_06_copies(self):
+        p = makeTDInstance()
+        p.set('a.x', 1, 'b.y', 2)
+
+        p2 = self.mappedRoundTrip(p)
+
+        p3 = p2.copy(copy_on_write = True)
+        p3.a.x = 5
+
+        self.assert_(p2.a.x == 1)
+        self.assert_(p3.b.y == 2)
+        self.assert_(p2.copy() == p)
+        self.assert_(p2.diff(p3)['changed'] == {'a.x' : (1, 5)})
+
+    def testMapped_07_bad_file(self):
+        fd, path = tempfile.mkstemp()
+        os.write(fd, b"not a tree at all")
+        os.close(fd)
+
+        try:
+            self.assertRaises(ValueError, lambda: TreeDict.openMapped(path))
+        finally:
+            os.remove(path)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -159,6 +159,56 @@ class TestProperties(unittest.TestCase):
         
         self.assert_(not p1.isMutable())
         
+    def testMutability_04_deep_branch(self):
+        p1 = makeTDInstance('root')
+
+        p1.a.b.c.d = 1
+        p1.a.b.c.e = [1,2]
+        p1.x.y = 2
+
+        p1.freeze()
+
+        # Asked twice so the kept counts are used the second time
+        self.assert_(p1.isMutable())
+        self.assert_(p1.isMutable())
+        self.assert_(p1.a.b.isMutable())
+        self.assert_(not p1.x.isMutable())
+        self.assert_(not p1.x.isMutable())
+
+        self.assertRaises(TypeError, lambda: hash(p1))
+
+    def testMutability_05_tree_value_frozen_later(self):
+        p1 = makeTDInstance('root')
+        p2 = makeTDInstance('node')
+
+        p2.a.b = 432
+        p1.a.b.node = p2
+
+        p1.freeze()
+
+        self.assert_(p1.isMutable())
+        self.assert_(p1.isMutable())
+
+        p2.freeze()
+
+        self.assert_(not p1.isMutable())
+        hash(p1)
+
+    def testMutability_06_changed_copy(self):
+        p1 = makeTDInstance('root')
+
+        p1.a.b.c = 1
+        p1.freeze()
+
+        self.assert_(not p1.isMutable())
+
+        p2 = p1.copy()
+        p2.a.b.d = [1,2]
+        p2.freeze()
+
+        self.assert_(p2.isMutable())
+        self.assert_(not p1.isMutable())
+
     def testFreezingValues_01(self):
         p1 = makeTDInstance('root')
         
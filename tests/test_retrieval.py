@@ -403,6 +403,94 @@ class TestRetrieval(unittest.TestCase):
 
         self.assert_(d2['a'][0] is d2)
 
+    def _report(self, t, **kwargs):
+        out = []
+
+        class Stream(object):
+            def write(self, s):
+                out.append(s)
+
+        t.writeReport(Stream(), **kwargs)
+
+        return ''.join(out)
+
+    def testReport_01_matches_makeReport(self):
+        t = makeTDInstance('mytree')
+        t.x = 1
+        t.a.z = [1,2,3]
+        t.b.x = "hello"
+        t.a.longer_name = None
+        t.y = 2
+        t.a.c.d = 3
+        t.e  # dangling
+
+        for kw in [{}, {'recursive' : False}, {'add_path' : True},
+                   {'add_path' : True, 'add_tree_name' : False}]:
+
+            self.assert_(self._report(t, **kw) == t.makeReport(**kw) + '\n')
+            self.assert_(self._report(t.a, **kw) == t.a.makeReport(**kw) + '\n')
+
+    def testReport_02_makeReport_order(self):
+        t = makeTDInstance()
+        t.b.x = 1
+        t.a = 2
+        t.b.c = 3
+
+        self.assert_(t.makeReport() == "b.x = 1\nb.c = 3\na   = 2")
+
+    def testReport_03_empty(self):
+        t = makeTDInstance()
+        t.a.b
+
+        self.assert_(self._report(t) == '')
+        self.assert_(t.makeReport() == '')
+
+    def testReport_04_align(self):
+        t = makeTDInstance()
+        t.x = 1
+        t.ab.c = 2
+        t.ab.de = 3
+
+        self.assert_(self._report(t, align = 'global') == "x     = 1\nab.c  = 2\nab.de = 3\n")
+        self.assert_(self._report(t, align = 'branch') == "x = 1\nab.c  = 2\nab.de = 3\n")
+        self.assert_(self._report(t, align = 'none') == "x = 1\nab.c = 2\nab.de = 3\n")
+
+        self.assertRaises(ValueError, lambda: self._report(t, align = 'left'))
+
+    def testReport_05_max_value_length(self):
+        t = makeTDInstance()
+        t.a = list(range(100000))
+        t.b = 'x' * 1000
+        t.c = 1
+
+        lines = self._report(t, max_value_length = 30).splitlines()
+
+        self.assert_(len(lines) == 3)
+        self.assert_(lines[0].startswith('a = [0, 1, 2,'))
+        self.assert_(lines[2] == 'c = 1')
+
+        for l in lines:
+            self.assert_(len(l) <= len('a = ') + 30)
+
+        self.assertRaises(ValueError, lambda: self._report(t, max_value_length = 2))
+
+    def testReport_06_large(self):
+        t = makeTDInstance()
+
+        for i in range(10000):
+            t['b%d.v%d' % (i % 10, i)] = i
+
+        out = []
+
+        class Stream(object):
+            def write(self, s):
+                out.append(s)
+
+        t.writeReport(Stream())
+
+        self.assert_(len(out) > 1)
+        self.assert_(''.join(out) == t.makeReport() + '\n')
+
 
 
 
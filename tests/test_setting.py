@@ -651,6 +651,75 @@ class TestSetting(unittest.TestCase):
 
         self.assert_(t.a is t)
 
+    def testFromDict_04_shared_dict(self):
+
+        # The first occurrence becomes the branch; others refer to it
+        d = {'x' : 1}
+        t = TreeDict.fromdict({'a' : {'b' : d, 'c' : d}}, expand_nested = True)
+
+        self.assert_(t.a.b is t.a.c)
+        self.assert_(t.a.b.x == 1)
+        self.assert_(t.a.b.parentNode() is t.a or t.a.c.parentNode() is t.a)
+
+    def testFromDict_05_dotted_and_nested(self):
+        t = TreeDict.fromdict({'a.x' : 1, 'a' : {'y' : 2}, 'b' : {'c.d' : 3}},
+                              expand_nested = True)
+
+        t2 = makeTDInstance()
+        t2.a.x = 1
+        t2.a.y = 2
+        t2.b.c.d = 3
+
+        self.assert_(t == t2)
+
+    def testFromDict_06_matches_setting(self):
+        d = {'a' : {'b' : [1, 2], 'c' : (1, 2), 'd' : 'x', 'e' : {}},
+             'f' : 1.5, 'g' : set([1])}
+
+        t = TreeDict.fromdict(d, expand_nested = True)
+
+        t2 = makeTDInstance()
+        t2.a.b = [1, 2]
+        t2.a.c = (1, 2)
+        t2.a.d = 'x'
+        t2.makeBranch('a.e')
+        t2.f = 1.5
+        t2.g = set([1])
+
+        self.assert_(t == t2)
+        self.assert_(t.hash() == t2.hash())
+        self.assert_(t.a.e.parentNode() is t.a)
+        self.assert_(t.convertTo() == d)
+
+        self.assert_(t.isMutable())
+        self.assert_(t.a.isMutable())
+
+        t.freeze()
+        self.assert_(t.isFrozen())
+        self.assertRaises(TypeError, lambda: t.a.__setattr__('d', 1))
+
+    def testFromDict_07_tree_values(self):
+        t2 = makeTDInstance()
+        t2.x = 1
+
+        t = TreeDict.fromdict({'a' : {'t' : t2}}, expand_nested = True)
+
+        self.assert_(t.a.t is t2)
+        self.assert_(t2.parentNode() is None)
+
+    def testFromDict_08_bad_names(self):
+        self.assertRaises(NameError, lambda: TreeDict.fromdict(
+            {'a' : {'1b' : 1}}, expand_nested = True))
+        self.assertRaises(TypeError, lambda: TreeDict.fromdict(
+            {'a' : {1 : 1}}, expand_nested = True))
+
+    def testFromDict_09_mapping_function(self):
+        t = TreeDict.fromdict({'a' : {'b' : 1}, 'c' : 2}, expand_nested = True,
+                              mapping_function = lambda v: v * 10 if isinstance(v, int) else v)
+
+        self.assert_(t.a.b == 10)
+        self.assert_(t.c == 20)
+
     def testOrdering_01(self):
         t = makeTDInstance()
 
@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2009-2011, Hoyt Koepke (hoytak@gmail.com)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     - Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     - Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     - Neither the name 'treedict' nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY Hoyt Koepke ''AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL Hoyt Koepke BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import unittest, pickle, threading, time
+from treedict import TreeDict
+
+from common import *
+
+def runThreads(targets):
+    errors = []
+
+    def wrap(f):
+        def run():
+            try:
+                f()
+            except Exception as e:
+                errors.append(e)
+        return run
+
+    threads = [threading.Thread(target=wrap(f)) for f in targets]
+
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+
+    return errors
+
+class _SlowRepr(object):
+    # Signals when its repr is taken and waits before returning, so a
+    # report of the tree holds the read lock for a while.
+
+    def __init__(self, started):
+        self.started = started
+
+    def __repr__(self):
+        self.started.set()
+        time.sleep(0.2)
+        return "slow"
+
+class _YieldingValue(object):
+    # Gives up the GIL when compared, so other threads run while a
+    # comparison is in progress.
+
+    def __init__(self, v):
+        self.v = v
+
+    def __eq__(self, other):
+        time.sleep(0)
+        return isinstance(other, _YieldingValue) and self.v == other.v
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.v)
+
+class TestThreadSafe(unittest.TestCase):
+
+    def testSetting_01(self):
+        p = makeTDInstance()
+        p.a.b = 1
+
+        self.assert_(not p.isThreadSafe())
+
+        p.a.setThreadSafe()
+
+        self.assert_(p.isThreadSafe())
+        self.assert_(p.a.isThreadSafe())
+
+        p.setThreadSafe(False)
+
+        self.assert_(not p.isThreadSafe())
+        self.assert_(p.a.b == 1)
+
+    def testSetting_02_not_copied(self):
+        p = makeTDInstance()
+        p.a.b = 1
+        p.setThreadSafe()
+
+        p2 = p.copy()
+        self.assert_(not p2.isThreadSafe())
+        self.assert_(p2 == p)
+
+        p3 = pickle.loads(pickle.dumps(p, protocol=2))
+        self.assert_(not p3.isThreadSafe())
+        self.assert_(p3 == p)
+
+    def testOperations_01(self):
+        # Operations that call each other internally must not block
+        # on the lock they already hold.
+
+        p = makeTDInstance()
+        p.setThreadSafe()
+
+        p.a.b.c = 1
+        p["a.b.d"] = 2
+        p.set("x", 3, y = 4)
+        p.setdefault("z", 5)
+        p.update({"w" : 6})
+        p.makeBranch("e").f = 7
+
+        self.assert_(p.a.b.c == 1)
+        self.assert_(p.get("a.b.d") == 2)
+        self.assert_("a.b.c" in p)
+        self.assert_(p.size() == 7)
+        self.assert_(set(p.keys()) == set(["a.b.c", "a.b.d", "x", "y", "z", "w", "e.f"]))
+
+        p.freeze("a")
+        p.pop("x")
+        del p.y
+        del p["z"]
+
+        p.freeze()
+        hash(p)
+        p.hash()
+
+        self.assert_(p.flatten() == {"a.b.c" : 1, "a.b.d" : 2, "w" : 6, "e.f" : 7})
+
+    def testConcurrent_01_readers_and_writer(self):
+        p = makeTDInstance()
+        p.setThreadSafe()
+
+        for i in range(100):
+            p["b%d.v" % i] = i
+
+        def reader():
+            for n in range(200):
+                for i in range(0, 100, 10):
+                    self.assert_(p["b%d.v" % i] == i)
+                    self.assert_(getattr(p, "b%d" % i).v == i)
+                p.keys()
+
+        def writer():
+            for n in range(200):
+                p["w.c%d" % (n % 10)] = n
+                p.size()
+
+        errors = runThreads([reader]*4 + [writer])
+
+        self.assert_(not errors, errors)
+        self.assert_(p.w.c9 == 199)
+
+    def testConcurrent_02_writer_waits(self):
+        started = threading.Event()
+        order = []
+
+        p = makeTDInstance()
+        p.setThreadSafe()
+        p.a = _SlowRepr(started)
+
+        def reader():
+            p.makeReport()
+            order.append("read")
+
+        def writer():
+            started.wait()
+            p.b = 1
+            order.append("write")
+
+        errors = runThreads([reader, writer])
+
+        self.assert_(not errors, errors)
+        self.assert_(order == ["read", "write"], order)
+
+    def testConcurrent_03_lazy_loading(self):
+        p = makeTDInstance()
+
+        for i in range(50):
+            p["b%d.c.v" % i] = i
+
+        p.setLazyPickling()
+        p2 = pickle.loads(pickle.dumps(p))
+        p2.setThreadSafe()
+
+        def reader():
+            for i in range(50):
+                self.assert_(p2.get("b%d.c.v" % i) == i)
+
+        errors = runThreads([reader]*8)
+
+        self.assert_(not errors, errors)
+        self.assert_(p2 == p)
+
+    def testConcurrent_04_compare_and_patch(self):
+        p = makeTDInstance()
+
+        for i in range(20):
+            p["b%d.v" % i] = _YieldingValue(i)
+
+        pa = p.copy()
+        pb = p.copy()
+
+        for i in range(0, 20, 2):
+            pb["b%d.v" % i] = _YieldingValue(-i)
+        del pb.b1
+        pb.c = 1
+
+        forward, back = pa.diff(pb), pb.diff(pa)
+
+        for q in [p, pa, pb]:
+            q.setThreadSafe()
+
+        def reader():
+            for i in range(200):
+                self.assert_((p == pa) != (pb == p))
+                d = p.diff(pa)
+                self.assert_(d == pa.diff(pa) or d == back, d)
+
+        def writer():
+            for i in range(100):
+                p.applyPatch(forward)
+                p.applyPatch(back)
+
+        errors = runThreads([reader]*4 + [writer])
+
+        self.assert_(not errors, errors)
+        self.assert_(p == pa)
+
+    def testFrozen_01_iterators(self):
+        p = makeTDInstance()
+        p.set("a.x", 1, "a.y", 2, "b", 3, "c", 4)
+
+        it = p.iteritems()
+        next(it)
+        self.assert_(p._iteratorRefCount() == 1)
+        del it
+
+        p.freeze()
+
+        # Frozen trees are not told about their iterators
+        it = p.iteritems()
+        next(it)
+        self.assert_(p._iteratorRefCount() == 0)
+        self.assert_(p.a._iteratorRefCount() == 0)
+
+        self.assert_(len(list(it)) == 3)
+
+    def testFrozen_02_getattr(self):
+        p = makeTDInstance()
+        p.a.b = 1
+        p.c.d
+        p.freeze()
+
+        self.assert_(p.a.b == 1)
+        self.assertRaises(AttributeError, lambda: p.x)
+        self.assertRaises(AttributeError, lambda: p.c)
+        self.assert_(not hasattr(p, "c"))
+
+    def testFrozen_03_concurrent_lazy_loading(self):
+        # Frozen trees are read without setThreadSafe()
+        p = makeTDInstance()
+
+        for i in range(50):
+            p["b%d.c.v" % i] = i
+
+        p.setLazyPickling()
+        p.freeze()
+        p2 = pickle.loads(pickle.dumps(p))
+
+        def reader():
+            for i in range(50):
+                self.assert_(getattr(p2, "b%d" % i).c.v == i)
+            self.assert_(len(p2.keys()) == 50)
+
+        errors = runThreads([reader]*8)
+
+        self.assert_(not errors, errors)
+        self.assert_(p2 == p)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -718,7 +718,185 @@ class TestUpdate(unittest.TestCase):
 
         self.assertRaises(TypeError, lambda: p.update(q) )
 
+    def testUpdate_Atomic_01(self):
+        # A failure partway through leaves the tree untouched
 
+        p = makeTDInstance()
+        p.a = 1
+        p.b.c = 2
+        p.z.x = 1
+        p.freeze("z")
+
+        h = p.hash()
+
+        q = makeTDInstance()
+        q.a = 10
+        q.b.d = 3
+        q.n.m = 4
+        q.z.x = 5
+
+        self.assertRaises(TypeError, lambda: p.update(q))
+
+        self.assert_(p.hash() == h)
+        self.assert_(p.a == 1)
+        self.assert_("b.d" not in p)
+        self.assert_("n" not in p)
+        self.assert_(p.z.x == 1)
+
+    def testUpdate_Atomic_02_order_preserved(self):
+
+        p = makeTDInstance()
+        p.a = 1
+        p.b = 2
+        p.c = 3
+        p.z.x = 1
+        p.freeze("z")
+
+        q = makeTDInstance()
+        q.b = 20
+        q.d = 4
+        q.z.x = 2
+
+        self.assertRaises(TypeError, lambda: p.update(q))
+
+        self.assert_(p.keys() == ['a', 'b', 'c', 'z.x'])
+
+        p.e = 5
+        self.assert_(p.keys() == ['a', 'b', 'c', 'z.x', 'e'])
+
+    def testUpdate_Atomic_03_dangling(self):
+
+        p = makeTDInstance()
+        p.z.x = 1
+        p.freeze("z")
+
+        d = p.a.b
+
+        self.assertRaises(NameError, lambda: d.update([("c", 1), ("9g", 2)]))
+
+        self.assert_(d.isDangling())
+        self.assert_("a" not in p)
+        self.assert_(p.keys() == ['z.x'])
+
+        d.c = 1
+        self.assert_(p.a.b.c == 1)
+
+    def testUpdate_Atomic_04_dict(self):
+
+        p = makeTDInstance()
+        p.a.b = 1
+        p.z.x = 1
+        p.freeze("z")
+
+        h = p.hash()
+
+        self.assertRaises(TypeError,
+                          lambda: p.update({"a.c" : 2, "n.m.o" : 3, "z.y" : 4}))
+
+        self.assert_(p.hash() == h)
+        self.assert_(p.size() == 2)
+        self.assert_("n" not in p)
+
+    def testUpdate_Dict_Dotted(self):
+
+        p = makeTDInstance()
+        p.a.b = 1
+
+        p.update({"a.c" : 2, "d.e.f" : 3, "g" : 4})
+
+        self.assert_(p.a.b == 1)
+        self.assert_(p.a.c == 2)
+        self.assert_(p.d.e.f == 3)
+        self.assert_(p.g == 4)
+        self.assert_(p.d.e.parentNode() is p.d)
+
+    def testUpdate_Dict_Overlap_01_branch_last(self):
+        # Later keys replace earlier ones, as in a new tree
+
+        for ps in [False, True]:
+            p = makeTDInstance()
+            p.a.x = 1
+
+            p.update([("a", 3), ("a.y", 4)], protect_structure = ps)
+
+            self.assert_(p.keys() == ['a.x', 'a.y'])
+            self.assert_(p.a.y == 4)
+
+    def testUpdate_Dict_Overlap_02_value_last(self):
+
+        p = makeTDInstance()
+        p.a.x = 1
+
+        p.update([("a.y", 4), ("a", 3)])
+
+        self.assert_(p.keys() == ['a'])
+        self.assert_(p.a == 3)
+
+        p = makeTDInstance()
+        p.a.x = 1
+
+        self.assertRaises(TypeError,
+                          lambda: p.update([("a.y", 4), ("a", 3)], protect_structure = True))
+        self.assert_(p.keys() == ['a.x'])
+
+    def testUpdate_Dict_Overlap_03_tree_value(self):
+
+        p = makeTDInstance()
+        p.update([("b.z", 3), ("b", TreeDict('u', w = 1))])
+
+        self.assert_(p.keys() == ['b'])
+        self.assert_(p.b.keys() == ['w'])
+
+        p = makeTDInstance()
+        p.b.q = 1
+        p.update([("b.z", 3), ("b", TreeDict('u', w = 1))], protect_structure = True)
+
+        self.assert_(p.keys() == ['b.q', 'b.w'])
+
+    def testUpdate_Dict_Overlap_04_frozen_structure(self):
+        # A value replaced by a new branch is built as a branch of a
+        # tree source would be
+
+        p = makeTDInstance()
+        p.b.b = 2
+        p.b.freeze(structure_only = True)
+
+        q = makeTDInstance()
+        q.b.b = 2
+        q.b.freeze(structure_only = True)
+
+        p.update({'b.b.c' : 1})
+        q.update(TreeDict(**{'b.b.c' : 1}))
+
+        self.assert_(p.b.b.c == 1)
+        self.assert_(p == q)
+
+    def testUpdate_Dict_BadNames(self):
+        # Names are checked before overwrite = False skips anything
+
+        p = makeTDInstance()
+        p.c = 1
+
+        self.assertRaises(NameError, lambda: p.update({'c.1bad' : 2}, overwrite = False))
+        self.assertRaises(NameError, lambda: p.update({'x' : 1, 'd.e.1bad' : 2}, overwrite = False))
+
+        self.assert_(p.keys() == ['c'])
+
+    def testUpdate_Dict_ProtectStructure(self):
+
+        p = makeTDInstance()
+        p.a = 1
+
+        self.assertRaises(TypeError,
+                          lambda: p.update({"a.b" : 2}, protect_structure = True))
+        self.assert_(p.a == 1)
+
+        p.update({"a.b" : 2, "c" : 3}, overwrite = False)
+        self.assert_(p.a == 1)
+        self.assert_(p.c == 3)
+
+        p.update({"a.b" : 2})
+        self.assert_(p.a.b == 2)
 
 
 if __name__ == '__main__':
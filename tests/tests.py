@@ -51,6 +51,11 @@ if __name__ == '__main__':
     import test_setting
     import test_update
     import test_regressions
+    import test_mapvalues
+    import test_diff
+    import test_json
+    import test_overlay
+    import test_threadsafe
 
     ts = unittest.TestSuite([
         dtl.loadTestsFromModule(test_badvalues),
@@ -71,7 +76,12 @@ if __name__ == '__main__':
         dtl.loadTestsFromModule(test_retrieval),
         dtl.loadTestsFromModule(test_setting),
         dtl.loadTestsFromModule(test_update),
-        dtl.loadTestsFromModule(test_regressions)
+        dtl.loadTestsFromModule(test_regressions),
+        dtl.loadTestsFromModule(test_mapvalues),
+        dtl.loadTestsFromModule(test_diff),
+        dtl.loadTestsFromModule(test_json),
+        dtl.loadTestsFromModule(test_overlay),
+        dtl.loadTestsFromModule(test_threadsafe)
         ])
 
     if '--verbose' in sys.argv:
@@ -1,2 +1,3 @@
-from .treedict import TreeDict, getTree, treeExists, HashError
+from .treedict import TreeDict, OverlayTreeDict, getTree, treeExists, HashError, registerDeepCopier
+from .treedict import publishShared, attachShared, unpublishShared
 
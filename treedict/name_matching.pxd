@@ -40,7 +40,9 @@ import sys
 from minsmaxes cimport min3
 from membuffers cimport size_t_v, resize_size_t_v
 import warnings
-from minsmaxes cimport min2_long
+from minsmaxes cimport min2_long, max2_long
+from libc.string cimport memset
+from libc.limits cimport LONG_MAX
 
 cdef inline long _combine_scores(long n_beginning, long n_groups, long n_end_groups, long n1, long n2, long ldist):
     # make sure that beginning matching is most important
@@ -53,17 +55,23 @@ cdef inline long name_match_distance(size_t_v *calc_buffer,
 
     # s1 is the query string, s2 is the one being compared against
 
-    cdef long n1 = len(s1)
-    cdef long n2 = len(s2)
+    s_s1 = s1.encode('utf-8')
+    t_s2 = s2.encode('utf-8')
+
+    return name_match_distance_bounded(calc_buffer, s_s1, len(s_s1), t_s2, len(t_s2),
+                                       LONG_MAX)
+
+cdef inline long name_match_distance_bounded(size_t_v *calc_buffer,
+                                             char* s, long n1, char* t, long n2,
+                                             long bound):
+
+    # The same as name_match_distance, but on the utf-8 encoded
+    # strings.  If the distance is known to be at least bound, then a
+    # value >= bound may be returned without finding it exactly.
 
     if n1 == 0: return n2
     if n2 == 0: return n1
 
-    s_s1 = s1.encode('utf-8')
-    t_s2 = s2.encode('utf-8')
-    cdef char* s = s_s1
-    cdef char* t = t_s2
-    
     cdef size_t n_beginning = 0, n_groups = 0, n_end_groups = 0
 
     # Get the overlap at the beginning; this is important
@@ -92,11 +100,62 @@ cdef inline long name_match_distance(size_t_v *calc_buffer,
         if n1 == 0: return _combine_scores(n_beginning, n_groups, n_end_groups, n1, n2,  n2)
         if n2 == 0: return _combine_scores(n_beginning, n_groups, n_end_groups, n1, n2,  n1)
 
+    # The score only grows with the edit distance, so a lower bound
+    # on that lets most poor matches be dropped before the full
+    # calculation.
+    cdef long lower = _combine_scores(n_beginning, n_groups, n_end_groups, n1, n2,
+                                      n1 - n2 if n1 > n2 else n2 - n1)
+
+    if lower >= bound:
+        return lower
+
+    lower = _combine_scores(n_beginning, n_groups, n_end_groups, n1, n2,
+                            _bagDistance(s, n1, t, n2))
+
+    if lower >= bound:
+        return lower
+
+    # Only an edit distance of at most max_dist gives a score below
+    # the bound, so the calculation can stop once it is exceeded.
+    cdef long max_dist = n1 if n1 > n2 else n2
 
-    cdef long ldist = _editDistanceDirect(calc_buffer, s, n1, t, n2)
+    if bound != LONG_MAX:
+        max_dist = min2_long(max_dist,
+                             bound - 1 - _combine_scores(n_beginning, n_groups, n_end_groups,
+                                                         n1, n2, 0))
+
+    cdef long ldist = _editDistanceDirect(calc_buffer, s, n1, t, n2, max_dist)
     return _combine_scores(n_beginning, n_groups, n_end_groups, n1, n2, ldist)
 
 
+cdef inline long _bagDistance(char *s, long n1, char *t, long n2):
+
+    # The larger of the number of characters of s not in t and of t
+    # not in s, counting repeats; this is never more than the edit
+    # distance.
+
+    cdef int counts[256]
+    cdef long i, c, n_s = 0, n_t = 0
+
+    memset(counts, 0, sizeof(counts))
+
+    for i from 0 <= i < n1: counts[<unsigned char>s[i]] += 1
+    for i from 0 <= i < n2: counts[<unsigned char>t[i]] -= 1
+
+    for i from 0 <= i < n1:
+        c = counts[<unsigned char>s[i]]
+        if c > 0:
+            n_s += c
+            counts[<unsigned char>s[i]] = 0
+
+    for i from 0 <= i < n2:
+        c = counts[<unsigned char>t[i]]
+        if c < 0:
+            n_t -= c
+            counts[<unsigned char>t[i]] = 0
+
+    return n_s if n_s > n_t else n_t
+
 
 cdef inline long editDistance(size_t_v *calc_buffer, str s1, str s2):
 
@@ -130,30 +189,71 @@ cdef inline long editDistance(size_t_v *calc_buffer, str s1, str s2):
         if n1 == 0: return n2
         if n2 == 0: return n1
     
-    return _editDistanceDirect(calc_buffer, s, n1, t, n2)
+    return _editDistanceDirect(calc_buffer, s, n1, t, n2, n1 if n1 > n2 else n2)
+
+
+cdef inline long _editDistanceDirect(size_t_v *calc_buffer, char *s, long n1, char *t, long n2,
+                                     long max_dist):
 
+    # Returns the edit distance if it is at most max_dist, and
+    # max_dist + 1 otherwise.  Only the cells within max_dist of the
+    # diagonal can be that close, so only those are filled in, a row
+    # at a time; the calculation stops once a whole row is past
+    # max_dist.
 
-cdef inline long _editDistanceDirect(size_t_v *calc_buffer, char *s, long n1, char *t, long n2):
+    cdef long over = max_dist + 1
 
-    resize_size_t_v(calc_buffer, ((n1+2)*(n2+2) + 1))
+    if max_dist < 0:
+        return 0 if n1 == 0 and n2 == 0 else over
 
-    cdef size_t* d = calc_buffer.d
+    if (n1 - n2 if n1 > n2 else n2 - n1) > max_dist:
+        return over
 
-    if d == NULL:
+    resize_size_t_v(calc_buffer, 2*(n2 + 2))
+
+    cdef size_t* prev = calc_buffer.d
+
+    if prev == NULL:
         warnings.warn("Out-of-memory error allocating buffer array.")
         return 0
 
-    cdef size_t i, j
-    cdef size_t m = n2+1
+    cdef size_t* cur = prev + (n2 + 2)
+    cdef size_t* tmp
+    cdef long i, j, lo, hi
+    cdef size_t v, row_min
+
+    for j from 0 <= j <= n2:
+        prev[j] = j if j <= max_dist else over
+
+    prev[n2 + 1] = over
 
-    for i from 0 <= i <= n1: d[i*m] = i
-    for j from 0 < j <= n2:  d[j] = j
- 
     for i from 1 <= i <= n1:
-        for j from 1 <= j <= n2:
-            d[i*m + j] = min3( d[(i-1)*m + j] + 1, # Insertion
-                               d[i*m + j-1] + 1,   # Deletion
-                               d[(i-1)*m + j-1] + (0 if s[i-1] == t[j-1] else 1) ) # Change
-    
-    return d[n1*m + n2]
-    
+        lo = max2_long(1, i - max_dist)
+        hi = min2_long(n2, i + max_dist)
+
+        cur[lo - 1] = i if lo == 1 and i <= max_dist else over
+        row_min = cur[lo - 1]
+
+        for j from lo <= j <= hi:
+            v = min3( prev[j] + 1,      # Insertion
+                      cur[j-1] + 1,     # Deletion
+                      prev[j-1] + (0 if s[i-1] == t[j-1] else 1) ) # Change
+
+            if v > <size_t>over:
+                v = over
+
+            cur[j] = v
+
+            if v < row_min:
+                row_min = v
+
+        cur[hi + 1] = over
+
+        if row_min > <size_t>max_dist:
+            return over
+
+        tmp = prev
+        prev = cur
+        cur = tmp
+
+    return prev[n2]
@@ -24,12 +24,14 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 # Cython imports
-from name_matching cimport name_match_distance, editDistance
+from name_matching cimport name_match_distance, name_match_distance_bounded, editDistance
 from minsmaxes     cimport min2, max2, max2_long, min2_long
 from membuffers    cimport size_t_v, new_size_t_v, free_size_t_v
+from libc.limits   cimport LONG_MAX
 
 # python imports.
 import sys
+import os
 import copy as copy_module
 try:
     import cPickle as pickle
@@ -42,6 +44,24 @@ import inspect
 import base64
 import heapq
 import weakref
+import struct
+import mmap
+import json
+import codecs
+import threading
+import atexit
+try:
+    import reprlib
+except ImportError:
+    import repr as reprlib
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+try:
+    import _posixshmem
+except ImportError:
+    _posixshmem = None
 
 ################################################################################
 # Some preliminary debug stuff
@@ -55,6 +75,11 @@ cdef extern from "compile_import.h":
 
 cdef object md5 = hashlib.md5
 cdef object dumps = pickle.dumps
+cdef object loads = pickle.loads
+cdef object PickleBuffer = getattr(pickle, "PickleBuffer", None)
+
+# Smaller bytes values are cheaper to copy than to pass out-of-band.
+DEF _min_pickle_buffer_size = 65536
 cdef object PicklingError = pickle.PicklingError
 cdef object copy_f = copy_module.copy
 cdef object deepcopy_f = copy_module.deepcopy
@@ -74,6 +99,9 @@ cdef object new_weakref = weakref.ref
 cdef class TreeDict(object)
 cdef class TreeDictIterator(object)
 cdef class _PTreeNode(object)
+cdef class _CopyOnWriteContext(object)
+cdef class _RWLock(object)
+cdef class _UpdateBranch(dict)
 
 ################################################################################
 # Needed python C-API stuff
@@ -84,10 +112,14 @@ cdef extern from "Python.h":
     PyObject* PyIter_Next(PyObject*)
     bint PyDict_Next(dict p, Py_ssize_t *ppos, PyObject **pkey, PyObject **pvalue)
 
+    object PyUnicode_DecodeUTF8(const char *s, Py_ssize_t size, const char *errors)
+
     void* PyMem_Malloc(size_t n)
     void* PyMem_Realloc(void *p, size_t n)
     void PyMem_Free(void *p)
 
+    long PyThread_get_thread_ident()
+
 ################################################################################
 # Commonly used dictionary keys, instantiated once here for speed
 
@@ -105,6 +137,18 @@ cdef str s_copied_node = "copied_node"
 cdef str s_copy_referencing_keys = "copy_referencing_keys"
 cdef str s_dangling_reference_queue = "dangling_reference_queue"
 cdef str s_dangling_parent_reference = "dangling_parent_reference"
+cdef str s_flattened_keys = "flattened_keys"
+cdef str s_cow_source = "cow_source"
+cdef str s_mapped_source = "mapped_source"
+cdef str s_pickled_source = "pickled_source"
+cdef str s_lazy_pickling = "lazy_pickling"
+cdef str s_cow_dependents = "cow_dependents"
+cdef str s_has_tree_values = "has_tree_values"
+cdef str s_subtree_digest = "subtree_digest"
+cdef str s_n_mutable_recursive = "n_mutable_recursive"
+cdef str s_n_entries_recursive = "n_entries_recursive"
+cdef str s_rw_lock = "rw_lock"
+cdef str s_overlay_shadow = "overlay_shadow"
 
 ################################################################################
 # Exception methods needed for internal catching
@@ -325,6 +369,9 @@ DEF f_is_copy_referenced           = (2*f_is_already_copied)
 DEF f_visited_by_hash_function     = (2*f_is_copy_referenced)
 DEF f_visited_by_im_hash_function  = (2*f_visited_by_hash_function)
 DEF f_getattr_called               = (2*f_visited_by_im_hash_function)
+DEF f_is_cow_source                = (2*f_getattr_called)
+DEF f_py_hash_cached               = (2*f_is_cow_source)
+DEF f_is_thread_safe               = (2*f_py_hash_cached)
 
 DEF f_newbranch_propegating_flags  = (f_is_frozen
     | f_only_existing_values_frozen
@@ -332,6 +379,10 @@ DEF f_newbranch_propegating_flags  = (f_is_frozen
 
 DEF f_copybranch_propegating_flags = (f_is_dangling)
 
+DEF f_freeze_flags = (f_is_frozen
+    | f_only_structure_is_frozen
+    | f_only_existing_values_frozen)
+
 ####################
 # Getting / retrieving
 DEF f_create_node_if_needed        = 1
@@ -414,6 +465,107 @@ cdef inline int itemType(v):
     
     return t_Immutable_Complex
 
+########################################
+# Deep copying of values.  All the values in one deep copy share a
+# single memo, so objects referenced from several places in the tree
+# are copied once.  Types with a registered copier skip the generic
+# copy.deepcopy dispatch.
+
+cdef frozenset _scalar_types = frozenset(
+    [int, long, float, complex, bool, str, unicode, bytes, type(None)])
+
+cdef dict _deep_copiers = {}
+cdef bint _numpy_copier_checked = False
+
+def _copyScalarList(list l, dict memo):
+    for x in l:
+        if type(x) not in _scalar_types:
+            return deepcopy_f(l, memo)
+
+    return l[:]
+
+def _copyScalarDict(dict d, dict memo):
+    for k, x in (d.iteritems() if IS_PYTHON2 else d.items()):
+        if type(x) not in _scalar_types or type(k) not in _scalar_types:
+            return deepcopy_f(d, memo)
+
+    return d.copy()
+
+def _copyNumpyArray(a, dict memo):
+    if a.dtype.hasobject:
+        return deepcopy_f(a, memo)
+    else:
+        return a.copy()
+
+_deep_copiers[list] = _copyScalarList
+_deep_copiers[dict] = _copyScalarDict
+
+cdef _checkNumpyCopier():
+    # numpy arrays can only be present if numpy has been imported, so
+    # the copier is added the first time it is found loaded.
+
+    global _numpy_copier_checked
+
+    if not _numpy_copier_checked:
+        np = sys.modules.get('numpy')
+
+        if np is not None:
+            if np.ndarray not in _deep_copiers:
+                _deep_copiers[np.ndarray] = _copyNumpyArray
+
+            _numpy_copier_checked = True
+
+def registerDeepCopier(type value_type, copier):
+    """
+    Registers `copier` as the function used by ``copy(deep = True)``
+    to copy values of type `value_type` (subclasses are not
+    included).  It is called as ``copier(value, memo)``, where `memo`
+    is the memo dictionary shared by the whole copy, and must return
+    the copied value; values it cannot handle can be passed on to
+    ``copy.deepcopy(value, memo)``.  If `copier` is None, the copier
+    registered for `value_type` is removed.
+
+    By default, lists and dicts holding only scalars are copied with a
+    flat copy, and numpy arrays without object elements are copied
+    with their ``copy()`` method.  Numbers and strings are never
+    copied.
+    """
+
+    _checkNumpyCopier()
+
+    if copier is None:
+        _deep_copiers.pop(value_type, None)
+    else:
+        _deep_copiers[value_type] = copier
+
+cdef inline _keepAlive(v, dict memo):
+    # As in copy.deepcopy; keeps the ids in memo from being reused.
+    try:
+        (<list>memo[id(memo)]).append(v)
+    except KeyError:
+        memo[id(memo)] = [v]
+
+cdef _deepCopyValue(v, int t, dict memo):
+
+    if t == t_Immutable_Simple:
+        return v
+
+    cdef object copier = _deep_copiers.get(type(v))
+
+    if copier is None:
+        return deepcopy_f(v, memo)
+
+    try:
+        return memo[id(v)]
+    except KeyError:
+        pass
+
+    r = copier(v, memo)
+    memo[id(v)] = r
+    _keepAlive(v, memo)
+
+    return r
+
 ########################################
 
 # Now a class for holding the nodes.  Queries relating to item
@@ -535,7 +687,7 @@ cdef class _PTreeNode(object):
             return False
 
         if self._t == t_Tree or self._t == t_Branch:
-            return (<TreeDict>self._v)._isEqual(<TreeDict>pn._v)
+            return (<TreeDict>self._v)._isEqualNodes(<TreeDict>pn._v)
         else:
             return self._v == pn._v
 
@@ -543,6 +695,25 @@ cdef class _PTreeNode(object):
         return (_PTreeNode_unpickler,
                 (self._v, self._t, self._order_position) )
 
+    def __reduce_ex__(self, protocol):
+
+        # With protocol 5, large bytes and bytearray values are passed
+        # as pickle buffers, so they can be sent out-of-band instead
+        # of being copied into the pickle stream.  Other values with
+        # their own support for this, e.g. numpy arrays, handle it
+        # themselves.
+
+        cdef object vt = type(self._v)
+
+        if (protocol >= 5 and PickleBuffer is not None
+            and (vt is bytes or vt is bytearray)
+            and len(self._v) >= _min_pickle_buffer_size):
+
+            return (_PTreeNode_buffer_unpickler,
+                    (PickleBuffer(self._v), vt is bytearray, self._t, self._order_position) )
+
+        return self.__reduce__()
+
 ########################################
 # Stuff for fast node creation
 
@@ -557,6 +728,18 @@ cdef inline _PTreeNode newPTreeNode(TreeDict node, str key, value, size_t order_
 def _PTreeNode_unpickler(value, int t, size_t order_pos):
     return newPTreeNodeExact(value, t, order_pos)
 
+def _PTreeNode_buffer_unpickler(buf, bint is_bytearray, int t, size_t order_pos):
+
+    # In-band, buf is already a bytes or bytearray object; out-of-band,
+    # it is whatever buffer the receiver supplied.
+
+    if is_bytearray:
+        v = buf if type(buf) is bytearray else bytearray(buf)
+    else:
+        v = buf if type(buf) is bytes else bytes(memoryview(buf))
+
+    return newPTreeNodeExact(v, t, order_pos)
+
 cdef inline newPTreeNodeExact(value, int t, size_t order_pos):
 
     cdef _PTreeNode pn = createPTreeNode(_PTreeNode)
@@ -572,6 +755,8 @@ cdef inline newPTreeNodeExact(value, int t, size_t order_pos):
 DEF i_Items  = 1
 DEF i_Keys   = 2
 DEF i_Values = 3
+DEF i_Lists  = 4
+DEF i_Dict   = 5
 
 DEF i_BranchMode_All = 1
 DEF i_BranchMode_None = 2
@@ -605,6 +790,7 @@ cdef class TreeDictIterator(object):
     cdef bint _base_treedict_referenced
     cdef bint _stop_on_next
     cdef bint _first_iter_run_yet
+    cdef bint _frozen
 
     def __cinit__(self):
         self._pos_array = NULL
@@ -638,6 +824,10 @@ cdef class TreeDictIterator(object):
         if self._pos_array == NULL:
             raise MemoryError
 
+        # A frozen tree cannot change under the iterator, so it is not
+        # told about it; iterating over it then writes nothing to it.
+        self._frozen = p.isFrozen()
+
         self._cur_pt = p
         self._incRefToCurTree(0)
 
@@ -692,7 +882,7 @@ cdef class TreeDictIterator(object):
         else:
             return r
 
-    cdef bint _loadNext(self):
+    cdef bint _loadNext(self) except *:
 
         cdef PyObject *k_obj = NULL
         cdef PyObject *pn_obj = NULL
@@ -724,12 +914,14 @@ cdef class TreeDictIterator(object):
                     self._setCurrentKey()  # Call before the recursion
 
                     if self._recursive:
+                        self._last_pn.tree()._load()
                         self.goUpStack(self._last_key, self._last_pn.tree())
 
                     return True
 
                 else:
                     if self._recursive:
+                        self._last_pn.tree()._load()
                         self.goUpStack(self._last_key, self._last_pn.tree())
 
                     continue
@@ -778,6 +970,9 @@ cdef class TreeDictIterator(object):
         self._current_key = self._fullKey(self._last_key)
 
     cdef void _decRefToCurTree(self, size_t depth):
+        if self._frozen:
+            return
+
         if depth == 0:
             if self._base_treedict_referenced:
                 self._cur_pt.iteratorDecRef()
@@ -787,6 +982,9 @@ cdef class TreeDictIterator(object):
             self._cur_pt.iteratorDecRef()
 
     cdef void _incRefToCurTree(self, size_t depth):
+        if self._frozen:
+            return
+
         self._cur_pt.iteratorIncRef()
 
         if depth == 0:
@@ -813,6 +1011,177 @@ cdef class TreeDictIterator(object):
             return (<str>self._key_stack[-1]) + '.' + k
 
 
+def _entryOrderPosition(tuple entry):
+    return (<_PTreeNode>entry[1])._order_position
+
+cdef inline _flatEmit(list l1, list l2, dict d, str k, v, int itertype):
+    if itertype == i_Keys:
+        l1.append(k)
+    elif itertype == i_Values:
+        l1.append(v)
+    elif itertype == i_Items:
+        l1.append( (k, v) )
+    elif itertype == i_Lists:
+        l1.append(k)
+        l2.append(v)
+    elif itertype == i_Dict:
+        d[k] = v
+
+
+################################################################################
+# The number of nodes currently flagged as the source of an unloaded
+# copy-on-write copy; while it is zero, writes skip the check for
+# dependent copies entirely.
+
+cdef size_t _n_cow_sources = 0
+
+################################################################################
+# Locking for trees shared between threads; see TreeDict.setThreadSafe().
+# While no tree is thread-safe, nothing here is touched.
+
+cdef size_t _n_thread_safe_trees = 0
+
+# Readers of a thread-safe tree count themselves while holding the GIL;
+# on free-threaded builds, they take the lock's mutex to do so.
+cdef bint _gil_enabled = getattr(sys, "_is_gil_enabled", lambda: True)()
+
+# Held while loading an unloaded node, so threads reading a lazily
+# unpickled, mapped or copy-on-write tree at once load each node only
+# once.
+cdef object _load_lock = threading.RLock()
+
+cdef class _RWLock(object):
+    # A readers-writer lock that a thread may take again while it
+    # holds it.  Readers only count themselves, holding the GIL, while
+    # no writer holds or waits for the lock, so they never wait on
+    # each other; the condition is only used when someone has to
+    # wait, or when there is no GIL.  Writers are preferred, so a
+    # reloading thread is not starved by a steady stream of readers.
+
+    cdef:
+        object _cond
+        dict _readers
+        long _writer
+        bint _has_writer
+        size_t _write_depth, _n_waiting_writers
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = {}
+        self._has_writer = False
+        self._write_depth = 0
+        self._n_waiting_writers = 0
+
+    cdef acquireRead(self):
+        cdef long ident = PyThread_get_thread_ident()
+
+        if self._has_writer and self._writer == ident:
+            self._write_depth += 1
+            return
+
+        if not _gil_enabled:
+            with self._cond:
+                if ident not in self._readers:
+                    while self._has_writer or self._n_waiting_writers != 0:
+                        self._cond.wait()
+
+                self._readers[ident] = self._readers.get(ident, 0) + 1
+            return
+
+        n = self._readers.get(ident, 0)
+
+        if n == 0 and (self._has_writer or self._n_waiting_writers != 0):
+            with self._cond:
+                while self._has_writer or self._n_waiting_writers != 0:
+                    self._cond.wait()
+
+                self._readers[ident] = 1
+        else:
+            self._readers[ident] = n + 1
+
+    cdef releaseRead(self):
+        cdef long ident = PyThread_get_thread_ident()
+
+        if self._has_writer and self._writer == ident:
+            self._write_depth -= 1
+            return
+
+        if not _gil_enabled:
+            with self._cond:
+                n = self._readers[ident] - 1
+
+                if n != 0:
+                    self._readers[ident] = n
+                else:
+                    del self._readers[ident]
+
+                    if not self._readers:
+                        self._cond.notify_all()
+            return
+
+        n = self._readers[ident] - 1
+
+        if n != 0:
+            self._readers[ident] = n
+            return
+
+        del self._readers[ident]
+
+        if self._n_waiting_writers != 0 and not self._readers:
+            with self._cond:
+                self._cond.notify_all()
+
+    cdef acquireWrite(self):
+        cdef long ident = PyThread_get_thread_ident()
+
+        if self._has_writer and self._writer == ident:
+            self._write_depth += 1
+            return
+
+        if ident in self._readers:
+            raise RuntimeError("A thread-safe tree cannot be changed by a thread that is reading it.")
+
+        with self._cond:
+            self._n_waiting_writers += 1
+
+            try:
+                while self._has_writer or self._readers:
+                    self._cond.wait()
+            finally:
+                self._n_waiting_writers -= 1
+
+            self._has_writer = True
+            self._writer = ident
+            self._write_depth = 1
+
+    cdef releaseWrite(self):
+        self._write_depth -= 1
+
+        if self._write_depth == 0:
+            with self._cond:
+                self._has_writer = False
+                self._cond.notify_all()
+
+    cdef bint upgrade(self) except -1:
+        # Trades a read lock for the write lock, unless the thread
+        # holds the lock more than once; returns True if it did.
+
+        cdef long ident = PyThread_get_thread_ident()
+
+        if self._has_writer or self._readers.get(ident, 0) != 1:
+            return False
+
+        self.releaseRead()
+        self.acquireWrite()
+        return True
+
+cdef inline _unlock(_RWLock lock, bint write_locked):
+    if lock is not None:
+        if write_locked:
+            lock.releaseWrite()
+        else:
+            lock.releaseRead()
+
 ################################################################################
 # Now the actual parameter tree structure
 
@@ -830,6 +1199,8 @@ cdef class TreeDict(object):
 
         size_t _n_mutable, _next_item_order_position, _n_dangling
 
+        Py_hash_t _py_hash
+
         dict _aux_dict
 
         object __weakref__
@@ -837,6 +1208,15 @@ cdef class TreeDict(object):
     def __cinit__(self):
         self._run__cinit__()
 
+    def __dealloc__(self):
+        global _n_cow_sources, _n_thread_safe_trees
+
+        if _flagOn(&self._flags, f_is_cow_source):
+            _n_cow_sources -= 1
+
+        if _flagOn(&self._flags, f_is_thread_safe):
+            _n_thread_safe_trees -= 1
+
     cdef _run__cinit__(self):
 
         # Split this off so the new style constructor can use them
@@ -875,18 +1255,26 @@ cdef class TreeDict(object):
     # Parameters for manipulating the values
 
     def __setattr__(self, k, v):
+        cdef _RWLock lock = self._lockWrite()
+
         try:
             self._setLocal(validateKey(k), v, 0)
         except Exception, e:
             if DEBUG_MODE: raise
             else: raise e
+        finally:
+            _unlock(lock, True)
 
     def __setitem__(self, k, v):
+        cdef _RWLock lock = self._lockWrite()
+
         try:
             self._set(validateKey(k), v, 0)
         except Exception, e:
             if DEBUG_MODE: raise
             else: raise e
+        finally:
+            _unlock(lock, True)
 
     def setFromString(self, key, str value, dict extra_variables = {}):
         """
@@ -933,11 +1321,15 @@ cdef class TreeDict(object):
             v = value
             ret_status = False
 
+        cdef _RWLock lock = self._lockWrite()
+
         try:
             self._set(validateKey(key), v, 0)
         except Exception, e:
             if DEBUG_MODE: raise
             else: raise e
+        finally:
+            _unlock(lock, True)
 
         return ret_status
 
@@ -1050,23 +1442,135 @@ cdef class TreeDict(object):
 
         return p
 
+    @classmethod
+    def fromJSON(cls, source, mapping_function = None):
+        """
+        Creates a new TreeDict from JSON text, as written by
+        ``convertTo('json')``.  `source` may be a file-like object
+        with a ``read()`` method, returning either text or utf-8
+        encoded bytes, or a string holding the JSON text.  The JSON
+        text must be a single object.
+
+        The text is read in pieces as it is parsed, with each nested
+        object becoming a branch and each other value being set as it
+        is reached, so no intermediate dictionary of the whole tree is
+        built.  Arrays are set as lists; any objects within them are
+        read as dictionaries.  A ValueError is raised if the text is
+        not valid JSON.
+
+        As with :meth:`fromdict`, if `mapping_function` is given, then
+        each value is passed through it before being set.  This allows
+        values that were written as a JSON compatible replacement
+        (e.g. using the `non_json` parameter of :meth:`convertTo`) to
+        be restored.
+
+        Example::
+
+            >>> from treedict import TreeDict
+            >>> t = TreeDict.fromJSON('{"a": {"x": 1, "y": [1, 2]}, "z": "abc"}')
+            >>> print t.makeReport()
+            a.x = 1
+            a.y = [1, 2]
+            z   = 'abc'
+        """
+
+        try:
+            return _readJSON(source, mapping_function)
+        except Exception, e:
+            if DEBUG_MODE: raise
+            else: raise e
+
+    @staticmethod
+    def overlay(base, *layers):
+        """
+        Returns an :class:`OverlayTreeDict` presenting the tree `base`
+        with the trees in `layers` laid over it in order, so that a
+        value in a later layer takes precedence over the same key in
+        an earlier layer or in `base`.  This gives the same values as
+        ``base.copy().update(layer_1).update(layer_2) ...``, except
+        that nothing is copied; lookups fall through the layers as
+        they are made.
+
+        Writes to the overlay go to a new, initially empty top layer;
+        `base` and `layers` are never modified.  Thus many overlays
+        may share the same base tree.  A plain TreeDict holding the
+        values of the overlay is given by
+        :meth:`OverlayTreeDict.materialize`.
+
+        Example::
+
+            >>> from treedict import TreeDict
+            >>> defaults = TreeDict() ; defaults.set('run.n', 10, 'run.seed', 0)
+            >>> job = TreeDict() ; job.run.n = 20
+            >>> o = TreeDict.overlay(defaults, job)
+            >>> o.run.n, o.run.seed
+            (20, 0)
+            >>> o.run.seed = 5
+            >>> defaults.run.seed
+            0
+            >>> print o.materialize().makeReport()
+            run.n    = 20
+            run.seed = 5
+        """
+
+        cdef list ll = [base] + list(layers)
+
+        for t in ll:
+            if not isinstance(t, TreeDict):
+                raise TypeError("Layers of an overlay must be TreeDict instances.")
+
+        return _newOverlay(ll)
+
     cdef _expandDictSet(self, dict recursion_set, dict d, mapping_function):
 
-        if IS_PYTHON2:
-            for k, v in d.iteritems():
-                self._expandDictSetItem(k, v, recursion_set, d, mapping_function)
-        else:
-            for k, v in d.items():
-                self._expandDictSetItem(k, v, recursion_set, d, mapping_function)
-            
-    cdef _expandDictSetItem(self, k, v, dict recursion_set, dict d, mapping_function):
+        # Builds the tree directly from d.  Nodes for new keys with
+        # simple names, and branches for their dict values, are
+        # created here, with the bookkeeping done by _setLocal done
+        # once for the whole branch; dotted or existing keys, tree
+        # values and repeated dicts go through _expandDictSetItem.
 
-        if mapping_function is not None:
-            try:
-                v = mapping_function(v)
-            except Exception, e:
-                setattr(e, "__is_mapping_function_exception__", True)
-                raise
+        cdef TreeDict b
+        cdef _PTreeNode pn
+        cdef bint reset_hashes = False
+
+        for k, v in (d.iteritems() if IS_PYTHON2 else d.items()):
+
+            if mapping_function is not None:
+                try:
+                    v = mapping_function(v)
+                except Exception, e:
+                    setattr(e, "__is_mapping_function_exception__", True)
+                    raise
+
+            if (type(k) is not str or k in self._param_dict or not isValidName(<str>k)
+                or isinstance(v, TreeDict) or (type(v) is dict and id(v) in recursion_set)):
+
+                self._expandDictSetItem(k, v, recursion_set, mapping_function)
+
+            elif type(v) is dict:
+                b = newTreeDict(<str>k, False)
+                b._setParent(self)
+                b._flags = self._flags & f_newbranch_propegating_flags
+
+                self._branches.append(b)
+                self._param_dict[k] = newPTreeNodeExact(b, t_Branch, self._getNextOrderValue())
+
+                recursion_set[id(v)] = b
+                b._expandDictSet(recursion_set, <dict>v, mapping_function)
+
+            else:
+                pn = newPTreeNodeExact(v, itemType(v), self._getNextOrderValue())
+                self._param_dict[k] = pn
+
+                if pn.isMutable():
+                    self._n_mutable += 1
+                elif pn.isImmutable():
+                    reset_hashes = True
+
+        if reset_hashes:
+            self._resetImmutableHashes()
+
+    cdef _expandDictSetItem(self, k, v, dict recursion_set, mapping_function):
 
         if type(v) is dict:
             if id(v) in recursion_set:
@@ -1074,16 +1578,16 @@ cdef class TreeDict(object):
             else:
                 tc = recursion_set[id(v)] = self.makeBranch(validateKey(k))
                 (<TreeDict>tc)._expandDictSet(recursion_set, <dict>v, mapping_function)
-                
+
         else:
             self._set(validateKey(k), v, 0)
 
     def convertTo(self, str format = 'nested_dict', **kwargs):
         """
         Converts the local tree and branches to an external format
-        given by the `format` parameter.  Currently, the only
-        supported value for `format` is 'nested_dict', which returns
-        the tree as a nested dictionary of ``key : value`` pairs.
+        given by the `format` parameter.  Currently, the supported
+        values for `format` are 'nested_dict', which returns the tree
+        as a nested dictionary of ``key : value`` pairs, and 'json'.
 
         'nested_dict' format:
 
@@ -1152,8 +1656,59 @@ cdef class TreeDict(object):
             >>> print t2.convertTo('nested_dict')
             {'b': {'x': 1}}
 
+        'json' format:
+
+          Writes the tree as a JSON object, with each branch or
+          TreeDict value being a nested object and the keys of each
+          object in the order they were set.  The tree is written as
+          it is walked, so no intermediate copy of the tree is built;
+          the result may be read back with :meth:`fromJSON`.
+
+          The 'json' format supports the following keyword parameters:
+
+          - ``stream = None`` gives a file-like object with a
+            ``write()`` method to write the JSON text to, in which
+            case None is returned.  Otherwise, the JSON text is
+            returned as a string.
+
+          - ``indent = None`` gives the number of spaces each level is
+            indented by.  If None, the JSON text is written on a
+            single line.
+
+          - ``prune_empty = True`` causes all empty branches to be
+            ignored.  Without this parameter, they show up as empty
+            objects.
+
+          - ``non_json = 'error'`` determines how values that can't be
+            represented in JSON are handled.  Lists, tuples and
+            dictionaries with string keys are written as JSON arrays
+            and objects, and TreeDict instances within them as
+            objects; anything else is a non-JSON value.  If
+            `non_json` is 'error', a TypeError is raised; if 'skip',
+            any value containing a non-JSON value is left out; if
+            'repr', non-JSON values are written as the string given
+            by ``repr()``.  Otherwise, `non_json` may be a function
+            returning a JSON compatible replacement for a non-JSON
+            value, as with the `default` parameter of ``json.dump``.
+
+          As JSON can't express shared or recursive references, a
+          TreeDict value present in several places is written in
+          full at each, and a ValueError is raised if a tree
+          contains itself.
+
+          Example 4::
+
+            >>> t = TreeDict() ; t.set('a.x', 1, 'a.y', [1, 2], z = 'abc')
+            >>> print t.convertTo('json')
+            {"a": {"x": 1, "y": [1, 2]}, "z": "abc"}
+            >>> t.b = set([1])
+            >>> print t.convertTo('json', non_json = 'skip')
+            {"a": {"x": 1, "y": [1, 2]}, "z": "abc"}
+
         """
 
+        cdef _RWLock lock
+
         if format == 'nested_dict':
             convert_values = kwargs.pop('convert_values', True)
             prune_empty = kwargs.pop('prune_empty', False)
@@ -1167,10 +1722,33 @@ cdef class TreeDict(object):
                 raise TypeError("Unrecognized keyword arguments: " + ', '.join(kwargs.keys()))
 
             d = {}
-            return self._fillNestedDict(d, {id(self) : d}, {}, convert_values,
-                                        prune_empty, expand_lists)
+            lock = self._lockRead()
+
+            try:
+                return self._fillNestedDict(d, {id(self) : d}, {}, convert_values,
+                                            prune_empty, expand_lists)
+            finally:
+                _unlock(lock, False)
+        elif format == 'json':
+            stream = kwargs.pop('stream', None)
+            indent = kwargs.pop('indent', None)
+            prune_empty = kwargs.pop('prune_empty', False)
+            non_json = kwargs.pop('non_json', 'error')
+
+            if kwargs:
+                raise TypeError("Unrecognized keyword arguments: " + ', '.join(kwargs.keys()))
+
+            if not (non_json in ('error', 'skip', 'repr') or callable(non_json)):
+                raise ValueError("`non_json` must be 'error', 'skip', 'repr' or a function.")
+
+            lock = self._lockRead()
+
+            try:
+                return _writeJSON(self, stream, indent, prune_empty, non_json)
+            finally:
+                _unlock(lock, False)
         else:
-            raise ValueError("`format` parameter must be 'nested_dict' (more coming).")
+            raise ValueError("`format` parameter must be 'nested_dict' or 'json'.")
 
     cdef dict _fillNestedDict(self, dict d, dict prev_treedict_map,
                               dict future_branches_map,
@@ -1182,6 +1760,8 @@ cdef class TreeDict(object):
         cdef list l, new_list
         cdef size_t i
 
+        self._load()
+
         cdef list _param_dict_listitems = self._param_dict.items() if IS_PYTHON2 else list(self._param_dict.items())
         
         for k, pn in _param_dict_listitems:
@@ -1278,6 +1858,7 @@ cdef class TreeDict(object):
 
         """
         cdef str key_ = validateKey(key)
+        cdef _RWLock lock = self._lockWrite()
 
         try:
             if not self._exists(key_, False):
@@ -1288,6 +1869,8 @@ cdef class TreeDict(object):
         except Exception, e:
             if DEBUG_MODE: raise
             else: raise e
+        finally:
+            _unlock(lock, True)
 
     def set(self, *args, **kwargs):
         """
@@ -1341,6 +1924,8 @@ cdef class TreeDict(object):
 
         """
 
+        cdef _RWLock lock = self._lockWrite()
+
         try:
             if s_protect_structure in kwargs:
                 v = kwargs.pop(s_protect_structure)
@@ -1355,6 +1940,8 @@ cdef class TreeDict(object):
         except Exception, e:
             if DEBUG_MODE: raise
             else: raise e
+        finally:
+            _unlock(lock, True)
 
     def checkset(self, *args, **kwargs):
         """
@@ -1364,6 +1951,8 @@ cdef class TreeDict(object):
         raise an exception.
         """
 
+        cdef _RWLock lock = self._lockRead()
+
         try:
             if s_protect_structure in kwargs:
                 v = kwargs.pop(s_protect_structure)
@@ -1378,6 +1967,8 @@ cdef class TreeDict(object):
         except Exception, e:
             if DEBUG_MODE: raise
             else: raise e
+        finally:
+            _unlock(lock, False)
 
     cdef _setAll(self, tuple args, dict kwargs, flagtype flags):
 
@@ -1517,6 +2108,8 @@ cdef class TreeDict(object):
             if (gsp & f_check_only):
                 return
 
+            self._prepareWrite()
+
             # Most common case, # 1 above
             self._keyDeleted(k, lpn)
 
@@ -1528,6 +2121,8 @@ cdef class TreeDict(object):
             if (gsp & f_check_only):
                 return
 
+            self._prepareWrite()
+
             new_pn = newPTreeNode(self, k, v, self._getNextOrderValue())
             self._param_dict[k] = new_pn
             self._keyInserted(k, new_pn)
@@ -1558,8 +2153,13 @@ cdef class TreeDict(object):
 
         cdef dict tr_dict = dict([(p, np+1) for np, p in enumerate(vl)])
 
-        for pn in self._param_dict.itervalues():
-            pn.setOrderPostion(tr_dict[pn.orderPosition()])
+        self._prepareWrite()
+
+        # The nodes may be shared with copy-on-write copies, so
+        # replace them rather than renumbering them in place.
+        for k, pn in list(self._param_dict.items()):
+            self._param_dict[k] = newPTreeNodeExact(
+                pn.value(), pn.type(), tr_dict[pn.orderPosition()])
 
         self._next_item_order_position = len(vl) + 2
 
@@ -1602,18 +2202,23 @@ cdef class TreeDict(object):
         if structure_only and values_only:
             raise ValueError("Options structure_only and values_only are mutually exclusive.")
 
-        if branch is None:
-            self._freeze_tree(structure_only, values_only)
-        else:
-            b = self.get(branch)
+        cdef _RWLock lock = self._lockWrite()
 
-            if not isinstance(b, TreeDict):
-                if not quiet:
-                    raise TypeError("Cannot freeze non-branch value at key '%s'" % branch)
-                else:
-                    return
+        try:
+            if branch is None:
+                self._freeze_tree(structure_only, values_only)
+            else:
+                b = self.get(branch)
 
-            (<TreeDict>b)._freeze_tree(structure_only, values_only)
+                if not isinstance(b, TreeDict):
+                    if not quiet:
+                        raise TypeError("Cannot freeze non-branch value at key '%s'" % branch)
+                    else:
+                        return
+
+                (<TreeDict>b)._freeze_tree(structure_only, values_only)
+        finally:
+            _unlock(lock, True)
 
 
     cdef _freeze_tree(self, bint structure_only, bint values_only):
@@ -1626,39 +2231,184 @@ cdef class TreeDict(object):
         if values_only:
             _setFlagOn(&self._flags, f_only_existing_values_frozen)
 
+        # An unloaded copy-on-write node passes these flags on to its
+        # branches when it is loaded.
+        if self._param_dict is None:
+            return
+
         for b in self._branches:
             (<TreeDict>b)._freeze_tree(structure_only, values_only)
 
+    ################################################################################
+    # Sharing the tree between threads
+
+    def setThreadSafe(self, bint thread_safe = True):
+        """
+        If `thread_safe` is True, the tree may afterwards be read and
+        changed from several threads at once.  Each operation then
+        holds a readers-writer lock kept by the root of the tree;
+        threads reading the tree do not wait on each other, while a
+        thread changing the tree waits until current readers are done
+        and holds off new ones.  The setting applies to the whole tree
+        and should be made before the tree is shared.  It is not kept
+        by copies or pickles of the tree.  If `thread_safe` is False,
+        no locking is done (default).
+
+        Reading the tree, e.g. attribute or item lookups, :meth:`get`,
+        ``in``, ``len()``, :meth:`keys`, :meth:`values`,
+        :meth:`items`, :meth:`branches`, :meth:`size`,
+        :meth:`flatten`, :meth:`makeReport`, :meth:`writeReport`,
+        :meth:`convertTo`, :meth:`toBytes`, :meth:`getClosestKey`,
+        pickling and comparisons, takes the lock for reading.
+        Comparing two trees with ``==`` or :meth:`diff` takes the
+        locks of both, always in the same order.  Changing the tree,
+        e.g. setting or deleting values, :meth:`set`,
+        :meth:`setdefault`, :meth:`update`, :meth:`applyPatch`,
+        :meth:`clear`, :meth:`pop`, :meth:`popitem`, :meth:`attach`,
+        :meth:`makeBranch`, :meth:`mapValues`, :meth:`freeze` and
+        :meth:`setLazyPickling`, takes it for writing, as do
+        :meth:`copy`, :meth:`project`, :meth:`with_`, :meth:`hash`
+        and ``hash()``, which mark the nodes they visit.  Iterators
+        returned by :meth:`iteritems` and the like do not hold the
+        lock between items.
+
+        Frozen trees are read without taking the lock, as they cannot
+        change.  Lookups in and iteration over a frozen tree write
+        nothing to it, so it may be read from any number of threads
+        without this setting.
+
+        Example::
+
+            >>> import threading
+            >>> from treedict import TreeDict
+            >>> t = TreeDict() ; t.set('a.x', 1, 'b.y', 2)
+            >>> t.setThreadSafe()
+            >>> def reader():
+            ...     for i in range(1000): t.a.x
+            >>> threads = [threading.Thread(target=reader) for i in range(4)]
+            >>> for th in threads: th.start()
+            >>> t.b.y = 3      # waits for any reads in progress
+            >>> for th in threads: th.join()
+        """
+
+        global _n_thread_safe_trees
+
+        cdef TreeDict r = self.rootNode()
+
+        if thread_safe:
+            if not _flagOn(&r._flags, f_is_thread_safe):
+                r._aux_dict[s_rw_lock] = _RWLock()
+                _setFlagOn(&r._flags, f_is_thread_safe)
+                _n_thread_safe_trees += 1
+
+        elif _flagOn(&r._flags, f_is_thread_safe):
+            del r._aux_dict[s_rw_lock]
+            _setFlagOff(&r._flags, f_is_thread_safe)
+            _n_thread_safe_trees -= 1
+
+    cpdef bint isThreadSafe(self):
+        """
+        Returns True if the tree has been made thread-safe with
+        :meth:`setThreadSafe`, and False otherwise.
+        """
+
+        return _flagOn(&self.rootNode()._flags, f_is_thread_safe)
+
+    cdef _RWLock _threadLock(self):
+        if _n_thread_safe_trees == 0:
+            return None
+
+        return self.rootNode()._aux_dict.get(s_rw_lock)
+
+    cdef inline _RWLock _readLock(self):
+        # Frozen trees cannot change, so they are read without the lock
+        return (self._threadLock()
+                if _n_thread_safe_trees != 0 and not self.isFrozen() else None)
+
+    cdef inline _RWLock _lockRead(self):
+        cdef _RWLock lock = self._readLock()
+
+        if lock is not None:
+            lock.acquireRead()
+
+        return lock
+
+    cdef tuple _lockReadWith(self, TreeDict other):
+        # Locks this tree and other for reading.  The locks are taken
+        # in the order of their ids, so threads reading the same two
+        # trees the other way around cannot deadlock.
+
+        if _n_thread_safe_trees == 0 or other is None:
+            return (self._lockRead(), None)
+
+        cdef _RWLock l1 = self._readLock(), l2 = other._readLock()
+
+        if l2 is l1:
+            l2 = None
+        elif l1 is not None and l2 is not None and id(l2) < id(l1):
+            l1, l2 = l2, l1
+
+        if l1 is not None:
+            l1.acquireRead()
+
+        if l2 is not None:
+            try:
+                l2.acquireRead()
+            except:
+                _unlock(l1, False)
+                raise
+
+        return (l1, l2)
+
+    cdef inline _RWLock _lockWrite(self):
+        cdef _RWLock lock = self._threadLock() if _n_thread_safe_trees != 0 else None
+
+        if lock is not None:
+            lock.acquireWrite()
+
+        return lock
+
     ################################################################################
     # Methods for deleting / pruning the tree
 
     def __delattr__(self, str k):
+        cdef _RWLock lock = self._lockWrite()
+
         try:
+            self._load()
             self._cut(k, self._param_dict[k])
         except KeyError, ke:
             raise AttributeError(str(ke))
         except Exception, e:
             if DEBUG_MODE: raise
             else: raise e
+        finally:
+            _unlock(lock, True)
 
     def __delitem__(self, k):
         if not isinstance(k, str):
             raise KeyError(repr(k))
 
+        cdef _RWLock lock = self._lockWrite()
+
         try:
             self._prune(k, False)
         except Exception, e:
             if DEBUG_MODE: raise
             else: raise e
+        finally:
+            _unlock(lock, True)
 
     cdef _cut(self, str k, _PTreeNode pn):
 
         cdef TreeDict p
 
         if pn is None:
+            self._load()
             pn = self._param_dict[k]
 
         self._ensureWriteable(k, _DeletionValue, pn)
+        self._prepareWrite()
 
         # Legit if this raises an error
         if DEBUG_MODE:
@@ -1722,6 +2472,7 @@ cdef class TreeDict(object):
 
         cdef int b_mode = self._getBranchMode(branch_mode)
         cdef _PTreeNode pn
+        cdef _RWLock lock = self._lockWrite()
 
         # Check if it's a dangling node; this is bad
 
@@ -1731,8 +2482,10 @@ cdef class TreeDict(object):
 
             # First check if it's frozen or can't be written
             self._ensureWriteable(None, None, None)
+            self._load()
 
             if b_mode == i_BranchMode_All:
+                self._prepareWrite()
                 self._param_dict.clear()
                 self._branches = []
                 self._n_dangling = 0
@@ -1750,6 +2503,8 @@ cdef class TreeDict(object):
         except Exception, e:
             if DEBUG_MODE: raise
             else: raise e
+        finally:
+            _unlock(lock, True)
 
     ################################################################################
     # Some methods for raising attribute errors at the proper time
@@ -1830,6 +2585,8 @@ cdef class TreeDict(object):
 
         """
 
+        cdef _RWLock lock = self._lockWrite()
+
         try:
             return self._pop(key, False, prune_empty)
         except KeyError, ke:
@@ -1840,6 +2597,8 @@ cdef class TreeDict(object):
         except Exception, e:
             if DEBUG_MODE: raise
             else: raise e
+        finally:
+            _unlock(lock, True)
 
     def popitem(self, str key = None, bint prune_empty = False, bint silent = False):
         """
@@ -1866,6 +2625,8 @@ cdef class TreeDict(object):
         extra options).
         """
 
+        cdef _RWLock lock = self._lockWrite()
+
         try:
             return self._pop(key, True, prune_empty)
         except KeyError, ke:
@@ -1876,6 +2637,8 @@ cdef class TreeDict(object):
         except Exception, e:
             if DEBUG_MODE: raise
             else: raise e
+        finally:
+            _unlock(lock, True)
 
     cdef _pop(self, str name, bint return_item_pair, bint prune_empty):
 
@@ -2022,6 +2785,7 @@ cdef class TreeDict(object):
 
         cdef str key
         cdef flagtype flags
+        cdef _RWLock lock = self._lockWrite()
 
         try:
             if tree_or_key is None and tree is None:
@@ -2067,6 +2831,8 @@ cdef class TreeDict(object):
         except Exception, e:
             if DEBUG_MODE: raise
             else: raise e
+        finally:
+            _unlock(lock, True)
 
     cdef _attach(self, str name, TreeDict tree, flagtype flags):
 
@@ -2134,6 +2900,7 @@ cdef class TreeDict(object):
     cdef _recursiveAttach(self, flagtype flags):
 
         self._ensureWriteable(None, None, None)
+        self._load()
 
         cdef _PTreeNode pn
 
@@ -2380,6 +3147,8 @@ cdef class TreeDict(object):
         (Note that dangling branches don't count, but empty branches do.)
         """
 
+        self._load()
+
         if len(self._param_dict) == 0:
             return True
 
@@ -2615,6 +3384,71 @@ cdef class TreeDict(object):
 
         """
 
+        cdef _ReportWriter w = _ReportWriter(None, recursive, 'global', None)
+        cdef _RWLock lock = self._lockRead()
+
+        try:
+            w.writeReport(self, self._reportPrefix(add_path, add_tree_name))
+        finally:
+            _unlock(lock, False)
+
+        return "\n".join(w.out)
+
+    def writeReport(self, stream, bint recursive = True, bint add_path = False,
+                    bint add_tree_name = True, align = 'global', max_value_length = None):
+        """
+        Writes the report given by :meth:`makeReport` to `stream`, a
+        file-like object with a ``write()`` method, one line per
+        value.  The lines are written as the tree is walked, so the
+        report is never held in memory as a whole; this is preferable
+        for large trees.  `recursive`, `add_path` and `add_tree_name`
+        are as in :meth:`makeReport`.
+
+        `align` determines how the values are aligned.  If 'global'
+        (default), the ``=`` signs of all lines line up, as in
+        :meth:`makeReport`; this requires a first pass over the keys
+        of the tree.  If 'branch', the lines for the values in each
+        branch are aligned only with each other, and if 'none', the
+        lines are not aligned at all.
+
+        If `max_value_length` is given, the representation of each
+        value is limited to that many characters, with large
+        containers and long strings abbreviated using ``...``.
+        Otherwise, each value is written in full as given by
+        ``repr()``.
+
+        Example::
+
+            >>> from treedict import TreeDict
+            >>> import sys
+            >>> t = TreeDict() ; t.set('x', 1, 'ab.c', range(1000), 'ab.de', 'hello')
+            >>> t.writeReport(sys.stdout, align = 'branch', max_value_length = 20)
+            x = 1
+            ab.c  = [0, 1, 2, 3, 4, ...]
+            ab.de = 'hello'
+        """
+
+        if not (align == 'global' or align == 'branch' or align == 'none'):
+            raise ValueError("`align` must be one of 'global', 'branch' or 'none'.")
+
+        if max_value_length is not None and max_value_length < 4:
+            raise ValueError("`max_value_length` must be at least 4.")
+
+        cdef _ReportWriter w
+        cdef _RWLock lock = self._lockRead()
+
+        try:
+            w = _ReportWriter(stream, recursive, align, max_value_length)
+            w.writeReport(self, self._reportPrefix(add_path, add_tree_name))
+            w.flush()
+        except Exception, e:
+            if DEBUG_MODE: raise
+            else: raise e
+        finally:
+            _unlock(lock, False)
+
+    cdef str _reportPrefix(self, bint add_path, bint add_tree_name):
+
         if add_path and add_tree_name:
             tn = self.treeName()
 
@@ -2627,16 +3461,7 @@ cdef class TreeDict(object):
         if len(prepend_string) != 0:
             prepend_string += '.'
 
-        value_list = [(self._getSettingOrderPosition(k), prepend_string + k, v)
-                      for k, v in self.iteritems(recursive, 'none')]
-
-        if len(value_list) == 0:
-            return ""
-
-        variable_space = max([len(k) for o,k,v in value_list])
-
-        return "\n".join([ (k + " "*(variable_space - len(k)) + " = " + repr(v))
-                           for (o, k, v) in sorted(value_list)])
+        return prepend_string
 
 
     cpdef tuple _getSettingOrderPosition(self, str name):
@@ -2669,12 +3494,22 @@ cdef class TreeDict(object):
 
     def __getattr__(self, str k):
 
+        # A frozen tree is read without writing anything to it, so
+        # any number of threads can read it at once.
+        if self.isFrozen():
+            return self._getFrozenAttr(k)
+
         # Different from get in that we handle non-existant branches
         # by creating a new node and flagging it as tentative
 
-        # The _getattr__called is to detect programming errors
+        # The _getattr__called is to detect programming errors.  On
+        # a thread-safe tree, other threads may be in here at the same
+        # time, so it is not used.
+
+        cdef _RWLock lock = self._lockRead()
+        cdef bint write_locked = False
 
-        if _flagOn(&self._flags, f_getattr_called):
+        if lock is None and _flagOn(&self._flags, f_getattr_called):
             raise Exception("Programming Error: Multiple (recursive?) __getattr__ with '%s'" % k)
 
         cdef bint allow_dangling_nodes = not (self.isFrozen() or self.structureIsFrozen())
@@ -2684,7 +3519,13 @@ cdef class TreeDict(object):
                                 if not allow_dangling_nodes else 0))
 
         try:
-            _setFlagOn(&self._flags, f_getattr_called)
+            # Creating a new dangling node changes the tree
+            if (lock is not None and allow_dangling_nodes
+                and not self._existsLocal(k, allow_dangling_nodes)):
+                write_locked = lock.upgrade()
+
+            if lock is None:
+                _setFlagOn(&self._flags, f_getattr_called)
 
             if self._existsLocal(k, allow_dangling_nodes):
                 return self._getLocal(k, allow_dangling_nodes)
@@ -2700,18 +3541,33 @@ cdef class TreeDict(object):
             else: raise e
 
         finally:
-            _setFlagOff(&self._flags, f_getattr_called)
+            if lock is None:
+                _setFlagOff(&self._flags, f_getattr_called)
+
+            _unlock(lock, write_locked)
+
+    cdef _getFrozenAttr(self, str k):
+        cdef _PTreeNode pn = self._getLocalPTNode(k)
+
+        if pn is None or pn.isDanglingTree():
+            self._raiseAttributeError(k)
+
+        return pn.value()
 
     def __getitem__(self, key):
         if not isinstance(key, str):
             raise KeyError("'%s' (Indexing keys must be strings, not %s)"
                            % (repr(key), repr(type(key))))
 
+        cdef _RWLock lock = self._lockRead()
+
         try:
             return self._get(key,False)
         except Exception, e:
             if DEBUG_MODE: raise
             else: raise e
+        finally:
+            _unlock(lock, False)
 
     cpdef get(self, str key, default_value = _NoDefault):
         """
@@ -2735,6 +3591,7 @@ cdef class TreeDict(object):
         checkKeyNotNone(key)
 
         cdef _PTreeNode pn
+        cdef _RWLock lock = self._lockRead()
 
         try:
             pn = self._getPTNode(key)
@@ -2751,16 +3608,22 @@ cdef class TreeDict(object):
         except Exception, e:
             if DEBUG_MODE: raise
             else: raise e
+        finally:
+            _unlock(lock, False)
 
     ################################################################################
     # existence checks
 
     def __contains__(self, k):
+        cdef _RWLock lock = self._lockRead()
+
         try:
             return self.exists(k)
         except Exception, e:
             if DEBUG_MODE: raise
             else: raise e
+        finally:
+            _unlock(lock, False)
 
     def has_key(self, key):
         """
@@ -2768,11 +3631,15 @@ cdef class TreeDict(object):
 
         This is analogous to the `has_key` dict method.
         """
+        cdef _RWLock lock = self._lockRead()
+
         try:
             return self.exists(key)
         except Exception, e:
             if DEBUG_MODE: raise
             else: raise e
+        finally:
+            _unlock(lock, False)
 
     cdef bint exists(self, k):
         if not isinstance(k, str) or k is None:
@@ -2801,6 +3668,8 @@ cdef class TreeDict(object):
 
     cdef _PTreeNode _getLocalPTNode(self, str k):
 
+        self._load()
+
         try:
             return (<_PTreeNode> self._param_dict[k])
 
@@ -2841,6 +3710,7 @@ cdef class TreeDict(object):
         cdef _PTreeNode pn
 
         if dangling_okay:
+            self._load()
             return (k in self._param_dict)
         else:
             pn = self._getLocalPTNode(k)
@@ -2939,6 +3809,15 @@ cdef class TreeDict(object):
         is returned if present.
         """
 
+        cdef _RWLock lock = self._lockWrite()
+
+        try:
+            return self._makeBranch(name, only_new)
+        finally:
+            _unlock(lock, True)
+
+    cdef TreeDict _makeBranch(self, str name, bint only_new):
+
         checkKeyNotNone(name)
 
         if self._exists(name, False):
@@ -3056,13 +3935,14 @@ cdef class TreeDict(object):
     def __richcmp__(p1, p2, int t):
 
         cdef bint are_equal
+        cdef tuple locks
 
         if not isinstance(p1, TreeDict):
             if DEBUG_MODE:
                 assert isinstance(p2, TreeDict)
 
             if isinstance(p1, dict):
-                are_equal = (dict((<TreeDict>p2).iteritems()) == p1)
+                are_equal = ((<TreeDict>p2)._asLocalDict() == p1)
             else:
                 are_equal = False
 
@@ -3071,7 +3951,7 @@ cdef class TreeDict(object):
                 assert isinstance(p1, TreeDict)
 
             if isinstance(p2, dict):
-                are_equal = (dict((<TreeDict>p1).iteritems()) == p2)
+                are_equal = ((<TreeDict>p1)._asLocalDict() == p2)
             else:
                 are_equal = False
 
@@ -3079,7 +3959,13 @@ cdef class TreeDict(object):
             are_equal = False
 
         else:
-            are_equal = (<TreeDict>p1)._isEqual(<TreeDict>p2)
+            locks = (<TreeDict>p1)._lockReadWith(<TreeDict>p2)
+
+            try:
+                are_equal = (<TreeDict>p1)._isEqual(<TreeDict>p2)
+            finally:
+                _unlock(<_RWLock>locks[1], False)
+                _unlock(<_RWLock>locks[0], False)
 
         if t == 2:              # ==
             return are_equal
@@ -3088,13 +3974,83 @@ cdef class TreeDict(object):
         else:
             return False
 
+    cdef dict _asLocalDict(self):
+
+        cdef _RWLock lock = self._lockRead()
+
+        try:
+            return dict(self.iteritems())
+        finally:
+            _unlock(lock, False)
+
     cdef bint _isEqual(self, TreeDict p):
 
-        cdef size_t i
+        # Cheap tests first; frozen trees that differ in size are
+        # rejected before any of the values are compared.
+
+        if p is None:
+            return False
+
+        if self is p:
+            return True
+
+        cdef int known = self._cachedDigestsEqual(p)
+
+        if known != -1:
+            return known
+
+        if (self.isFrozen() and p.isFrozen()
+            and self._frozenEntryCount() != p._frozenEntryCount()):
+            return False
+
+        return self._isEqualNodes(p)
+
+    cdef size_t _frozenEntryCount(self) except? 0:
+
+        # The number of values and branches in a frozen tree, which is
+        # kept after it is first counted.  Counting an unfrozen tree
+        # each time would cost nearly as much as comparing it.
+
+        cdef TreeDict t = self._contentSource()
+        cdef size_t n
+
+        if s_n_entries_recursive in t._aux_dict:
+            return t._aux_dict[s_n_entries_recursive]
+
+        n = t._size(True, i_BranchMode_All)
+        t._aux_dict[s_n_entries_recursive] = n
+
+        return n
+
+    cdef int _cachedDigestsEqual(self, TreeDict p) except -2:
+        # 1 if the two subtrees are known to be equal, 0 if they are
+        # known to differ, and -1 if the values must be compared.
+        # Only digests that are already kept are used.
+
+        cdef TreeDict s1 = self._contentSource()
+        cdef TreeDict s2 = p._contentSource()
+
+        if s1 is s2:
+            return 1
+
+        if s_subtree_digest in s1._aux_dict and s_subtree_digest in s2._aux_dict:
+            return s1._aux_dict[s_subtree_digest] == s2._aux_dict[s_subtree_digest]
+
+        return -1
+
+    cdef bint _isEqualNodes(self, TreeDict p):
 
         if p is None:
             return False
 
+        if self is p:
+            return True
+
+        cdef int known = self._cachedDigestsEqual(p)
+
+        if known != -1:
+            return known
+
         # The tricky thing is that equality testing needs to ignore
         # any dangling nodes, as they don't really exist...
 
@@ -3106,6 +4062,9 @@ cdef class TreeDict(object):
         elif self_dng and other_dng:
             return True
 
+        self._load()
+        p._load()
+
         # Attempt reject based on other equality measures
         if (len(self._param_dict) - self._n_dangling
             != len(p._param_dict) - p._n_dangling):
@@ -3142,15 +4101,29 @@ cdef class TreeDict(object):
     # hash stuff
 
     def __hash__(self):
+
+        # A frozen tree that is hashable can never change again, so
+        # the hash is only computed once.
+        if _flagOn(&self._flags, f_py_hash_cached):
+            return self._py_hash
+
         if not self.isFrozen():
             raise TypeError("Only frozen trees are python hashable.")
 
-        if self.isMutable():
-            s = self._firstMutableType()
-            if s is not None:
-                raise TypeError("Node '%s' (and possibly more) not hashable." % s)
+        cdef _RWLock lock = self._lockWrite()
+
+        try:
+            if self.isMutable():
+                s = self._firstMutableType()
+                if s is not None:
+                    raise TypeError("Node '%s' (and possibly more) not hashable." % s)
+
+            self._py_hash = hash(self._self_immutable_hash())
+            _setFlagOn(&self._flags, f_py_hash_cached)
 
-        return hash(self._self_immutable_hash())
+            return self._py_hash
+        finally:
+            _unlock(lock, True)
 
     cdef str _firstMutableType(self):
         cdef _PTreeNode pn
@@ -3158,6 +4131,8 @@ cdef class TreeDict(object):
 
         # Mutable tests; if there are no mutable items, then go with
 
+        self._load()
+
         _param_dict_items = self._param_dict.iteritems() if IS_PYTHON2 else self._param_dict.items()
         for k, pn in _param_dict_items:
             if pn.isMutable() or (pn.isTree() and pn.tree().isMutable()):
@@ -3176,26 +4151,74 @@ cdef class TreeDict(object):
         mutable values, otherwise returns False.
         """
 
-        # Just like the previous version, but doesn't take as long
-        # cause it just does quick checks
-
         if not self.isFrozen():
             return True
 
-        if self._n_mutable != 0:
+        if self._recursiveMutableCount() != 0:
             return True
 
+        # Only TreeDict values can now make the tree mutable; unlike
+        # the branches, these may be changed or frozen later.
+        if not self._subtreeHasTreeValues():
+            return False
+
+        return self._treeValuesMutable()
+
+    cdef size_t _recursiveMutableCount(self) except? 0:
+
+        # The number of mutable values in this tree and all its
+        # branches.  A frozen tree never changes, so the count is kept
+        # on each branch after it is first found, and asking again
+        # takes constant time.
+
+        cdef TreeDict src
         cdef _PTreeNode pn
+        cdef size_t n
 
-        _param_dict_items = self._param_dict.iteritems() if IS_PYTHON2 else self._param_dict.items()
-        for k, pn in _param_dict_items:
-            if pn.isTree() and pn.tree().isMutable():
-                return True
+        if self._param_dict is None and s_cow_source in self._aux_dict:
+            src = <TreeDict>((<tuple>self._aux_dict[s_cow_source])[0])
+            return src._recursiveMutableCount()
+
+        self._load()
+
+        if s_n_mutable_recursive in self._aux_dict:
+            return self._aux_dict[s_n_mutable_recursive]
+
+        n = self._n_mutable
+
+        for pnv in (self._param_dict.itervalues() if IS_PYTHON2 else self._param_dict.values()):
+            pn = <_PTreeNode>pnv
+
+            if pn.isBranch():
+                n += pn.tree()._recursiveMutableCount()
+
+        if self.isFrozen():
+            self._aux_dict[s_n_mutable_recursive] = n
+
+        return n
+
+    cdef bint _treeValuesMutable(self) except -1:
+
+        cdef _PTreeNode pn
+
+        self._load()
+
+        for pnv in (self._param_dict.itervalues() if IS_PYTHON2 else self._param_dict.values()):
+            pn = <_PTreeNode>pnv
+
+            if pn.isNonBranchTree():
+                if pn.tree().isMutable():
+                    return True
+
+            elif pn.isBranch() and pn.tree()._subtreeHasTreeValues():
+                if pn.tree()._treeValuesMutable():
+                    return True
 
         return False
 
     def _numMutable(self):
         # For testing
+        self._load()
         return self._n_mutable
 
     ########################################
@@ -3258,6 +4281,10 @@ cdef class TreeDict(object):
             KeyError: 'root.nothere'
 
         """
+
+        # Hashing marks the nodes it visits, so it holds the write lock
+        cdef _RWLock lock = self._lockWrite()
+
         try:
             if add_name:
                 if key is not None:
@@ -3281,6 +4308,8 @@ cdef class TreeDict(object):
         except Exception, e:
             if DEBUG_MODE: raise
             else: raise e
+        finally:
+            _unlock(lock, True)
 
     cdef bytes _reportable_hash(self, str key, bytes digest):
         return <bytes>(key + "-") + digest
@@ -3357,6 +4386,11 @@ cdef class TreeDict(object):
         # This takes care of all the mutable items
         cdef _PTreeNode pn
         cdef list _param_dict_items
+        cdef TreeDict src = self._unchangedSource()
+
+        if src is not None:
+            src._runFullHash(hf)
+            return
 
         try:
             _setFlagOn(&self._flags, f_visited_by_hash_function)
@@ -3391,6 +4425,11 @@ cdef class TreeDict(object):
         cdef TreeDict b
         cdef _PTreeNode pn
         cdef list _param_dict_items
+        cdef TreeDict src = self._unchangedSource()
+
+        if src is not None:
+            src._runImmutableHash(hf)
+            return
 
         try:
             _setFlagOn(&self._flags, f_visited_by_im_hash_function)
@@ -3425,6 +4464,8 @@ cdef class TreeDict(object):
         if self.isDangling():
             raise TypeError("Dangling nodes not hashable.")
 
+        self._load()
+
         if s_immutable_items_hash not in self._aux_dict:
             h = md5()
             hf = getattr(h, 'update')
@@ -3545,818 +4586,3554 @@ cdef class TreeDict(object):
     ################################################################################
     # Methods for copying the tree
     def __copy__(self):
+        cdef _RWLock lock = self._lockWrite()
+
         try:
             return self._copy(False, False)
         except Exception, e:
             if DEBUG_MODE: raise
             else: raise e
+        finally:
+            _unlock(lock, True)
+
+    def __deepcopy__(self, memo = None):
+        cdef _RWLock lock = self._lockWrite()
 
-    def __deepcopy__(self, m={}):
         try:
-            return self._copy(True, False)
+            return self._copy(True, False, {} if memo is None else memo)
         except Exception, e:
             if DEBUG_MODE: raise
             else: raise e
+        finally:
+            _unlock(lock, True)
 
-    def copy(self, bint deep=False, bint freeze=False):
+    def copy(self, bint deep=False, bint freeze=False, bint copy_on_write=False, **kwargs):
         """
         Returns a copy of the current tree.  If `deep` is true, then
         all the values in the leaves are also copied, otherwise the
         entire tree structure is copied but not the values.  If
         `freeze` is true, then the returned tree is frozen.
-        """
 
-        try:
-            return self._copy(deep, freeze)
-        except Exception, e:
-            if DEBUG_MODE: raise
-            else: raise e
+        If `include` is given, it is a key or list of keys of values
+        or branches; only these are copied, as in :meth:`project`.
+        If `exclude` is given, the values and branches it names are
+        left out of the copy.  Both may be given, in which case the
+        excluded keys are removed from the included ones.
+
+        If `copy_on_write` is True, the copy is made lazily: it
+        returns immediately, and each branch of the copy builds its
+        own storage -- sharing the stored values with the original --
+        only when it is first accessed, or just before the
+        corresponding branch of the original is modified.  Branches
+        that are never touched are never copied.  The result behaves
+        exactly like a regular shallow copy.  This option cannot be
+        combined with `deep`.
 
-    def update(self, source, bint overwrite = True,
-               bint protect_structure = False):
+        Example::
+
+            >>> from treedict import TreeDict
+            >>> t = TreeDict() ; t.set('a.x', 1, 'b.y', 2)
+            >>> t2 = t.copy(copy_on_write = True)
+            >>> t2.a.x = 10
+            >>> t.a.x, t2.a.x
+            (1, 10)
+            >>> t.b.y = 20
+            >>> t2.b.y
+            2
         """
-        Copies all the branches and values from a source
-        branch/tree/dict `source` into the current branch.  Branch
-        structures are recreated in this node, with the new branches
-        reference this node as their parent.
 
-        If `source` is not of type dict or a TreeDict, it must be
-        convertable to a dictionary; if this fails, a TypeError is
-        raised.
+        # include is a reserved word in cython, so these come in
+        # through kwargs.
+        include_keys = kwargs.pop("include", None)
+        exclude_keys = kwargs.pop("exclude", None)
 
-        If `deepcopy` is True, then copies are made of all the values
-        held in the source tree, otherwise, only the tree structure
-        and references to the values are copied (default).
+        # Copying marks the nodes of this tree as it goes
+        cdef _RWLock lock = self._lockWrite()
 
-        If `overwrite_existing` is True (default), then conflicting
-        values in the local tree are overwritten by the corresponding
-        values in the source tree.  If `overwrite_existing` is False,
-        all local values already present are preserved.
+        try:
+            if kwargs:
+                raise TypeError("Unrecognized keyword arguments: " + ', '.join(kwargs.keys()))
 
-        If `protect_structure` is False (default = True), then values
-        can be implicitly overwritten by branches.  For example, if `b
-        = 1` is in the tree, then setting `b.x = 2` would overwrite b
-        with an implicitly created branch.  Normally, this operation
-        would raise a TypeError (for consistency with attribute style
-        setting).
+            if copy_on_write:
+                if deep:
+                    raise ValueError("Options deep and copy_on_write are mutually exclusive.")
 
-        Note: Unlike the update method of dict, this method may fail
-        and raise an exception.  This can occur either because one or
-        more of the keys in `d` is not a valid key name (only occurs
-        if `d` is a dict), or if all/part of the tree being updated is
-        frozen.  If this happens, no changes are made to the tree
-        (i.e, this method is atomic).
+                if include_keys is not None or exclude_keys is not None:
+                    raise ValueError("Options include/exclude cannot be used with copy_on_write.")
 
-        Example 1::
+                return self._lazyCopy(freeze)
 
-            >>> from treedict import TreeDict
-            >>> t = TreeDict()
-            >>> t.a.x = 1
-            >>> t.update({'a.y': 2, 'z' : 3})
-            >>> print t.makeReport()
-            a.x = 1
-            a.y = 2
-            z   = 3
-            >>>
+            elif include_keys is not None or exclude_keys is not None:
+                return self._selectiveCopy(
+                    None if include_keys is None else self._selectionTrie(include_keys),
+                    None if exclude_keys is None else self._selectionTrie(exclude_keys),
+                    deep, freeze)
+            else:
+                return self._copy(deep, freeze, {} if deep else None)
+        except Exception, e:
+            if DEBUG_MODE: raise
+            else: raise e
+        finally:
+            _unlock(lock, True)
 
-        Example 2::
+    def project(self, keys, bint deep = False):
+        """
+        Returns a copy of the tree holding only the values and
+        branches given by `keys`, which may be a single key or a list
+        of keys.  A key naming a branch includes everything under it.
+        The branches leading to the selected keys are kept, and all
+        the keys keep their setting order.  Only the selected parts of
+        the tree are visited, so the cost depends on the size of the
+        result rather than that of the tree.  If `deep` is True, the
+        selected values are copied as in ``copy(deep = True)``.
 
-            >>> from treedict import TreeDict
-            >>> t1 = TreeDict(x = 1, y = 2)
-            >>> t2 = TreeDict(y = 3, z = 4)
-            >>> t1.update(t2)
-            >>> print t1.makeReport()
-            y = 3
-            x = 1
-            z = 4
-            >>>
+        A KeyError is raised if any key is not present in the tree.
 
-        Example 3 -- No Overwrite::
+        Example::
 
             >>> from treedict import TreeDict
-            >>> t1 = TreeDict(x = 1, y = 2)
-            >>> t2 = TreeDict(y = 3, z = 4)
-            >>> t1.update(t2, overwrite=False)
-            >>> print t1.makeReport()
-            y = 2
-            x = 1
-            z = 4
+            >>> t = TreeDict() ; t.set('a.x', 1, 'a.y', 2, 'b.z', 3, c = 4)
+            >>> print t.project(['a.y', 'b']).makeReport()
+            a.y = 2
+            b.z = 3
+        """
 
-        Example 4 -- Protecting structure::
+        cdef _RWLock lock = self._lockWrite()
 
-            >>> t1, t2 = TreeDict('t1'), TreeDict('t2')
-            >>> t1.a.x = 1
-            >>> t2.a = 2
-            >>> t2.x = 3
-            >>>
-            >>> print t1.makeReport()
-            a.x = 1
-            >>>
-            >>> t1.update(t2, protect_structure = True)
+        try:
+            return self._selectiveCopy(self._selectionTrie(keys), None, deep, False)
+        except Exception, e:
+            if DEBUG_MODE: raise
+            else: raise e
+        finally:
+            _unlock(lock, True)
 
-            TypeError: Tree/Branch 't1.a' would get implicitly overwritten by value on merge; set protect_structure=False to allow overwriting.
+    def with_(self, key, value):
+        """
+        Returns a new, frozen version of the tree with `key` set to
+        `value`, leaving the current tree unchanged.  The new version
+        is built as a copy-on-write copy (see :meth:`copy`), so only
+        the branches on the path to `key` are copied; all other
+        branches are shared with the current tree until they are
+        accessed.  Chains of versions created this way are cheap to
+        keep, e.g. as a history of configurations.
+
+        This is most useful on frozen trees, as nothing then needs to
+        be tracked between the versions.  The hash of a version can be
+        computed without copying the branches it shares.
 
-            >>>
-            >>> print t1.makeReport()
-            a.x = 1
-            >>>
+        Example::
 
+            >>> from treedict import TreeDict
+            >>> t = TreeDict() ; t.set('a.x', 1, 'b.y', 2) ; t.freeze()
+            >>> t2 = t.with_('a.x', 10)
+            >>> t.a.x, t2.a.x
+            (1, 10)
+            >>> t2.isFrozen()
+            True
+            >>> t2.b.hash() == t.b.hash()
+            True
         """
 
-        cdef flagtype flags = ((0 if overwrite else f_no_overwrite)
-                               | (f_protect_structure
-                                  if protect_structure and overwrite
-                                  else 0))
-
         cdef TreeDict p
+        cdef _RWLock lock = self._lockWrite()
 
         try:
-            if isinstance(source, TreeDict):
-                self._update(<TreeDict>source, flags | f_check_only)
-                self._update(<TreeDict>source, flags | f_already_checked)
-
-            else:
-                p = newTreeDict(s_default_tree_name, False)
-                if isinstance(source, dict):
-                    p._setAll(None, <dict>source, 0)
-                else:
-                    p._setAll(None, dict(source), 0)
+            p = self._lazyCopy(False)
+            p._set(validateKey(key), value, 0)
+            p.freeze()
 
-                self._update(p, flags | f_check_only)
-                self._update(p, flags | f_already_checked)
+            return p
         except Exception, e:
             if DEBUG_MODE: raise
             else: raise e
+        finally:
+            _unlock(lock, True)
 
-    cdef _update(self, TreeDict t, flagtype flags):
+    def mapValues(self, func, executor = None, keys = None, size_t chunksize = 256):
+        """
+        Returns a copy of the tree in which every value `v` has been
+        replaced by ``func(v)``.  The branch structure and the order
+        in which keys were set are preserved.
+
+        If `keys` is given, it must be an iterable of keys giving the
+        values to transform; all other values are carried over
+        unchanged.  Each key must refer to a value in this tree (not
+        a branch), otherwise a KeyError is raised.
+
+        If `executor` is given, it must provide the ``submit()``
+        method of the executors in the :mod:`concurrent.futures`
+        module.  The values are then sent to the executor in chunks of
+        `chunksize` values each, so a thread or process pool can
+        transform them in parallel.  When a process pool is used,
+        `func` and the values must be picklable.
+
+        The new values are placed directly into the copied tree rather
+        than set key by key, so this is considerably faster than
+        setting each transformed value individually.
 
-        # Relevant Flags: f_check_only, f_already_checked,
-        if IS_PYTHON2:
-            for k, pn in t._param_dict.iteritems():
-                self._updateItem(<str>k, <_PTreeNode>pn, t, flags)
-        else:
-            for k, pn in t._param_dict.items():
-                self._updateItem(<str>k, <_PTreeNode>pn, t, flags)
-
-    cdef _updateItem(self, str k, _PTreeNode pn, TreeDict t, flagtype flags):
+        Example::
 
-        cdef _PTreeNode lpn
+            >>> from treedict import TreeDict
+            >>> t = TreeDict() ; t.set('b.x', 1, 'b.c.y', 2, x = 3)
+            >>> print t.mapValues(lambda v: 10*v).makeReport()
+            b.x   = 10
+            b.c.y = 20
+            x     = 30
+            >>> print t.mapValues(str, keys = ['x']).makeReport()
+            b.x   = 1
+            b.c.y = 2
+            x     = '3'
 
-        if pn.isTree():
+        """
 
-            if pn.isDanglingBranch():
-                return
+        cdef TreeDict p
+        cdef list nodes = [], names = [], pns = [], values, results
+        cdef size_t i
 
-            lpn = self._getLocalPTNode(k)
+        if chunksize == 0:
+            raise ValueError("`chunksize` must be positive.")
 
-            if lpn is None:
-                if pn.isBranch():
-                    self._attach(k, pn.tree(), f_copy | flags)
-                else:
-                    self._setLocal(k, pn.tree(), flags)
+        cdef _RWLock lock = self._lockWrite()
 
-            elif lpn.isTree():
-                lpn.tree()._update(pn.tree(), flags)
+        try:
+            p = self._copy(False, False)
 
-            elif (flags & f_no_overwrite):
-                return
+            if keys is None:
+                p._collectLeaves(nodes, names, pns)
+            else:
+                seen = set()
+                for k in keys:
+                    if k not in seen:
+                        seen.add(k)
+                        p._collectLeaf(validateKey(k), nodes, names, pns)
 
-            elif not (flags & f_protect_structure):
-                self._attach(k, pn.tree(), f_copy | flags)
+            values = [(<_PTreeNode>pn)._v for pn in pns]
 
+            if executor is None:
+                results = [func(v) for v in values]
             else:
-                raise TypeError(
-                    ("Value '%s' would get implicitly overwritten by branch on merge; "
-                     % self._fullNameOf(k))
-                    + "set protect_structure=False to allow overwriting.")
-        else:
+                futures = [executor.submit(_mapChunk, func, values[i:i+chunksize])
+                           for i in range(0, len(values), chunksize)]
 
-            if (flags & f_protect_structure) and not (flags & f_already_checked):
+                results = []
+                for f in futures:
+                    results.extend(f.result())
 
-                lpn = self._getLocalPTNode(k)
+                if len(results) != len(values):
+                    raise RuntimeError("Executor returned the wrong number of values.")
 
-                if lpn is not None and lpn.isTree():
-                    raise TypeError(
-                        ("Tree/Branch '%s' would get implicitly overwritten by value on merge; "
-                         % self._fullNameOf(k))
-                        + "set protect_structure=False to allow overwriting.")
-
-            self._setLocal(k, pn.value(), flags)
+            for 0 <= i < len(pns):
+                (<TreeDict>nodes[i])._replaceValue(
+                    <str>names[i], <_PTreeNode>pns[i], results[i])
 
+            return p
 
+        except Exception, e:
+            if DEBUG_MODE: raise
+            else: raise e
+        finally:
+            _unlock(lock, True)
 
-    cdef TreeDict _copy(self, bint deep, bint frozen):
-        # Wraps the recursive function _recursiveCopy() that
+    cdef _collectLeaves(self, list nodes, list names, list pns):
+        cdef PyObject *k_obj = NULL
+        cdef PyObject *pn_obj = NULL
+        cdef Py_ssize_t pos = 0
+        cdef _PTreeNode pn
 
-        if self.isDangling():
-            self._raiseErrorAtFirstNonDanglingBranch(True)
+        self._load()
 
-        cdef TreeDict p
-        cdef str tn, bn, newbn
+        while PyDict_Next(self._param_dict, &pos, &k_obj, &pn_obj):
+            pn = <_PTreeNode>pn_obj
 
-        p = self._recursiveCopy(deep)
+            if pn.isBranch():
+                if not pn.isDanglingBranch():
+                    pn.tree()._collectLeaves(nodes, names, pns)
+            else:
+                nodes.append(self)
+                names.append(<str>k_obj)
+                pns.append(pn)
 
-        if frozen:
-            p.freeze()
+    cdef _collectLeaf(self, str key, list nodes, list names, list pns):
+        cdef int pos = strrfind(key, '.')
+        cdef TreeDict b = self
+        cdef _PTreeNode pn
+        cdef str name
 
-        self._clearHasBeenCopiedFlags()
+        if pos != -1:
+            pn = self._getPTNode(key[:pos])
 
-        return p
+            if pn is None or not pn.isBranch() or pn.isDanglingBranch():
+                raise KeyError(repr(self._fullNameOf(key)))
 
-    cdef _clearHasBeenCopiedFlags(self):
+            b = pn.tree()
+            name = key[pos+1:]
+        else:
+            name = key
 
-        cdef _PTreeNode pn
+        pn = b._getLocalPTNode(name)
 
-        if self.hasBeenCopied():
-            del self._aux_dict[s_copied_node]
+        if pn is None or pn.isBranch():
+            raise KeyError(repr(self._fullNameOf(key)))
 
-            self._setHasBeenCopiedFlag(False)
+        nodes.append(b)
+        names.append(name)
+        pns.append(pn)
 
-            for pnv in self._param_dict.values() if IS_PYTHON2 else list(self._param_dict.values()):
-                pn = <_PTreeNode>pnv
+    cdef _replaceValue(self, str k, _PTreeNode pn, v):
+        # Swaps in a new value at the same order position, bypassing
+        # the name and structure checks of _setLocal.
 
-                if pn.isTree():
-                    pn.tree()._clearHasBeenCopiedFlags()
+        cdef _PTreeNode new_pn = newPTreeNode(self, k, v, pn._order_position)
 
-        if self.isCopyReferenced():
-            self._setCopyReferencedFlag(False)
-            del self._aux_dict[s_copy_referencing_keys]
+        self._keyDeleted(k, pn)
+        self._param_dict[k] = new_pn
+        self._keyInserted(k, new_pn)
 
-    cdef TreeDict _recursiveCopy(self, bint deep):
-        # The recursive version of the above;
+    ################################################################################
+    # Differences between trees
 
-        if not deep:
-            if DEBUG_MODE:
-                assert not self.hasBeenCopied()
-        else:
-            if self.hasBeenCopied():
-                return self._aux_dict[s_copied_node]
+    def diff(self, TreeDict other):
+        """
+        Returns the differences between this tree and `other` as a
+        dict with the entries ``'added'``, ``'removed'`` and
+        ``'changed'``.  ``'added'`` maps the keys present only in
+        `other` to their values, ``'removed'`` maps the keys present
+        only in this tree to their values, and ``'changed'`` maps the
+        keys present in both with different values to ``(old, new)``
+        tuples.  Keys are given relative to the current node, and only
+        values are compared; branches appear through the values they
+        hold.
+
+        Parts of the two trees that are known to be identical are
+        skipped without looking at their values; this includes
+        branches shared between copy-on-write copies (see
+        :meth:`copy` and :meth:`with_`), frozen branches with equal
+        hashes, and the immutable values of each branch, which are
+        compared through their cached hash.  Thus diffing two nearly
+        identical trees takes time roughly proportional to the number
+        of changes.
+
+        The result can be passed to :meth:`applyPatch`.
 
-        cdef TreeDict p = newTreeDict(self._name, False)
-        cdef _PTreeNode pn, new_pn
+        Example::
 
-        assert p._name == self._name
+            >>> from treedict import TreeDict
+            >>> t1 = TreeDict() ; t1.set('a.x', 1, 'a.y', 2, b = 3)
+            >>> t2 = t1.copy() ; t2.a.y = 20 ; t2.c = 4 ; del t2.b
+            >>> t1.diff(t2)
+            {'added': {'c': 4}, 'removed': {'b': 3}, 'changed': {'a.y': (2, 20)}}
+        """
 
-        # In copying, the tree doesn't preserve parental relation.
+        cdef dict added = {}, removed = {}, changed = {}
+        cdef tuple locks = self._lockReadWith(other)
 
-        p._clearParent()
-        p._param_dict = {}
+        try:
+            self._diffInto(other, "", added, removed, changed)
 
-        p._flags = self._flags & f_copybranch_propegating_flags
+            return {"added" : added, "removed" : removed, "changed" : changed}
+        except Exception, e:
+            if DEBUG_MODE: raise
+            else: raise e
+        finally:
+            _unlock(<_RWLock>locks[1], False)
+            _unlock(<_RWLock>locks[0], False)
 
-        p._n_dangling = 0
-        p._n_mutable = 0
-        p._next_item_order_position = self._next_item_order_position
+    def applyPatch(self, dict patch):
+        """
+        Applies a patch as returned by :meth:`diff` to the current
+        tree, so that ``t1.applyPatch(t1.diff(t2))`` makes `t1` hold
+        the same values as `t2`.  The removed keys are deleted first,
+        along with any branches this leaves empty, then the changed
+        and added values are set.
 
-        for k, pn in self._param_dict.items():
+        A KeyError is raised, before anything is changed, if any of
+        the removed keys is not in the tree.
 
-            if pn.isDanglingBranch():
-                continue
+        Example::
 
-            new_pn = self._copyValue(p, k, pn, deep)
+            >>> from treedict import TreeDict
+            >>> t1 = TreeDict() ; t1.set('a.x', 1, 'a.y', 2, b = 3)
+            >>> t2 = t1.copy() ; t2.a.y = 20 ; t2.c = 4 ; del t2.b
+            >>> t1.applyPatch(t1.diff(t2))
+            >>> t1 == t2
+            True
+        """
 
-            p._param_dict[k] = new_pn
-            p._keyInserted(k, new_pn)
+        cdef list removed
+        cdef _RWLock lock = self._lockWrite()
 
-        p._reset_branches()
+        try:
+            removed = [validateKey(k) for k in patch.get("removed", ())]
 
-        self._aux_dict[s_copied_node] = p
-        self._setHasBeenCopiedFlag(True)
+            for k in removed:
+                if self._getPTNode(k) is None:
+                    raise KeyError(repr(self._fullNameOf(k)))
 
-        if self.isCopyReferenced():
-            # Now have to go through and update keys in trees that
-            # previously reference this one
-            for t, k in (<list>self._aux_dict[s_copy_referencing_keys]):
+            for k in removed:
+                self._prune(k, True)
 
-                if DEBUG_MODE:
-                    assert isinstance(t, TreeDict)
-                    assert isinstance(k, str)
+            for k, (old, v) in patch.get("changed", {}).items():
+                self._set(validateKey(k), v, 0)
 
-                (<TreeDict>t)._setLocal(k, p, f_already_checked)
+            for k, v in patch.get("added", {}).items():
+                self._set(validateKey(k), v, 0)
 
-            del self._aux_dict[s_copy_referencing_keys]
-            self._setCopyReferencedFlag(False)
+        except Exception, e:
+            if DEBUG_MODE: raise
+            else: raise e
+        finally:
+            _unlock(lock, True)
 
-        return p
+    cdef _diffInto(self, TreeDict other, str prefix,
+                   dict added, dict removed, dict changed):
 
+        if self._knownEqual(other):
+            return
 
-    cdef _copyValue(self, TreeDict parent, str key, _PTreeNode pn, bint deep):
+        self._load()
+        other._load()
 
-        cdef TreeDict p
+        cdef bint skip_immutable
+        cdef _PTreeNode pn1, pn2
+        cdef str k
 
-        if pn.isBranch() and pn.tree()._parent() is self and pn.tree()._name == key:
+        # If the immutable values hash the same, they are all equal.
+        try:
+            skip_immutable = (self._getImmutableItemsHash()
+                              == other._getImmutableItemsHash())
+        except HashError:
+            skip_immutable = False
 
-            # print "Here; key = %s; tree id = %s" % (key, id(pn.tree()))
+        for k, pn1 in (self._param_dict.iteritems() if IS_PYTHON2 else self._param_dict.items()):
 
-            p = pn.tree()._recursiveCopy(deep)
-            p._setParent(parent)
+            if pn1.isDanglingTree():
+                continue
 
-            return newPTreeNodeExact(p, pn.type(), pn.orderPosition())
+            pn2 = other._param_dict.get(k)
 
-        elif deep:
-            return newPTreeNodeExact(
-                deepcopy_f(pn.value()),
-                pn.type(), pn.orderPosition())
+            if pn2 is None or pn2.isDanglingTree():
+                _diffCollect(pn1, prefix + k, removed)
 
-        elif pn.isTree():
+            elif pn1.isBranch() and pn2.isBranch():
+                pn1.tree()._diffInto(pn2.tree(), prefix + k + ".",
+                                     added, removed, changed)
 
-            p = pn.tree()
+            elif pn1.isBranch() or pn2.isBranch():
+                _diffCollect(pn1, prefix + k, removed)
+                _diffCollect(pn2, prefix + k, added)
 
-            if p.hasBeenCopied():
-                return newPTreeNodeExact(<TreeDict>(p._aux_dict[s_copied_node]),
-                                         pn.type(), pn.orderPosition())
-            else:
-                p._setCopyReferencedFlag(True)
+            elif skip_immutable and pn1.isImmutable():
+                continue
 
-                if s_copy_referencing_keys in p._aux_dict:
-                    (<list>p._aux_dict[s_copy_referencing_keys]).append( (parent, key) )
-                else:
-                    p._aux_dict[s_copy_referencing_keys] = [ (parent, key) ]
+            elif not pn1.isEqual(pn2):
+                changed[prefix + k] = (pn1.value(), pn2.value())
 
-                return newPTreeNodeExact(pn.value(), pn.type(), pn.orderPosition())
+        for k, pn2 in (other._param_dict.iteritems() if IS_PYTHON2 else other._param_dict.items()):
 
-        else:
-            return newPTreeNodeExact(pn.value(), pn.type(), pn.orderPosition())
+            if pn2.isDanglingTree():
+                continue
 
+            pn1 = self._param_dict.get(k)
 
-    cdef _reset_branches(self):
-        self._branches = [(<_PTreeNode> pn).value() for pn in self._param_dict.values()
-                          if (<_PTreeNode> pn).isBranch()]
+            if pn1 is None or pn1.isDanglingTree():
+                _diffCollect(pn2, prefix + k, added)
 
-    ################################################################################
-    # Methods relating to pickling / unpickling
+    cdef bint _knownEqual(self, TreeDict other) except -1:
+        # True if the two subtrees are known to hold the same values
+        # without comparing them.
 
-    def __reduce__(self):
+        if self is other or self._contentSource() is other._contentSource():
+            return True
 
-        # Need to check for weak references in
-        # _param_dict[s_dangling_reference_queue].  This handles a
-        # corner case that shouldn't really be that important.
+        cdef bytes d1 = self._frozenDigest()
 
-        cdef dict d = <dict>(self._aux_dict.copy())
-        cdef flagtype flags = self._flags
+        if d1 is None:
+            return False
 
-        if s_dangling_reference_queue in d:
-            d[s_dangling_reference_queue] = []
+        return d1 == other._frozenDigest()
 
-        ########################################
-        # Clear other irrelevant flags
-        _setFlagOff(&flags, f_one_iterators_referencing)
-        _setFlagOff(&flags, f_many_iterators_referencing)
-        _setFlagOff(&flags, f_is_registered)
+    cdef TreeDict _contentSource(self):
+        # An unloaded copy-on-write node holds the same values as its
+        # source.
 
-        # Clear iterator referencing
-        if s_IterReferenceCount in d:
-            del d[s_IterReferenceCount]
+        cdef TreeDict t = self
 
-        if s_registration_tree_name in d:
-            del d[s_registration_tree_name]
+        while t._param_dict is None and s_cow_source in t._aux_dict:
+            t = <TreeDict>((<tuple>t._aux_dict[s_cow_source])[0])
 
-        if s_registration_branch_name in d:
-            del d[s_registration_branch_name]
+        return t
 
-        return (_TreeDict_unpickler,
-                (self._name, self._param_dict, flags, d,
-                 self._n_mutable, self._next_item_order_position, self._n_dangling) )
+    cdef bytes _frozenDigest(self):
+        # Digest of a frozen subtree holding no mutable values, built
+        # from the digests of its branches; such a subtree never
+        # changes, so the digest is kept.  Returns None for any other
+        # subtree.
 
+        cdef TreeDict t = self._contentSource()
+        cdef _PTreeNode pn
+        cdef bytes d
 
-    ################################################################################
-    # Methods relating to size and the like
+        if s_subtree_digest in t._aux_dict:
+            return <bytes>t._aux_dict[s_subtree_digest]
 
-    def __len__(self):
-        return self._size(True, i_BranchMode_None)
+        if t.isDangling() or not t.isFrozen():
+            return None
 
-    def size(self, bint recursive = True, str branch_mode = 'none'):
-        """
-        Returns a count of values in the tree.  If recursive is True,
-        then it counts all nodes in this branch and in all subtrees,
-        according to the branch_mode policy.
+        t._load()
 
-        If branch_mode is 'none' (default), only the values are counted.
+        if t._n_mutable != 0:
+            return None
 
-        If branch_mode is 'all', all nodes and all values in the current
-        tree are counted.
+        h = md5()
+        hf = getattr(h, 'update')
 
-        If branch_mode is 'only', only the branches are counted.
+        try:
+            hf(t._getImmutableItemsHash())
+        except HashError:
+            return None
 
-        Example::
+        for k, pn in (sorted(t._param_dict.iteritems()) if IS_PYTHON2
+                      else sorted(t._param_dict.items())):
 
-            >>> from treedict import TreeDict
-            >>> t = TreeDict() ; t.set('b.x', 1, 'b.c.y', 2, x = 1)
-            >>> print t.makeReport()
-            b.x   = 1
-            b.c.y = 2
-            x     = 1
-            >>> t.size()
-            3
-            >>> t.size(recursive=False)
-            1
-            >>> t.size(recursive=False, branch_mode='none')
-            1
-            >>> t.size(recursive=False, branch_mode='only')
-            1
-            >>> t.size(recursive=False, branch_mode='all')
-            2
-            >>> t.size(recursive=True, branch_mode='only')
-            2
-            >>> t.size(recursive=True, branch_mode='all')
-            5
+            if pn.isImmutable() or pn.isDanglingTree():
+                continue
 
-        """
+            d = pn.tree()._frozenDigest()
 
-        return self._size(recursive, self._getBranchMode(branch_mode))
+            if d is None:
+                return None
 
-    cdef size_t _local_size(self, int branch_mode):
-        if branch_mode == i_BranchMode_Only:
-            return len(self._branches) - self._n_dangling
-        elif branch_mode == i_BranchMode_All:
-            return len(self._param_dict) - self._n_dangling
-        elif branch_mode == i_BranchMode_None:
-            return len(self._param_dict) - len(self._branches)
+            t._update_hash_with_key(hf, k)
+            t._update_hash_with_context(hf, pn)
+            hf(d)
 
-    cdef size_t _size(self, bint recursive, int branch_mode):
+        d = h.digest()
+        t._aux_dict[s_subtree_digest] = d
 
-        cdef size_t n
-        cdef TreeDict b
+        return d
 
-        if recursive:
-            n = self._local_size(branch_mode)
+    def update(self, source, bint overwrite = True,
+               bint protect_structure = False):
+        """
+        Copies all the branches and values from a source
+        branch/tree/dict `source` into the current branch.  Branch
+        structures are recreated in this node, with the new branches
+        reference this node as their parent.
 
-            for b in self._branches:
-                if not b.isDangling():
-                    n += b._size(recursive, branch_mode)
+        If `source` is not of type dict or a TreeDict, it must be
+        convertable to a dictionary; if this fails, a TypeError is
+        raised.
 
-            return n
-        else:
-            return self._local_size(branch_mode)
+        If `deepcopy` is True, then copies are made of all the values
+        held in the source tree, otherwise, only the tree structure
+        and references to the values are copied (default).
 
+        If `overwrite_existing` is True (default), then conflicting
+        values in the local tree are overwritten by the corresponding
+        values in the source tree.  If `overwrite_existing` is False,
+        all local values already present are preserved.
 
-    ################################################################################
-    # Methods relating to iterating over values
+        If `protect_structure` is False (default = True), then values
+        can be implicitly overwritten by branches.  For example, if `b
+        = 1` is in the tree, then setting `b.x = 2` would overwrite b
+        with an implicitly created branch.  Normally, this operation
+        would raise a TypeError (for consistency with attribute style
+        setting).
 
-    cdef _getBranchMode(self, branch_mode):
-        # This function returns an object so it can raise exceptions;
-        # it gets converted later anyway.
+        Note: Unlike the update method of dict, this method may fail
+        and raise an exception.  This can occur either because one or
+        more of the keys in `d` is not a valid key name (only occurs
+        if `d` is a dict), or if all/part of the tree being updated is
+        frozen.  If this happens, no changes are made to the tree
+        (i.e, this method is atomic).
 
-        if branch_mode is None:
-            return i_BranchMode_None
+        Example 1::
 
-        if not isinstance(branch_mode, str):
-            raise TypeError(_branch_mode_error_msg)
+            >>> from treedict import TreeDict
+            >>> t = TreeDict()
+            >>> t.a.x = 1
+            >>> t.update({'a.y': 2, 'z' : 3})
+            >>> print t.makeReport()
+            a.x = 1
+            a.y = 2
+            z   = 3
+            >>>
 
-        try:
-            return _branch_mode_lookup[strlower(branch_mode)]
-        except KeyError:
-            raise TypeError(_branch_mode_error_msg)
+        Example 2::
 
-    cdef TreeDictIterator _getIter(self, bint recursive, int branch_mode, int valuetype):
-        return newTreeDictIterator(self, recursive, branch_mode, valuetype)
+            >>> from treedict import TreeDict
+            >>> t1 = TreeDict(x = 1, y = 2)
+            >>> t2 = TreeDict(y = 3, z = 4)
+            >>> t1.update(t2)
+            >>> print t1.makeReport()
+            y = 3
+            x = 1
+            z = 4
+            >>>
 
-    cpdef TreeDictIterator iteritems(self, bint recursive = True, branch_mode = 'none'):
-        """
-        Returns an iterator that returns (key, value) pairs.  If
-        recursive is True, then it iterates through all nodes in this
-        branch and in all subtrees.  Keys are returned with their full
-        path names, e.g. 'foo.bar'.
+        Example 3 -- No Overwrite::
 
-        If branch_mode is 'none' (default), the branches are ignored
-        and all the items associated with values are returned.
+            >>> from treedict import TreeDict
+            >>> t1 = TreeDict(x = 1, y = 2)
+            >>> t2 = TreeDict(y = 3, z = 4)
+            >>> t1.update(t2, overwrite=False)
+            >>> print t1.makeReport()
+            y = 2
+            x = 1
+            z = 4
 
-        If branch_mode is 'all', all items in the current tree
-        are returned.
+        Example 4 -- Protecting structure::
 
-        If branch_mode is 'only', then only the branches are returned.
+            >>> t1, t2 = TreeDict('t1'), TreeDict('t2')
+            >>> t1.a.x = 1
+            >>> t2.a = 2
+            >>> t2.x = 3
+            >>>
+            >>> print t1.makeReport()
+            a.x = 1
+            >>>
+            >>> t1.update(t2, protect_structure = True)
 
-        Example::
+            TypeError: Tree/Branch 't1.a' would get implicitly overwritten by value on merge; set protect_structure=False to allow overwriting.
 
-            >>> from treedict import TreeDict
-            >>> t = TreeDict() ; t.set('b.x', 1, 'b.c.y', 2, x = 1)
-            >>> print t.makeReport()
-            b.x   = 1
-            b.c.y = 2
-            x     = 1
-            >>> list(t.iteritems())
-            [('x', 1), ('b.x', 1), ('b.c.y', 2)]
-            >>> list(t.iteritems(recursive=False))
-            [('x', 1)]
-            >>> list(t.iteritems(recursive=False, branch_mode='none'))
-            [('x', 1)]
-            >>> list(t.iteritems(recursive=False, branch_mode='only'))
-            [('b', TreeDict <root.b>)]
-            >>> list(t.iteritems(recursive=False, branch_mode='all'))
-            [('x', 1), ('b', TreeDict <root.b>)]
-            >>> list(t.iteritems(recursive=True, branch_mode='only'))
-            [('b', TreeDict <root.b>), ('b.c', TreeDict <root.b.c>)]
-            >>> list(t.iteritems(recursive=True, branch_mode='all'))
-            [('x', 1), ('b', TreeDict <root.b>), ('b.x', 1), ('b.c', TreeDict <root.b.c>), ('b.c.y', 2)]
+            >>>
+            >>> print t1.makeReport()
+            a.x = 1
+            >>>
 
         """
 
-        return self._getIter(recursive, self._getBranchMode(branch_mode), i_Items)
+        cdef flagtype flags = ((0 if overwrite else f_no_overwrite)
+                               | (f_protect_structure
+                                  if protect_structure and overwrite
+                                  else 0))
 
-    cpdef TreeDictIterator itervalues(self, bint recursive = True, branch_mode = 'none'):
-        """
-        Returns an iterator that returns values in the tree.  If
-        recursive is True, then it iterates through all nodes in this
-        branch and in all subtrees.
+        # Every change is recorded in an undo log as it is made; if
+        # any part fails, the log is replayed backwards, so either all
+        # of source is merged or nothing is.
+        cdef list undo = []
+        cdef _RWLock lock = self._lockWrite()
 
-        If branch_mode is 'none' (default), the branches are ignored
-        and all the items associated with values are returned.
+        try:
+            try:
+                if isinstance(source, TreeDict):
+                    self._update(<TreeDict>source, flags, undo)
+                elif isinstance(source, dict):
+                    self._updateFromDict(<dict>source, flags, undo)
+                else:
+                    self._updateFromDict(dict(source), flags, undo)
+            except:
+                _rollbackUpdate(undo)
+                raise
+        except Exception, e:
+            if DEBUG_MODE: raise
+            else: raise e
+        finally:
+            _unlock(lock, True)
 
-        If branch_mode is 'all', all items in the current tree
-        are returned.
+    cdef _update(self, TreeDict t, flagtype flags, list undo):
 
-        If branch_mode is 'only', then only the branches are returned.
+        t._load()
 
-        Example::
+        if IS_PYTHON2:
+            for k, pn in t._param_dict.iteritems():
+                self._updateItem(<str>k, <_PTreeNode>pn, flags, undo)
+        else:
+            for k, pn in t._param_dict.items():
+                self._updateItem(<str>k, <_PTreeNode>pn, flags, undo)
 
-            >>> from treedict import TreeDict
-            >>> t = TreeDict() ; t.set('b.x', 1, 'b.c.y', 2, x = 1)
-            >>> print t.makeReport()
-            b.x   = 1
-            b.c.y = 2
-            x     = 1
-            >>> list(t.itervalues())
-            [1, 1, 2]
-            >>> list(t.itervalues(recursive=False))
-            [1]
-            >>> list(t.itervalues(recursive=False, branch_mode='none'))
-            [1]
-            >>> list(t.itervalues(recursive=False, branch_mode='only'))
-            [TreeDict <root.b>]
-            >>> list(t.itervalues(recursive=False, branch_mode='all'))
-            [1, TreeDict <root.b>]
-            >>> list(t.itervalues(recursive=True, branch_mode='only'))
-            [TreeDict <root.b>, TreeDict <root.b.c>]
-            >>> list(t.itervalues(recursive=True, branch_mode='all'))
-            [1, TreeDict <root.b>, 1, TreeDict <root.b.c>, 2]
+    cdef _updateItem(self, str k, _PTreeNode pn, flagtype flags, list undo):
 
-        """
+        if pn.isTree():
+            if not pn.isDanglingBranch():
+                self._updateTree(k, pn.tree(), pn.isBranch(), flags, undo)
+        else:
+            self._updateValue(k, pn.value(), flags, undo)
 
-        return self._getIter(recursive, self._getBranchMode(branch_mode), i_Values)
+    cdef _updateTree(self, str k, TreeDict tree, bint is_branch, flagtype flags, list undo):
 
-    def __iter__(self):
-        return self.iterkeys()
+        cdef _PTreeNode lpn = self._getLocalPTNode(k)
 
-    cpdef TreeDictIterator iterkeys(self, bint recursive = True, branch_mode = 'none'):
-        """
-        Returns an iterator that returns keys for nodes in the tree.
-        If recursive is True, then it iterates through all nodes in
-        this branch and in all subtrees.  Keys are returned with their
-        full path names, e.g. 'foo.bar'.
+        if lpn is None:
+            if is_branch:
+                self._loggedAttach(k, tree, flags, undo)
+            else:
+                self._loggedSetLocal(k, tree, flags, lpn, undo)
 
-        If branch_mode is 'none' (default), the branches are ignored
-        and all the items associated with values are returned.
+        elif lpn.isTree():
+            lpn.tree()._update(tree, flags, undo)
 
-        If branch_mode is 'all', all items in the current tree
-        are returned.
+        elif (flags & f_no_overwrite):
+            return
 
-        If branch_mode is 'only', then only the branches are returned.
+        elif not (flags & f_protect_structure):
+            self._loggedAttach(k, tree, flags, undo)
 
-        Example::
+        else:
+            raise TypeError(
+                ("Value '%s' would get implicitly overwritten by branch on merge; "
+                 % self._fullNameOf(k))
+                + "set protect_structure=False to allow overwriting.")
 
-            >>> from treedict import TreeDict
-            >>> t = TreeDict() ; t.set('b.x', 1, 'b.c.y', 2, x = 1)
-            >>> print t.makeReport()
-            b.x   = 1
-            b.c.y = 2
-            x     = 1
-            >>> list(t.iterkeys())
-            ['x', 'b.x', 'b.c.y']
-            >>> list(t.iterkeys(recursive=False))
-            ['x']
-            >>> list(t.iterkeys(recursive=False, branch_mode='none'))
-            ['x']
-            >>> list(t.iterkeys(recursive=False, branch_mode='only'))
-            ['b']
-            >>> list(t.iterkeys(recursive=False, branch_mode='all'))
-            ['x', 'b']
-            >>> list(t.iterkeys(recursive=True, branch_mode='only'))
-            ['b', 'b.c']
-            >>> list(t.iterkeys(recursive=True, branch_mode='all'))
-            ['x', 'b', 'b.x', 'b.c', 'b.c.y']
+    cdef _updateValue(self, str k, v, flagtype flags, list undo):
 
-        """
+        cdef _PTreeNode lpn = self._getLocalPTNode(k)
 
-        return self._getIter(recursive, self._getBranchMode(branch_mode), i_Keys)
+        if (flags & f_protect_structure) and lpn is not None and lpn.isTree():
+            raise TypeError(
+                ("Tree/Branch '%s' would get implicitly overwritten by value on merge; "
+                 % self._fullNameOf(k))
+                + "set protect_structure=False to allow overwriting.")
 
-    cpdef TreeDictIterator iterbranches(self):
-        """
-        A convenience function; iterates through all of the local
-        branches.  Equivalent to itervalues(recursive=False,
-        branch_mode='only').
+        self._loggedSetLocal(k, v, flags, lpn, undo)
 
-        Example::
+    cdef _updateFromDict(self, dict d, flagtype flags, list undo):
 
-            >>> from treedict import TreeDict
-            >>> t = TreeDict()
-            >>> t.set('a.b', 1, 'b.c', 2, x = 1, y = 2)
-            >>> print t.makeReport()
-            a.b = 1
-            b.c = 2
-            y   = 2
-            x   = 1
-            >>> list(t.iterbranches())
-            [TreeDict <root.a>, TreeDict <root.b>]
+        # The keys are first resolved in order, as setting them one
+        # by one in a new tree would, so later keys replace what
+        # earlier ones set under the same name; the result is then
+        # merged as a tree would be.
+        self._updateFromBranch(_resolveUpdateDict(d), flags, undo)
 
-        """
+    cdef _updateFromBranch(self, dict branch, flagtype flags, list undo):
 
-        return self._getIter(False, self._getBranchMode('only'), i_Values)
+        cdef str name
+        cdef _PTreeNode lpn
 
-    cdef list _getListFromIter(self, TreeDictIterator pti):
-        cdef bint recursive = pti._recursive
-        cdef int branch_mode = pti._branch_mode
+        for k, v in (branch.iteritems() if IS_PYTHON2 else branch.items()):
+            name = <str>k
 
-        cdef size_t n = self._size(recursive, branch_mode)
+            if type(v) is not _UpdateBranch:
+                if isinstance(v, TreeDict):
+                    self._updateTree(name, <TreeDict>v, False, flags, undo)
+                else:
+                    self._updateValue(name, v, flags, undo)
 
-        cdef list l = [None]*n
-        cdef size_t i
-        cdef bint r
+                continue
 
-        for 0 <= i < n:
+            lpn = self._getLocalPTNode(name)
 
-            r = pti._loadNext()
+            if lpn is not None and lpn.isTree():
+                lpn.tree()._updateFromBranch(<dict>v, flags, undo)
+            elif lpn is None or not (flags & f_no_overwrite):
+                self._updateTree(name, _treeFromUpdateBranch(name, <dict>v), True, flags, undo)
 
-            if DEBUG_MODE:
-                assert r
+    ########################################
+    # The undo log of update().  Entries are either (node, key,
+    # replaced node or None, next order position) for a local set, or
+    # (node, was detached, dangling reference queue) for a dangling
+    # node that became attached.
 
-            v = pti._currentRetValue()
+    cdef _loggedSetLocal(self, str k, v, flagtype flags, _PTreeNode lpn, list undo):
 
-            # Because we're using a temporary, and PyList_SetItem
-            # steals the reference, i.e. assumes it owns it now,
-            # we have to incref
-            l[i] = v
+        cdef size_t next_pos = self._next_item_order_position
 
-        if DEBUG_MODE:
-            assert not pti._loadNext()
+        if self.isDangling():
+            self._logDangling(undo)
 
-        return l
+        self._setLocal(k, v, flags)
 
-    def items(self, bint recursive = True, branch_mode = 'none'):
-        """
-        Identical to :meth:`iteritems()`, but returns a list instead
-        of an iterator.
-        """
+        undo.append( (self, k, lpn, next_pos) )
 
-        return self._getListFromIter(self.iteritems(recursive, branch_mode))
+    cdef _loggedAttach(self, str k, TreeDict tree, flagtype flags, list undo):
 
-    def values(self, bint recursive = True, branch_mode = 'none'):
-        """
-        Identical to :meth:`itervalues()`, but returns a list instead
-        of an iterator.
-        """
+        cdef _PTreeNode lpn = self._getLocalPTNode(k)
+        cdef size_t next_pos = self._next_item_order_position
 
-        return self._getListFromIter(self.itervalues(recursive, branch_mode))
+        if self.isDangling():
+            self._logDangling(undo)
 
-    def keys(self, bint recursive = True, branch_mode = 'none'):
-        """
-        Identical to :meth:`iterkeys()`, but returns a list instead of
-        an iterator.
-        """
+        self._attach(k, tree, f_copy | flags)
 
-        return self._getListFromIter(self.iterkeys(recursive, branch_mode))
+        undo.append( (self, k, lpn, next_pos) )
 
-    def branches(self):
-        """
-        Identical to :meth:`iterbranches()`, but returns a list
-        instead of an iterator.
+    cdef _logDangling(self, list undo):
 
-        Example::
+        # Setting a value in a dangling node attaches it and all its
+        # dangling parents, top one first.
+        cdef list chain = []
+        cdef TreeDict p = self
 
-            >>> from treedict import TreeDict
-            >>> t = TreeDict()
-            >>> t.set('a.b', 1, 'b.c', 2, x = 1, y = 2)
-            >>> print t.makeReport()
-            a.b = 1
-            b.c = 2
-            y   = 2
-            x   = 1
-            >>> t.branches()
-            [TreeDict <root.a>, TreeDict <root.b>]
+        while p is not None and p.isDangling():
+            chain.append( (p, p._isDetachedDangling(),
+                           p._aux_dict.get(s_dangling_reference_queue)) )
+            p = p._parent()
+
+        chain.reverse()
+        undo.extend(chain)
+
+    cdef _undoSetLocal(self, str k, _PTreeNode old_pn, size_t next_pos):
+
+        cdef _PTreeNode pn = self._param_dict.get(k)
+
+        if pn is not old_pn:
+            if pn is not None:
+                self._keyDeleted(k, pn)
+
+            if old_pn is None:
+                del self._param_dict[k]
+            else:
+                # Assigned in place to keep the key's position
+                self._param_dict[k] = old_pn
+                self._keyInserted(k, old_pn)
+
+                if old_pn.isBranch():
+                    self._branches.append(old_pn.tree())
+
+        self._next_item_order_position = next_pos
+
+    cdef _undoAttachDangling(self, bint was_detached, list queue):
+
+        cdef TreeDict p = self._parent()
+        cdef _PTreeNode pn
+
+        if was_detached:
+            pn = p._param_dict.get(self._name)
+
+            if pn is not None and pn.value() is self:
+                p._keyDeleted(self._name, pn)
+                del p._param_dict[self._name]
+
+            self._setDangling(True)
+            self._setDetachedDangling(True)
+        else:
+            self._setDangling(True)
+            p._n_dangling += 1
+
+        if queue is not None:
+            self._aux_dict[s_dangling_reference_queue] = queue
+
+
+
+    cdef TreeDict _copy(self, bint deep, bint frozen, dict memo = None):
+        # Wraps the recursive function _recursiveCopy() that
+
+        if self.isDangling():
+            self._raiseErrorAtFirstNonDanglingBranch(True)
+
+        cdef TreeDict p
+        cdef str tn, bn, newbn
+
+        if deep:
+            if memo is None:
+                memo = {}
+
+            _checkNumpyCopier()
+
+        p = self._recursiveCopy(deep, memo)
+
+        if frozen:
+            p.freeze()
+
+        self._clearHasBeenCopiedFlags()
+
+        return p
+
+    cdef _clearHasBeenCopiedFlags(self):
+
+        cdef _PTreeNode pn
+
+        if self.hasBeenCopied():
+            del self._aux_dict[s_copied_node]
+
+            self._setHasBeenCopiedFlag(False)
+
+            for pnv in self._param_dict.values() if IS_PYTHON2 else list(self._param_dict.values()):
+                pn = <_PTreeNode>pnv
+
+                if pn.isTree():
+                    pn.tree()._clearHasBeenCopiedFlags()
+
+        if self.isCopyReferenced():
+            self._setCopyReferencedFlag(False)
+            del self._aux_dict[s_copy_referencing_keys]
+
+    ########################################
+    # Copy-on-write copies.  These start as unloaded nodes, with
+    # _param_dict and _branches set to None, that only hold a
+    # reference to the node they were copied from.  The local storage
+    # is built by _load() on first access; every method that touches
+    # _param_dict or _branches of a node that may be unloaded must
+    # call it first.  Before a source node is changed in place,
+    # _prepareWrite() loads all the copies still reading from it.
+
+    cdef TreeDict _lazyCopy(self, bint frozen):
+
+        if self.isDangling():
+            self._raiseErrorAtFirstNonDanglingBranch(True)
+
+        cdef _CopyOnWriteContext ctx = _CopyOnWriteContext()
+        cdef TreeDict p = ctx.newNode(self, None, self._name)
+
+        if frozen:
+            p.freeze()
+
+        return p
+
+    cdef inline _load(self):
+        if self._param_dict is None:
+            self._loadFromSource()
+
+    cdef _loadFromSource(self):
+
+        # Several threads may get here together; the node is loaded
+        # by the first one.  Nodes of lazily pickled and mapped trees
+        # get their _param_dict last, so once it is set, other threads
+        # may read the node without taking the lock.
+
+        with _load_lock:
+            if self._param_dict is None:
+                self._loadSource()
+
+    cdef _loadSource(self):
+
+        cdef tuple source_info
+
+        if s_pickled_source in self._aux_dict:
+            _setLazyPickleState(self, <tuple>loads(self._aux_dict.pop(s_pickled_source)))
+            return
+
+        if s_mapped_source in self._aux_dict:
+            source_info = <tuple>self._aux_dict.pop(s_mapped_source)
+            (<_BinaryReader>source_info[0])._loadMappedNode(self, <size_t>source_info[1])
+            return
+
+        source_info = <tuple>self._aux_dict.pop(s_cow_source)
+        cdef TreeDict src = <TreeDict>source_info[0]
+        cdef _CopyOnWriteContext ctx = <_CopyOnWriteContext>source_info[1]
+        cdef dict d = {}
+        cdef list branches = []
+        cdef list tree_keys = None
+        cdef _PTreeNode pn
+        cdef TreeDict b
+
+        src._load()
+
+        # Values are immutable once stored, so their nodes are shared;
+        # branches get new, unloaded nodes of their own.
+        for k, pnv in (src._param_dict.iteritems() if IS_PYTHON2 else src._param_dict.items()):
+            pn = <_PTreeNode>pnv
+
+            if pn.isDanglingBranch():
+                continue
+
+            if pn.isBranch() and pn.tree()._parent() is src and pn.tree()._name == k:
+                b = ctx.newNode(pn.tree(), self, k)
+                pn = newPTreeNodeExact(b, t_Branch, pn.orderPosition())
+                branches.append(b)
+
+            elif pn.isTree():
+                if tree_keys is None:
+                    tree_keys = []
+
+                tree_keys.append(k)
+
+            elif pn.isMutable():
+                self._n_mutable += 1
+
+            d[k] = pn
+
+        self._param_dict = d
+        self._branches = branches
+        self._next_item_order_position = src._next_item_order_position
+
+        # Trees stored as values that are part of the copied tree must
+        # point to their copies; this is done after the storage is in
+        # place, as resolving them may load other nodes.
+        if tree_keys is not None:
+            for k in tree_keys:
+                pn = <_PTreeNode>d[k]
+                d[k] = newPTreeNodeExact(ctx.copyOf(pn.tree()), t_Tree, pn.orderPosition())
+
+        ctx.nodeLoaded()
+
+    cdef TreeDict _unchangedSource(self):
+        # An unloaded copy has the same contents as its source unless
+        # trees stored as values below it were remapped to copies; if
+        # there are none, the source can stand in for it when hashing.
+
+        cdef TreeDict src
+
+        if self._param_dict is None and s_cow_source in self._aux_dict:
+            src = <TreeDict>((<tuple>self._aux_dict[s_cow_source])[0])
+
+            if not src._subtreeHasTreeValues():
+                return src
+
+        return None
+
+    cdef bint _subtreeHasTreeValues(self) except -1:
+
+        cdef TreeDict src
+        cdef _PTreeNode pn
+        cdef bint ret = False
+
+        if self._param_dict is None and s_cow_source in self._aux_dict:
+            src = <TreeDict>((<tuple>self._aux_dict[s_cow_source])[0])
+            return src._subtreeHasTreeValues()
+
+        self._load()
+
+        if s_has_tree_values in self._aux_dict:
+            return self._aux_dict[s_has_tree_values]
+
+        for pnv in (self._param_dict.itervalues() if IS_PYTHON2 else self._param_dict.values()):
+            pn = <_PTreeNode>pnv
+
+            if pn.isNonBranchTree() or (pn.isBranch() and pn.tree()._subtreeHasTreeValues()):
+                ret = True
+                break
+
+        # Frozen trees never change, so the answer can be kept.
+        if self.isFrozen():
+            self._aux_dict[s_has_tree_values] = ret
+
+        return ret
+
+    cdef inline _prepareWrite(self):
+        if _n_cow_sources != 0:
+            self._releaseCopyOnWriteDependents()
+
+    cdef _releaseCopyOnWriteDependents(self):
+
+        # A lazy copy of any node between the root and this one may
+        # still read this node's storage, so all of them are loaded
+        # from the top down.
+        cdef list path = []
+        cdef TreeDict p = self
+
+        while p is not None:
+            path.append(p)
+            p = p._parent()
+
+        for p in reversed(path):
+            if _flagOn(&p._flags, f_is_cow_source):
+                p._loadDependents()
+
+    cdef _loadDependents(self):
+
+        global _n_cow_sources
+
+        cdef list dependents = <list>self._aux_dict.pop(s_cow_dependents)
+
+        _setFlagOff(&self._flags, f_is_cow_source)
+        _n_cow_sources -= 1
+
+        for wr in dependents:
+            b = wr()
+            if b is not None:
+                (<TreeDict>b)._load()
+
+    cdef _addDependent(self, TreeDict b):
+
+        global _n_cow_sources
+
+        cdef list dependents
+
+        if _flagOn(&self._flags, f_is_cow_source):
+            dependents = <list>self._aux_dict[s_cow_dependents]
+
+            # Drop copies that have since been loaded or deleted
+            if len(dependents) % 32 == 0:
+                dependents[:] = [wr for wr in dependents
+                                 if wr() is not None and (<TreeDict>wr())._param_dict is None]
+
+            dependents.append(new_weakref(b))
+        else:
+            self._aux_dict[s_cow_dependents] = [new_weakref(b)]
+            _setFlagOn(&self._flags, f_is_cow_source)
+            _n_cow_sources += 1
+
+    cdef TreeDict _recursiveCopy(self, bint deep, dict memo):
+        # The recursive version of the above; deep copies track the
+        # nodes already copied in memo, shallow ones with flags.
+
+        if not deep:
+            if DEBUG_MODE:
+                assert not self.hasBeenCopied()
+        else:
+            if id(self) in memo:
+                return memo[id(self)]
+
+        self._load()
+
+        cdef TreeDict p = newTreeDict(self._name, False)
+        cdef _PTreeNode pn, new_pn
+
+        assert p._name == self._name
+
+        # In copying, the tree doesn't preserve parental relation.
+
+        p._clearParent()
+        p._param_dict = {}
+
+        p._flags = self._flags & f_copybranch_propegating_flags
+
+        p._n_dangling = 0
+        p._n_mutable = 0
+        p._next_item_order_position = self._next_item_order_position
+
+        # Registered before the values are copied so values referring
+        # back to this node get the copy.
+        if deep:
+            memo[id(self)] = p
+            _keepAlive(self, memo)
+
+        for k, pn in self._param_dict.items():
+
+            if pn.isDanglingBranch():
+                continue
+
+            new_pn = self._copyValue(p, k, pn, deep, memo)
+
+            p._param_dict[k] = new_pn
+            p._keyInserted(k, new_pn)
+
+        p._reset_branches()
+
+        if not deep:
+            self._setCopiedNode(p)
+
+        return p
+
+    cdef _setCopiedNode(self, TreeDict p):
+
+        self._aux_dict[s_copied_node] = p
+        self._setHasBeenCopiedFlag(True)
+
+        if self.isCopyReferenced():
+            # Now have to go through and update keys in trees that
+            # previously reference this one
+            for t, k in (<list>self._aux_dict[s_copy_referencing_keys]):
+
+                if DEBUG_MODE:
+                    assert isinstance(t, TreeDict)
+                    assert isinstance(k, str)
+
+                (<TreeDict>t)._setLocal(k, p, f_already_checked)
+
+            del self._aux_dict[s_copy_referencing_keys]
+            self._setCopyReferencedFlag(False)
+
+
+    cdef _copyValue(self, TreeDict parent, str key, _PTreeNode pn, bint deep, dict memo):
+
+        cdef TreeDict p
+
+        if pn.isBranch() and pn.tree()._parent() is self and pn.tree()._name == key:
+
+            # print "Here; key = %s; tree id = %s" % (key, id(pn.tree()))
+
+            p = pn.tree()._recursiveCopy(deep, memo)
+            p._setParent(parent)
+
+            return newPTreeNodeExact(p, pn.type(), pn.orderPosition())
+
+        elif deep:
+            return newPTreeNodeExact(
+                _deepCopyValue(pn.value(), pn.type(), memo),
+                pn.type(), pn.orderPosition())
+
+        elif pn.isTree():
+
+            p = pn.tree()
+
+            if p.hasBeenCopied():
+                return newPTreeNodeExact(<TreeDict>(p._aux_dict[s_copied_node]),
+                                         pn.type(), pn.orderPosition())
+            else:
+                p._setCopyReferencedFlag(True)
+
+                if s_copy_referencing_keys in p._aux_dict:
+                    (<list>p._aux_dict[s_copy_referencing_keys]).append( (parent, key) )
+                else:
+                    p._aux_dict[s_copy_referencing_keys] = [ (parent, key) ]
+
+                return newPTreeNodeExact(pn.value(), pn.type(), pn.orderPosition())
+
+        else:
+            return newPTreeNodeExact(pn.value(), pn.type(), pn.orderPosition())
+
+
+    ########################################
+    # Selective copies.  The selected keys are held in a trie of
+    # nested dicts, mapping each name either to the sub-trie below it
+    # or to True if everything below is selected.
+
+    cdef dict _selectionTrie(self, keys):
+
+        cdef dict trie = {}, node
+        cdef list names
+        cdef str key, name
+        cdef size_t i
+        cdef TreeDict b
+        cdef _PTreeNode pn
+
+        if isinstance(keys, str):
+            keys = [keys]
+
+        for k in keys:
+            key = validateKey(k)
+            names = strsplit(key, '.')
+            node = trie
+            b = self
+
+            for i, name in enumerate(names):
+                pn = b._getLocalPTNode(name) if b is not None else None
+
+                if pn is None or pn.isDanglingTree() or (i != len(names) - 1 and not pn.isBranch()):
+                    raise KeyError(repr(self._fullNameOf(key)))
+
+                b = pn.tree() if pn.isBranch() else None
+
+                if node.get(name) is True:
+                    break
+
+                if i == len(names) - 1:
+                    node[name] = True
+                else:
+                    node = <dict>node.setdefault(name, {})
+
+        return trie
+
+    cdef TreeDict _selectiveCopy(self, dict included, dict excluded, bint deep, bint frozen):
+
+        if self.isDangling():
+            self._raiseErrorAtFirstNonDanglingBranch(True)
+
+        cdef dict memo = None
+        cdef TreeDict p
+
+        if deep:
+            memo = {}
+            _checkNumpyCopier()
+
+        p = self._recursiveSelectiveCopy(included, excluded, deep, memo)
+
+        if frozen:
+            p.freeze()
+
+        self._clearHasBeenCopiedFlags()
+
+        return p
+
+    cdef TreeDict _recursiveSelectiveCopy(self, dict included, dict excluded,
+                                          bint deep, dict memo):
+
+        # included is None if everything here is selected; excluded is
+        # None if nothing below here is excluded.
+
+        cdef TreeDict p = newTreeDict(self._name, False), b
+        cdef _PTreeNode pn, new_pn
+        cdef list entries
+        cdef str k
+        cdef object sub_in, sub_ex
+
+        self._load()
+
+        p._clearParent()
+        p._param_dict = {}
+        p._flags = self._flags & f_copybranch_propegating_flags
+        p._next_item_order_position = self._next_item_order_position
+
+        if deep:
+            memo[id(self)] = p
+            _keepAlive(self, memo)
+
+        # Only the selected keys are visited; sorting them by their
+        # setting order gives the same order as the original.
+        if included is None:
+            entries = list(self._param_dict.items())
+        else:
+            entries = sorted([(k, self._param_dict[k]) for k in included],
+                             key = _entryOrderPosition)
+
+        for k, pn in entries:
+
+            if pn.isDanglingBranch():
+                continue
+
+            sub_in = None if included is None else included[k]
+            sub_ex = None if excluded is None else excluded.get(k)
+
+            if sub_in is True:
+                sub_in = None
+
+            if sub_ex is True:
+                continue
+
+            if sub_in is None and sub_ex is None:
+                new_pn = self._copyValue(p, k, pn, deep, memo)
+            else:
+                b = pn.tree()._recursiveSelectiveCopy(sub_in, sub_ex, deep, memo)
+                b._setParent(p)
+                new_pn = newPTreeNodeExact(b, t_Branch, pn.orderPosition())
+
+            p._param_dict[k] = new_pn
+            p._keyInserted(k, new_pn)
+
+        p._reset_branches()
+
+        if not deep:
+            self._setCopiedNode(p)
+
+        return p
+
+    cdef _reset_branches(self):
+        self._branches = [(<_PTreeNode> pn).value() for pn in self._param_dict.values()
+                          if (<_PTreeNode> pn).isBranch()]
+
+    ################################################################################
+    # Methods relating to pickling / unpickling
+
+    def __reduce__(self):
+
+        self._load()
+
+        cdef tuple state, fa
+        cdef _RWLock lock = self._lockRead()
+
+        try:
+            if s_lazy_pickling in self.rootNode()._aux_dict:
+                state = self._lazyPickleState(False, self)
+
+                if state is not None:
+                    return (_TreeDict_lazy_unpickler, (state,))
+
+            fa = self._picklingFlagsAndAux()
+
+            # The unpickler sets the parent of each branch again; keeping
+            # the reference here would pickle the parent a second time.
+            if s_dangling_parent_reference in <dict>fa[1]:
+                del (<dict>fa[1])[s_dangling_parent_reference]
+
+            # The items are pickled after the lock is released, so a
+            # thread safe tree passes a copy of them.
+            return (_TreeDict_unpickler,
+                    (self._name, self._param_dict if lock is None else dict(self._param_dict),
+                     fa[0], fa[1], self._n_mutable, self._next_item_order_position,
+                     self._n_dangling) )
+        finally:
+            _unlock(lock, False)
+
+    cdef tuple _picklingFlagsAndAux(self):
+
+        # Need to check for weak references in
+        # _param_dict[s_dangling_reference_queue].  This handles a
+        # corner case that shouldn't really be that important.
+
+        cdef dict d = <dict>(self._aux_dict.copy())
+        cdef flagtype flags = self._flags
+
+        if s_dangling_reference_queue in d:
+            d[s_dangling_reference_queue] = []
+
+        ########################################
+        # Clear other irrelevant flags
+        _setFlagOff(&flags, f_one_iterators_referencing)
+        _setFlagOff(&flags, f_many_iterators_referencing)
+        _setFlagOff(&flags, f_is_registered)
+
+        # Clear iterator referencing
+        if s_IterReferenceCount in d:
+            del d[s_IterReferenceCount]
+
+        if s_registration_tree_name in d:
+            del d[s_registration_tree_name]
+
+        if s_registration_branch_name in d:
+            del d[s_registration_branch_name]
+
+        if s_flattened_keys in d:
+            del d[s_flattened_keys]
+
+        if s_cow_dependents in d:
+            del d[s_cow_dependents]
+
+        _setFlagOff(&flags, f_is_cow_source)
+
+        # String hashes differ between processes
+        _setFlagOff(&flags, f_py_hash_cached)
+
+        if s_rw_lock in d:
+            del d[s_rw_lock]
+
+        _setFlagOff(&flags, f_is_thread_safe)
+
+        return (flags, d)
+
+    def setLazyPickling(self, bint lazy = True):
+        """
+        If `lazy` is True, the tree is afterwards pickled so that each
+        branch is stored as a separate pickled string, which is only
+        unpickled when the branch is first accessed.  A process that
+        receives a large tree but reads only a few of its branches
+        then only pays for unpickling those.  The setting applies to
+        the whole tree and is kept by the unpickled tree.  If `lazy`
+        is False, the whole tree is pickled and unpickled at once
+        (default).
+
+        The unpickled tree is the same as with normal pickling, with
+        one exception: values referenced from several branches are
+        pickled separately in each, so they are no longer the same
+        object once unpickled.  Also, as the branches are pickled
+        separately, their values are not passed as out-of-band buffers
+        with pickle protocol 5.  A tree holding a branch of itself as
+        a value, e.g. after ``t.x = t.b``, is always pickled at once,
+        so the value is still that branch once unpickled.
+
+        Example::
+
+            >>> import pickle
+            >>> from treedict import TreeDict
+            >>> t = TreeDict() ; t.set('a.x', 1, 'b.y', 2)
+            >>> t.setLazyPickling()
+            >>> t2 = pickle.loads(pickle.dumps(t))
+            >>> t2.a.x       # Only branch a is unpickled here
+            1
+        """
+
+        cdef TreeDict r = self.rootNode()
+        cdef _RWLock lock = self._lockWrite()
+
+        try:
+            if lazy:
+                r._aux_dict[s_lazy_pickling] = True
+            elif s_lazy_pickling in r._aux_dict:
+                del r._aux_dict[s_lazy_pickling]
+        finally:
+            _unlock(lock, True)
+
+    cdef tuple _lazyPickleState(self, bint is_branch, TreeDict top):
+
+        # The state of a node, with each branch replaced by its
+        # flags and its own state as a pickled string.  A dangling
+        # branch's reference to its parent is set again on loading.
+        # Returns None if a value is a node of the tree being pickled,
+        # top, as it would be unpickled as a separate copy.
+
+        cdef list items = []
+        cdef _PTreeNode pn
+        cdef TreeDict b
+        cdef tuple fa, state
+
+        self._load()
+
+        for k, pnv in (self._param_dict.iteritems() if IS_PYTHON2 else self._param_dict.items()):
+            pn = <_PTreeNode>pnv
+
+            if pn.isBranch() and pn.tree()._parent() is self:
+                b = pn.tree()
+                state = b._lazyPickleState(True, top)
+
+                if state is None:
+                    return None
+
+                items.append( (k, pn._order_position, b._picklingFlagsAndAux()[0],
+                               dumps(state, -1)) )
+            else:
+                if pn.isTree():
+                    b = pn.tree()
+
+                    while b is not None and b is not top:
+                        b = b._parent()
+
+                    if b is not None:
+                        return None
+
+                items.append( (k, pn) )
+
+        fa = self._picklingFlagsAndAux()
+
+        if is_branch and s_dangling_parent_reference in <dict>fa[1]:
+            del (<dict>fa[1])[s_dangling_parent_reference]
+
+        return (self._name, items, fa[0], fa[1],
+                self._n_mutable, self._next_item_order_position, self._n_dangling)
+
+    def toBytes(self):
+        """
+        Returns the tree as a bytes string in a compact binary format,
+        which can be read back with :meth:`fromBytes`.  This is
+        usually smaller and much faster to read than a pickle of the
+        tree.  The structure, the keys, the setting order and the
+        frozen state of the tree are stored in compact tables, with
+        each distinct key or string value stored only once.  None,
+        bools, ints, floats, strings and bytes are stored directly;
+        all other values are pickled.
+
+        Unlike pickling, values referenced in several places are
+        stored separately for each, so after reading they are no
+        longer the same object.  Dangling branches are dropped.
+
+        Example::
+
+            >>> from treedict import TreeDict
+            >>> t = TreeDict() ; t.set('a.x', 1, 'a.y', 'abc', b = 2.5)
+            >>> t2 = TreeDict.fromBytes(t.toBytes())
+            >>> t2 == t
+            True
+        """
+
+        cdef _RWLock lock = self._lockRead()
+
+        try:
+            return _encodeTree(self)
+        except Exception, e:
+            if DEBUG_MODE: raise
+            else: raise e
+        finally:
+            _unlock(lock, False)
+
+    @classmethod
+    def fromBytes(cls, buf):
+        """
+        Creates a new TreeDict from a bytes string (or another buffer)
+        as returned by :meth:`toBytes`.  A ValueError is raised if the
+        data is not in that format or is truncated.
+        """
+
+        try:
+            return _BinaryReader(buf).readTree()
+        except Exception, e:
+            if DEBUG_MODE: raise
+            else: raise e
+
+    def saveMapped(self, path):
+        """
+        Writes the tree to the file `path` in a format that can be
+        opened with :meth:`openMapped`.  The format is like that of
+        :meth:`toBytes`, but each branch is stored as a separate
+        record that can be read on its own.
+        """
+
+        cdef _RWLock lock = self._lockRead()
+
+        try:
+            _saveMapped(self, path)
+        except Exception, e:
+            if DEBUG_MODE: raise
+            else: raise e
+        finally:
+            _unlock(lock, False)
+
+    @classmethod
+    def openMapped(cls, path):
+        """
+        Opens a tree written by :meth:`saveMapped`.  The file is
+        memory mapped, and each branch is read from it only when it
+        is first accessed, so opening even a very large tree is
+        nearly instant and memory is only used for the parts of the
+        tree that are actually read.  As the file is mapped read-only,
+        processes opening the same file share its pages.
+
+        The returned tree behaves as any other TreeDict and has the
+        frozen state of the saved tree; changing it does not change
+        the file.  The file must not be changed while it is open.
+
+        Example::
+
+            >>> from treedict import TreeDict
+            >>> t = TreeDict() ; t.set('a.x', 1, 'b.y', 2) ; t.freeze()
+            >>> t.saveMapped('params.tdm')
+            >>> t2 = TreeDict.openMapped('params.tdm')
+            >>> t2.a.x
+            1
+            >>> t2 == t
+            True
+        """
+
+        try:
+            return _openMapped(path)
+        except Exception, e:
+            if DEBUG_MODE: raise
+            else: raise e
+
+
+    ################################################################################
+    # Methods relating to size and the like
+
+    def __len__(self):
+
+        cdef _RWLock lock = self._lockRead()
+
+        try:
+            return self._size(True, i_BranchMode_None)
+        finally:
+            _unlock(lock, False)
+
+    def size(self, bint recursive = True, str branch_mode = 'none'):
+        """
+        Returns a count of values in the tree.  If recursive is True,
+        then it counts all nodes in this branch and in all subtrees,
+        according to the branch_mode policy.
+
+        If branch_mode is 'none' (default), only the values are counted.
+
+        If branch_mode is 'all', all nodes and all values in the current
+        tree are counted.
+
+        If branch_mode is 'only', only the branches are counted.
+
+        Example::
+
+            >>> from treedict import TreeDict
+            >>> t = TreeDict() ; t.set('b.x', 1, 'b.c.y', 2, x = 1)
+            >>> print t.makeReport()
+            b.x   = 1
+            b.c.y = 2
+            x     = 1
+            >>> t.size()
+            3
+            >>> t.size(recursive=False)
+            1
+            >>> t.size(recursive=False, branch_mode='none')
+            1
+            >>> t.size(recursive=False, branch_mode='only')
+            1
+            >>> t.size(recursive=False, branch_mode='all')
+            2
+            >>> t.size(recursive=True, branch_mode='only')
+            2
+            >>> t.size(recursive=True, branch_mode='all')
+            5
+
+        """
+
+        cdef int b_mode = self._getBranchMode(branch_mode)
+        cdef _RWLock lock = self._lockRead()
+
+        try:
+            return self._size(recursive, b_mode)
+        finally:
+            _unlock(lock, False)
+
+    cdef size_t _local_size(self, int branch_mode):
+        if branch_mode == i_BranchMode_Only:
+            return len(self._branches) - self._n_dangling
+        elif branch_mode == i_BranchMode_All:
+            return len(self._param_dict) - self._n_dangling
+        elif branch_mode == i_BranchMode_None:
+            return len(self._param_dict) - len(self._branches)
+
+    cdef size_t _size(self, bint recursive, int branch_mode):
+
+        cdef size_t n
+        cdef TreeDict b
+
+        self._load()
+
+        if recursive:
+            n = self._local_size(branch_mode)
+
+            for b in self._branches:
+                if not b.isDangling():
+                    n += b._size(recursive, branch_mode)
+
+            return n
+        else:
+            return self._local_size(branch_mode)
+
+
+    ################################################################################
+    # Methods relating to iterating over values
+
+    cdef _getBranchMode(self, branch_mode):
+        # This function returns an object so it can raise exceptions;
+        # it gets converted later anyway.
+
+        if branch_mode is None:
+            return i_BranchMode_None
+
+        if not isinstance(branch_mode, str):
+            raise TypeError(_branch_mode_error_msg)
+
+        try:
+            return _branch_mode_lookup[strlower(branch_mode)]
+        except KeyError:
+            raise TypeError(_branch_mode_error_msg)
+
+    cdef TreeDictIterator _getIter(self, bint recursive, int branch_mode, int valuetype):
+        self._load()
+        return newTreeDictIterator(self, recursive, branch_mode, valuetype)
+
+    cpdef TreeDictIterator iteritems(self, bint recursive = True, branch_mode = 'none'):
+        """
+        Returns an iterator that returns (key, value) pairs.  If
+        recursive is True, then it iterates through all nodes in this
+        branch and in all subtrees.  Keys are returned with their full
+        path names, e.g. 'foo.bar'.
+
+        If branch_mode is 'none' (default), the branches are ignored
+        and all the items associated with values are returned.
+
+        If branch_mode is 'all', all items in the current tree
+        are returned.
+
+        If branch_mode is 'only', then only the branches are returned.
+
+        Example::
+
+            >>> from treedict import TreeDict
+            >>> t = TreeDict() ; t.set('b.x', 1, 'b.c.y', 2, x = 1)
+            >>> print t.makeReport()
+            b.x   = 1
+            b.c.y = 2
+            x     = 1
+            >>> list(t.iteritems())
+            [('x', 1), ('b.x', 1), ('b.c.y', 2)]
+            >>> list(t.iteritems(recursive=False))
+            [('x', 1)]
+            >>> list(t.iteritems(recursive=False, branch_mode='none'))
+            [('x', 1)]
+            >>> list(t.iteritems(recursive=False, branch_mode='only'))
+            [('b', TreeDict <root.b>)]
+            >>> list(t.iteritems(recursive=False, branch_mode='all'))
+            [('x', 1), ('b', TreeDict <root.b>)]
+            >>> list(t.iteritems(recursive=True, branch_mode='only'))
+            [('b', TreeDict <root.b>), ('b.c', TreeDict <root.b.c>)]
+            >>> list(t.iteritems(recursive=True, branch_mode='all'))
+            [('x', 1), ('b', TreeDict <root.b>), ('b.x', 1), ('b.c', TreeDict <root.b.c>), ('b.c.y', 2)]
+
+        """
+
+        return self._getIter(recursive, self._getBranchMode(branch_mode), i_Items)
+
+    cpdef TreeDictIterator itervalues(self, bint recursive = True, branch_mode = 'none'):
+        """
+        Returns an iterator that returns values in the tree.  If
+        recursive is True, then it iterates through all nodes in this
+        branch and in all subtrees.
+
+        If branch_mode is 'none' (default), the branches are ignored
+        and all the items associated with values are returned.
+
+        If branch_mode is 'all', all items in the current tree
+        are returned.
+
+        If branch_mode is 'only', then only the branches are returned.
+
+        Example::
+
+            >>> from treedict import TreeDict
+            >>> t = TreeDict() ; t.set('b.x', 1, 'b.c.y', 2, x = 1)
+            >>> print t.makeReport()
+            b.x   = 1
+            b.c.y = 2
+            x     = 1
+            >>> list(t.itervalues())
+            [1, 1, 2]
+            >>> list(t.itervalues(recursive=False))
+            [1]
+            >>> list(t.itervalues(recursive=False, branch_mode='none'))
+            [1]
+            >>> list(t.itervalues(recursive=False, branch_mode='only'))
+            [TreeDict <root.b>]
+            >>> list(t.itervalues(recursive=False, branch_mode='all'))
+            [1, TreeDict <root.b>]
+            >>> list(t.itervalues(recursive=True, branch_mode='only'))
+            [TreeDict <root.b>, TreeDict <root.b.c>]
+            >>> list(t.itervalues(recursive=True, branch_mode='all'))
+            [1, TreeDict <root.b>, 1, TreeDict <root.b.c>, 2]
+
+        """
+
+        return self._getIter(recursive, self._getBranchMode(branch_mode), i_Values)
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    cpdef TreeDictIterator iterkeys(self, bint recursive = True, branch_mode = 'none'):
+        """
+        Returns an iterator that returns keys for nodes in the tree.
+        If recursive is True, then it iterates through all nodes in
+        this branch and in all subtrees.  Keys are returned with their
+        full path names, e.g. 'foo.bar'.
+
+        If branch_mode is 'none' (default), the branches are ignored
+        and all the items associated with values are returned.
+
+        If branch_mode is 'all', all items in the current tree
+        are returned.
+
+        If branch_mode is 'only', then only the branches are returned.
+
+        Example::
+
+            >>> from treedict import TreeDict
+            >>> t = TreeDict() ; t.set('b.x', 1, 'b.c.y', 2, x = 1)
+            >>> print t.makeReport()
+            b.x   = 1
+            b.c.y = 2
+            x     = 1
+            >>> list(t.iterkeys())
+            ['x', 'b.x', 'b.c.y']
+            >>> list(t.iterkeys(recursive=False))
+            ['x']
+            >>> list(t.iterkeys(recursive=False, branch_mode='none'))
+            ['x']
+            >>> list(t.iterkeys(recursive=False, branch_mode='only'))
+            ['b']
+            >>> list(t.iterkeys(recursive=False, branch_mode='all'))
+            ['x', 'b']
+            >>> list(t.iterkeys(recursive=True, branch_mode='only'))
+            ['b', 'b.c']
+            >>> list(t.iterkeys(recursive=True, branch_mode='all'))
+            ['x', 'b', 'b.x', 'b.c', 'b.c.y']
+
+        """
+
+        return self._getIter(recursive, self._getBranchMode(branch_mode), i_Keys)
+
+    cpdef TreeDictIterator iterbranches(self):
+        """
+        A convenience function; iterates through all of the local
+        branches.  Equivalent to itervalues(recursive=False,
+        branch_mode='only').
+
+        Example::
+
+            >>> from treedict import TreeDict
+            >>> t = TreeDict()
+            >>> t.set('a.b', 1, 'b.c', 2, x = 1, y = 2)
+            >>> print t.makeReport()
+            a.b = 1
+            b.c = 2
+            y   = 2
+            x   = 1
+            >>> list(t.iterbranches())
+            [TreeDict <root.a>, TreeDict <root.b>]
+
+        """
+
+        return self._getIter(False, self._getBranchMode('only'), i_Values)
+
+    cdef list _getList(self, bint recursive, branch_mode, int itertype):
+        cdef list l = []
+        cdef int b_mode = self._getBranchMode(branch_mode)
+        cdef _RWLock lock = self._lockRead()
+
+        try:
+            self._flattenInto(l, None, None, None, recursive, b_mode, itertype)
+        finally:
+            _unlock(lock, False)
+
+        return l
+
+    cdef _flattenInto(self, list l1, list l2, dict d, str prefix,
+                      bint recursive, int branch_mode, int itertype):
+
+        # Walks the tree in the same order as the iterators, appending
+        # the requested quantities as it goes.  Unlike the iterators,
+        # this needs no size pass and no per-node reference counting.
+
+        cdef PyObject *k_obj = NULL
+        cdef PyObject *pn_obj = NULL
+        cdef Py_ssize_t pos = 0
+        cdef _PTreeNode pn
+        cdef str k
+
+        self._load()
+
+        while PyDict_Next(self._param_dict, &pos, &k_obj, &pn_obj):
+            pn = <_PTreeNode>pn_obj
+
+            if pn.isBranch():
+                if pn.isDanglingBranch():
+                    continue
+
+                if branch_mode == i_BranchMode_None and not recursive:
+                    continue
+
+                k = (<str>k_obj) if prefix is None else prefix + (<str>k_obj)
+
+                if branch_mode != i_BranchMode_None:
+                    _flatEmit(l1, l2, d, k, pn._v, itertype)
+
+                if recursive:
+                    pn.tree()._flattenInto(l1, l2, d, k + '.', recursive,
+                                           branch_mode, itertype)
+
+            elif branch_mode != i_BranchMode_Only:
+                k = (<str>k_obj) if prefix is None else prefix + (<str>k_obj)
+                _flatEmit(l1, l2, d, k, pn._v, itertype)
+
+    def items(self, bint recursive = True, branch_mode = 'none'):
+        """
+        Identical to :meth:`iteritems()`, but returns a list instead
+        of an iterator.
+        """
+
+        return self._getList(recursive, branch_mode, i_Items)
+
+    def values(self, bint recursive = True, branch_mode = 'none'):
+        """
+        Identical to :meth:`itervalues()`, but returns a list instead
+        of an iterator.
+        """
+
+        return self._getList(recursive, branch_mode, i_Values)
+
+    def keys(self, bint recursive = True, branch_mode = 'none'):
+        """
+        Identical to :meth:`iterkeys()`, but returns a list instead of
+        an iterator.
+        """
+
+        return self._getList(recursive, branch_mode, i_Keys)
+
+    def branches(self):
+        """
+        Identical to :meth:`iterbranches()`, but returns a list
+        instead of an iterator.
+
+        Example::
+
+            >>> from treedict import TreeDict
+            >>> t = TreeDict()
+            >>> t.set('a.b', 1, 'b.c', 2, x = 1, y = 2)
+            >>> print t.makeReport()
+            a.b = 1
+            b.c = 2
+            y   = 2
+            x   = 1
+            >>> t.branches()
+            [TreeDict <root.a>, TreeDict <root.b>]
+
+        """
+        return self._getList(False, 'only', i_Values)
+
+    def flatten(self, str kind = 'dict', bint recursive = True,
+                branch_mode = 'none', bint cache_keys = False):
+        """
+        Returns the contents of the tree in flat form, with keys given
+        by their full path names, e.g. 'foo.bar'.  The tree is walked
+        only once, so this is the fastest way to export all the values
+        in a tree.
+
+        If `kind` is 'dict' (default), a dictionary of ``key : value``
+        pairs is returned.  If `kind` is 'lists', a tuple ``(keys,
+        values)`` of two parallel lists is returned, ordered as with
+        :meth:`iteritems()`.
+
+        `recursive` and `branch_mode` behave as they do with the
+        iterators.
+
+        If `cache_keys` is True and the structure of the tree is
+        frozen, the list of full key names is cached in the tree and
+        reused by later calls, so only the values need to be
+        gathered.  It is ignored if the structure of the tree can
+        still change.
+
+        Example::
+
+            >>> from treedict import TreeDict
+            >>> t = TreeDict() ; t.set('b.x', 1, 'b.c.y', 2, x = 1)
+            >>> t.flatten()
+            {'x': 1, 'b.x': 1, 'b.c.y': 2}
+            >>> t.flatten('lists')
+            (['x', 'b.x', 'b.c.y'], [1, 1, 2])
+            >>> t.flatten('lists', branch_mode = 'only')
+            (['b', 'b.c'], [TreeDict <root.b>, TreeDict <root.b.c>])
+
+        """
+
+        cdef int b_mode = self._getBranchMode(branch_mode)
+        cdef list keys, values
+        cdef dict d
+
+        if kind != 'dict' and kind != 'lists':
+            raise ValueError("`kind` must be either 'dict' or 'lists'.")
+
+        cdef _RWLock lock = self._lockRead()
+
+        try:
+            if cache_keys and (self.isFrozen() or self.structureIsFrozen()):
+                keys = self._getCachedKeyList(recursive, b_mode)
+                values = []
+                self._flattenInto(values, None, None, None, recursive, b_mode, i_Values)
+
+                if kind == 'dict':
+                    return dict(zip(keys, values))
+                else:
+                    return (list(keys), values)
+
+            if kind == 'dict':
+                d = {}
+                self._flattenInto(None, None, d, None, recursive, b_mode, i_Dict)
+                return d
+            else:
+                keys, values = [], []
+                self._flattenInto(keys, values, None, None, recursive, b_mode, i_Lists)
+                return (keys, values)
+        finally:
+            _unlock(lock, False)
+
+    cdef list _getCachedKeyList(self, bint recursive, int branch_mode):
+        cdef dict cache
+        cdef list keys
+
+        if s_flattened_keys in self._aux_dict:
+            cache = <dict>self._aux_dict[s_flattened_keys]
+        else:
+            cache = self._aux_dict[s_flattened_keys] = {}
+
+        key = (recursive, branch_mode)
+
+        if key in cache:
+            return <list>cache[key]
+
+        keys = []
+        self._flattenInto(keys, None, None, None, recursive, branch_mode, i_Keys)
+        cache[key] = keys
+        return keys
+
+
+    ################################################################################
+    # Methods relating to testing on this class
+
+    def getClosestKey(self, str key, int n = 0, bint recursive = True, branch_mode = 'none'):
+        """
+        Returns the closest match(s) in the tree to the key `key`.
+
+        If ``n >= 1``, then a list of the `n` closest strings is
+        returned.  If ``n <= 0``, then a single string, the closest
+        match, is returned.  The search algorithm is faster for
+        ``n=0`` or ``n=1``.
+
+        The optional behavior is just like with the iterators, with
+        the default being to examine, recursively, the keys of all
+        leaves for close matches.
+
+        The algorithm used is based on the closest edit distance to
+        the query key `key`, with extra weighting given to branch
+        boundaries.
+
+        Example::
+
+            >>> t = TreeDict()
+            >>> t.alpha.x1 = 1
+            >>> t.alpha.y1 = 1
+            >>> t.alpha.zzz = 1
+            >>> t.beta.x = 1
+            >>> t.gamma.beta = 1
+            >>> "alpah.x" in t
+            False
+            >>> t.getClosestKey("alpah.x")
+            'alpha.x1'
+            >>> t.getClosestKey("alpah.x", 1)
+            ['alpha.x1']
+            >>> t.getClosestKey("alpah.x", 3)
+            ['alpha.x1', 'beta.x', 'alpha.y1']
+
+        """
+
+        checkKeyNotNone(key)
+
+        cdef _ClosestKeyMatch m = _ClosestKeyMatch(key, n)
+        cdef _RWLock lock = self._lockRead()
+
+        try:
+            self._findClosestKeys([m], recursive, branch_mode)
+        finally:
+            _unlock(lock, False)
+
+        return m.result()
+
+    def getClosestKeys(self, queries, int n = 0, bint recursive = True, branch_mode = 'none'):
+        """
+        Returns a dictionary giving, for each key in `queries`, the
+        result of ``getClosestKey(key, n, recursive, branch_mode)``.
+        This is much faster than calling :meth:`getClosestKey` for
+        each key, as the keys of the tree are gone through only once
+        for all the queries.
+
+        Example::
+
+            >>> t = TreeDict()
+            >>> t.set('alpha.x1', 1, 'alpha.y1', 1, 'beta.x', 1)
+            >>> t.getClosestKeys(['alpah.x', 'bet.x'])
+            {'alpah.x': 'alpha.x1', 'bet.x': 'beta.x'}
+
+        """
+
+        cdef list matches = [_ClosestKeyMatch(validateKey(q), n) for q in queries]
+        cdef _RWLock lock = self._lockRead()
+
+        try:
+            self._findClosestKeys(matches, recursive, branch_mode)
+        except Exception, e:
+            if DEBUG_MODE: raise
+            else: raise e
+        finally:
+            _unlock(lock, False)
+
+        return dict([((<_ClosestKeyMatch>m).key, (<_ClosestKeyMatch>m).result())
+                     for m in matches])
+
+    cdef _findClosestKeys(self, list matches, bint recursive, branch_mode):
+
+        cdef int b_mode = self._getBranchMode(branch_mode)
+        cdef _ClosestKeySource src = _ClosestKeySource()
+        cdef _ClosestKeyMatch m
+        cdef size_t max_len = 0
+
+        # Frozen trees keep their keys and the encoded keys used for
+        # matching, so repeated queries don't need to walk the tree.
+        if self.isFrozen() or self.structureIsFrozen():
+            src.keys = self._getCachedKeyList(recursive, b_mode)
+            src.encoded_keys = self._getCachedEncodedKeyList(recursive, b_mode)
+        else:
+            src.pti = self.iterkeys(recursive, branch_mode)
+
+        if not matches:
+            return
+
+        for m in matches:
+            max_len = max2(max_len, len(m.query))
+
+        # One buffer serves all the comparisons; the edit distance
+        # needs two rows the length of the key, so this is usually
+        # large enough and is only grown for longer keys.
+        cdef size_t_v buf = new_size_t_v(2*(max_len + 2))
+
+        if buf.d == NULL:
+            raise MemoryError
+
+        try:
+            while src.next():
+                for m in matches:
+                    m.add(&buf, src.current_key, src.current_encoded)
+        finally:
+            free_size_t_v(&buf)
+
+    cdef list _getCachedEncodedKeyList(self, bint recursive, int branch_mode):
+
+        # The keys of _getCachedKeyList() as utf-8, for getClosestKey();
+        # kept in the same cache.
+
+        cdef dict cache = <dict>self._aux_dict[s_flattened_keys] if s_flattened_keys in self._aux_dict else None
+        cdef list keys
+
+        key = (recursive, branch_mode, 'utf-8')
+
+        if cache is not None and key in cache:
+            return <list>cache[key]
+
+        keys = [(<str>k).encode('utf-8') for k in self._getCachedKeyList(recursive, branch_mode)]
+        (<dict>self._aux_dict[s_flattened_keys])[key] = keys
+        return keys
+
+
+################################################################################
+# The candidates for TreeDict.getClosestKey(), either as the cached
+# key lists of a frozen tree or as an iterator over the keys.
+
+cdef class _ClosestKeySource(object):
+
+    cdef list keys
+    cdef list encoded_keys
+    cdef TreeDictIterator pti
+    cdef size_t pos
+
+    cdef str current_key
+    cdef bytes current_encoded
+
+    cdef bint next(self) except -1:
+        if self.keys is not None:
+            if self.pos == len(self.keys):
+                return False
+
+            self.current_key = <str>self.keys[self.pos]
+            self.current_encoded = <bytes>self.encoded_keys[self.pos]
+            self.pos += 1
+            return True
+
+        if not self.pti._loadNext():
+            return False
+
+        self.current_key = self.pti.currentKey()
+        self.current_encoded = self.current_key.encode('utf-8')
+        return True
+
+cdef class _ClosestKeyMatch(object):
+
+    # The closest keys found so far for one query of getClosestKey().
+    # If n <= 1, only the single closest key is tracked; otherwise, a
+    # heap of the n closest.
+
+    cdef str key
+    cdef bytes query
+    cdef int n
+
+    cdef str best_match
+    cdef long best_cost
+    cdef bint first
+
+    cdef list heap
+    cdef size_t n_els
+    cdef long highest_cost_cutoff
+
+    def __init__(self, str key, int n):
+        self.key = key
+        self.query = key.encode('utf-8')
+        self.n = n
+
+        self.best_match = None
+        self.best_cost = -(2**(sizeof(long) - 2) )
+        self.first = True
+
+        self.heap = []
+        self.n_els = 0
+        self.highest_cost_cutoff = -(2**(sizeof(long) - 2) )
+
+    cdef add(self, size_t_v *bufp, str k, bytes ek):
+
+        cdef long cost
+        cdef tuple t
+
+        if self.n <= 1:
+            cost = name_match_distance_bounded(bufp, self.query, len(self.query), ek, len(ek),
+                                               LONG_MAX if self.first else self.best_cost)
+
+            if self.first or cost < self.best_cost:
+                self.first      = False
+                self.best_cost  = cost
+                self.best_match = k
+
+            return
+
+        # Once the heap is full, only keys costing less than the
+        # cutoff matter, so the exact cost of others isn't needed.
+        cost = name_match_distance_bounded(bufp, self.query, len(self.query), ek, len(ek),
+                                           LONG_MAX if self.n_els < <size_t>self.n
+                                           else self.highest_cost_cutoff)
+
+        # put it on the heap; use -cost so pop gets rid of the
+        # highest cost one.
+        if self.n_els < <size_t>self.n:
+            heappush(self.heap, (-cost, k) )
+
+            if cost > self.highest_cost_cutoff:
+                self.highest_cost_cutoff = cost
+
+            self.n_els += 1
+        else:
+            if cost < self.highest_cost_cutoff:
+                t = <tuple>heapreplace(self.heap, (-cost, k) )
+
+                self.highest_cost_cutoff = min2_long(self.highest_cost_cutoff,
+                                                     max2_long(-(<long>(t[0])), cost))
+
+    cdef result(self):
+
+        if self.n <= 0:
+            return self.best_match
+        elif self.n == 1:
+            return [] if self.best_match is None else [self.best_match]
+        else:
+            # The order in which the heap would be popped, reversed
+            return [k for v, k in reversed(sorted(self.heap))]
+
+################################################################################
+# Collects the values under a node for TreeDict.diff()
+
+cdef _diffCollect(_PTreeNode pn, str key, dict out):
+
+    cdef TreeDict t
+
+    if not pn.isBranch():
+        out[key] = pn.value()
+        return
+
+    t = pn.tree()
+    t._load()
+
+    for k, pnv in (t._param_dict.iteritems() if IS_PYTHON2 else t._param_dict.items()):
+        if not (<_PTreeNode>pnv).isDanglingTree():
+            _diffCollect(<_PTreeNode>pnv, key + "." + k, out)
+
+################################################################################
+# Rolls back the changes recorded by TreeDict.update()
+
+cdef _rollbackUpdate(list undo):
+
+    cdef tuple entry
+
+    for entry in reversed(undo):
+        if len(entry) == 4:
+            (<TreeDict>entry[0])._undoSetLocal(<str>entry[1], <_PTreeNode>entry[2], <size_t>entry[3])
+        else:
+            (<TreeDict>entry[0])._undoAttachDangling(<bint>entry[1], <list>entry[2])
+
+# The branches of a dict given to update(), once its dotted keys are
+# resolved.  Other dicts there are values.
+cdef class _UpdateBranch(dict):
+    pass
+
+cdef dict _resolveUpdateDict(dict d):
+
+    cdef dict root = {}
+    cdef dict node
+    cdef list items = []
+    cdef list names
+    cdef str key, name
+    cdef size_t i
+
+    # All the keys are checked before anything is set.
+    for k, v in (d.iteritems() if IS_PYTHON2 else d.items()):
+        key = validateKey(k)
+        names = strsplit(key, '.')
+
+        for name in names:
+            checkNameValidity(name)
+
+        items.append( (names, v) )
+
+    for names, v in items:
+        node = root
+
+        for i from 0 <= i < len(names) - 1:
+            name = <str>names[i]
+            b = node.get(name)
+
+            if type(b) is _UpdateBranch:
+                node = <dict>b
+                continue
+
+            # A dotted key under a tree value sets into that tree,
+            # as it does in a tree.
+            if isinstance(b, TreeDict):
+                (<TreeDict>b).set('.'.join(names[i+1:]), v)
+                node = None
+                break
+
+            b = _UpdateBranch()
+            node[name] = b
+            node = <dict>b
+
+        if node is not None:
+            node[<str>names[-1]] = v
+
+    return root
+
+cdef TreeDict _treeFromUpdateBranch(str name, dict branch):
+
+    # Builds a new branch for update() to attach, as it would a branch
+    # of a tree given to it.
+    cdef TreeDict p = newTreeDict(name, False)
+    cdef TreeDict b
+
+    for k, v in (branch.iteritems() if IS_PYTHON2 else branch.items()):
+        if type(v) is _UpdateBranch:
+            b = _treeFromUpdateBranch(<str>k, <dict>v)
+            b._setParent(p)
+            p._setLocalBranch(b, 0)
+        else:
+            p._setLocal(<str>k, v, 0)
+
+    return p
+
+################################################################################
+# Bookkeeping shared by all the nodes of one copy-on-write copy
+
+cdef class _CopyOnWriteContext(object):
+
+    # Maps id(source node) to (source node, copy); the source is held
+    # so the id stays valid.  Dropped once every node is loaded.
+    cdef dict _copies
+    cdef size_t _n_unloaded
+
+    def __cinit__(self):
+        self._copies = {}
+        self._n_unloaded = 0
+
+    cdef TreeDict newNode(self, TreeDict src, TreeDict parent, str name):
+
+        cdef TreeDict b = newTreeDict(name, False)
+
+        b._param_dict = None
+        b._branches = None
+
+        if parent is not None:
+            b._setParent(parent)
+            b._flags = parent._flags & f_freeze_flags
+
+        b._aux_dict[s_cow_source] = (src, self)
+
+        self._copies[id(src)] = (src, b)
+        self._n_unloaded += 1
+
+        # A frozen node never changes, so nothing needs to be told
+        # before it is written to.
+        if not src.isFrozen():
+            src._addDependent(b)
+
+        return b
+
+    cdef nodeLoaded(self):
+        self._n_unloaded -= 1
+
+        if self._n_unloaded == 0:
+            self._copies = None
+
+    cdef _copyLookup(self, TreeDict t):
+        cdef tuple entry = self._copies.get(id(t))
+
+        if entry is not None and entry[0] is t:
+            return entry[1]
+        else:
+            return None
+
+    cdef copyOf(self, TreeDict t):
+
+        # Returns the copy of t if t is part of the copied tree, and t
+        # otherwise.  Nodes without a copy yet sit below an unloaded
+        # copy, so they are reached by loading down from the nearest
+        # node above them that has one.
+        cdef list path = []
+        cdef TreeDict p = t
+        cdef object c = None
+
+        while p is not None:
+            c = self._copyLookup(p)
+
+            if c is not None:
+                break
+
+            path.append(p)
+            p = p._parent()
+
+        if c is None:
+            return t
+
+        for p in reversed(path):
+            (<TreeDict>c)._load()
+            c = self._copyLookup(p)
+
+            if c is None:
+                return t
+
+        return c
+
+################################################################################
+# Helper run by the executors in TreeDict.mapValues; module level so it
+# can be pickled for process pools.
+
+def _mapChunk(func, list values):
+    return [func(v) for v in values]
+
+################################################################################
+# The binary format of TreeDict.toBytes().  The data is the magic bytes
+# and version, a table of the strings used, then the root node.  A
+# node is its name, frozen flags, next order position and number of
+# entries, followed by the entries; each entry is its key, type, order
+# position, and then either the branch node or the value.  Counts,
+# positions and string indices are unsigned LEB128 varints.
+
+cdef bytes _binary_magic = b"TDB"
+DEF _binary_version = 1
+
+DEF v_None   = 0
+DEF v_True   = 1
+DEF v_False  = 2
+DEF v_Int    = 3
+DEF v_Float  = 4
+DEF v_Str    = 5
+DEF v_Bytes  = 6
+DEF v_Pickle = 7
+
+cdef object _pack_double = struct.Struct("<d").pack
+cdef object _unpack_double = struct.Struct("<d").unpack_from
+
+cdef inline _writeVarint(bytearray out, unsigned long long v):
+    while v >= 0x80:
+        out.append(<int>((v & 0x7f) | 0x80))
+        v >>= 7
+
+    out.append(<int>v)
+
+cdef class _BinaryWriter(object):
+
+    cdef bytearray out
+    cdef dict string_index
+    cdef list strings
+
+    cdef _writeString(self, str s):
+
+        cdef bytes es
+
+        # Mapped files store the strings where they are used, so a
+        # node can be read without a global table.
+        if self.string_index is None:
+            es = s.encode('utf-8')
+            _writeVarint(self.out, len(es))
+            self.out += es
+            return
+
+        idx = self.string_index.get(s)
+
+        if idx is None:
+            idx = self.string_index[s] = len(self.strings)
+            self.strings.append(s)
+
+        _writeVarint(self.out, <size_t>idx)
+
+    cdef _writeNode(self, TreeDict t):
+
+        cdef _PTreeNode pn
+        cdef list entries = []
+
+        t._load()
+
+        for k, pnv in (t._param_dict.iteritems() if IS_PYTHON2 else t._param_dict.items()):
+            if not (<_PTreeNode>pnv).isDanglingBranch():
+                entries.append( (k, pnv) )
+
+        self._writeString(t._name)
+        _writeVarint(self.out, t._flags & f_freeze_flags)
+        _writeVarint(self.out, t._next_item_order_position)
+        _writeVarint(self.out, len(entries))
+
+        for k, pnv in entries:
+            pn = <_PTreeNode>pnv
+
+            self._writeString(<str>k)
+            self.out.append(pn._t)
+            _writeVarint(self.out, pn._order_position)
+
+            if pn._t == t_Branch:
+                self._writeNode(pn.tree())
+            else:
+                self._writeValue(pn._v)
+
+    cdef size_t _writeMappedNode(self, TreeDict t) except? 0:
+
+        # Branches are written before their parent, so the parent can
+        # give their offsets; returns the offset of the node.
+
+        cdef _PTreeNode pn
+        cdef list entries = []
+        cdef dict offsets = {}
+        cdef size_t pos
+
+        t._load()
+
+        for k, pnv in (t._param_dict.iteritems() if IS_PYTHON2 else t._param_dict.items()):
+            pn = <_PTreeNode>pnv
+
+            if pn.isDanglingBranch():
+                continue
+
+            if pn._t == t_Branch:
+                offsets[k] = self._writeMappedNode(pn.tree())
+
+            entries.append( (k, pn) )
+
+        pos = len(self.out)
+
+        self._writeString(t._name)
+        _writeVarint(self.out, t._flags & f_freeze_flags)
+        _writeVarint(self.out, t._next_item_order_position)
+        _writeVarint(self.out, len(entries))
+
+        for k, pnv in entries:
+            pn = <_PTreeNode>pnv
+
+            self._writeString(<str>k)
+            self.out.append(pn._t)
+            _writeVarint(self.out, pn._order_position)
+
+            if pn._t == t_Branch:
+                _writeVarint(self.out, <size_t>offsets[k])
+                _writeVarint(self.out, pn.tree()._flags & f_freeze_flags)
+            else:
+                self._writeValue(pn._v)
+
+        return pos
+
+    cdef _writeValue(self, v):
+
+        cdef object vt = type(v)
+        cdef long long i
+        cdef bytes b
+
+        if v is None:
+            self.out.append(v_None)
+        elif v is True:
+            self.out.append(v_True)
+        elif v is False:
+            self.out.append(v_False)
+        elif vt is int and -2**63 <= v < 2**63:
+            i = v
+            self.out.append(v_Int)
+            # zigzag encoding keeps small negative numbers short
+            _writeVarint(self.out, ((<unsigned long long>i) << 1) ^ (<unsigned long long>(i >> 63)))
+        elif vt is float:
+            self.out.append(v_Float)
+            self.out += _pack_double(v)
+        elif vt is str and not IS_PYTHON2:
+            self.out.append(v_Str)
+            self._writeString(<str>v)
+        elif vt is bytes:
+            self.out.append(v_Bytes)
+            _writeVarint(self.out, len(<bytes>v))
+            self.out += <bytes>v
+        else:
+            b = dumps(v, -1)
+            self.out.append(v_Pickle)
+            _writeVarint(self.out, len(b))
+            self.out += b
+
+cdef bytes _encodeTree(TreeDict t):
+
+    cdef _BinaryWriter w = _BinaryWriter()
+    cdef bytearray out = bytearray(_binary_magic)
+    cdef bytes es
+
+    w.out = bytearray()
+    w.string_index = {}
+    w.strings = []
+
+    w._writeNode(t)
+
+    out.append(_binary_version)
+    _writeVarint(out, len(w.strings))
+
+    for s in w.strings:
+        es = (<str>s).encode('utf-8')
+        _writeVarint(out, len(es))
+        out += es
+
+    out += w.out
+
+    return bytes(out)
+
+################################################################################
+# Reports, as written by TreeDict.writeReport() and makeReport().  The
+# tree is walked with the entries of each node in setting order, which
+# gives the lines in order without gathering and sorting them first.
+
+DEF _report_chunk_size = 65536
+
+DEF _align_Global = 1
+DEF _align_Branch = 2
+DEF _align_None   = 3
+
+cdef class _ReportWriter(object):
+
+    cdef object write
+    cdef list out
+    cdef size_t out_size
+    cdef bint recursive
+    cdef int align
+    cdef object repr_function
+    cdef object max_value_length
+    cdef size_t width
+
+    def __init__(self, stream, bint recursive, align, max_value_length):
+        self.write = stream.write if stream is not None else None
+        self.out = []
+        self.out_size = 0
+        self.recursive = recursive
+        self.align = (_align_Global if align == 'global'
+                      else (_align_Branch if align == 'branch' else _align_None))
+        self.width = 0
+        self.max_value_length = max_value_length
+
+        if max_value_length is None:
+            self.repr_function = repr
+        else:
+            r = reprlib.Repr()
+            r.maxstring = r.maxother = max_value_length
+            r.maxlist = r.maxtuple = r.maxdict = r.maxset = r.maxfrozenset \
+                = r.maxdeque = r.maxarray = max(max_value_length // 4, 1)
+            self.repr_function = r.repr
+
+    cdef str _repr(self, v):
+        cdef str s = self.repr_function(v)
+        cdef size_t n
+
+        if self.max_value_length is not None:
+            n = self.max_value_length
+
+            if len(s) > n:
+                s = s[:n - 3] + '...'
+
+        return s
+
+    cdef _emit(self, str line):
+        self.out.append(line)
+        self.out_size += len(line) + 1
+
+        if self.write is not None and self.out_size >= _report_chunk_size:
+            self.flush()
+
+    cdef flush(self):
+        if self.out:
+            self.out.append('')
+            self.write('\n'.join(self.out))
+
+        self.out = []
+        self.out_size = 0
+
+    cdef writeReport(self, TreeDict t, str prefix):
+        if self.align == _align_Global:
+            self.width = self._keyWidth(t, len(prefix))
+
+        self._writeNode(t, prefix)
+
+    cdef size_t _keyWidth(self, TreeDict t, size_t prefix_len):
+
+        # The length of the longest key of a line in the report of t
+
+        cdef _PTreeNode pn
+        cdef size_t w = 0
+
+        t._load()
+
+        for k, pnv in (t._param_dict.iteritems() if IS_PYTHON2 else t._param_dict.items()):
+            pn = <_PTreeNode>pnv
+
+            if not pn.isBranch():
+                w = max2(w, prefix_len + len(<str>k))
+            elif self.recursive and not pn.isDanglingBranch():
+                w = max2(w, self._keyWidth(pn.tree(), prefix_len + len(<str>k) + 1))
+
+        return w
+
+    cdef _writeNode(self, TreeDict t, str prefix):
+
+        cdef _PTreeNode pn
+        cdef list entries = []
+        cdef size_t width = self.width
+        cdef str key
+
+        t._load()
+
+        for k, pnv in (t._param_dict.iteritems() if IS_PYTHON2 else t._param_dict.items()):
+            pn = <_PTreeNode>pnv
+
+            if not pn.isBranch():
+                if self.align == _align_Branch:
+                    width = max2(width, len(prefix) + len(<str>k))
+            elif not self.recursive or pn.isDanglingBranch():
+                continue
+
+            entries.append( (pn._order_position, k, pn) )
+
+        entries.sort()
+
+        for pos, k, pnv in entries:
+            pn = <_PTreeNode>pnv
+            key = prefix + k
+
+            if pn.isBranch():
+                self._writeNode(pn.tree(), key + '.')
+            elif self.align == _align_None:
+                self._emit(key + " = " + self._repr(pn._v))
+            else:
+                self._emit(key + " "*(width - len(key)) + " = " + self._repr(pn._v))
+
+################################################################################
+# JSON, as written by convertTo('json') and read by TreeDict.fromJSON().
+# Both walk the tree as they go, writing out or setting each value as
+# it is reached, so no nested dictionary of the whole tree is built.
+
+DEF _json_chunk_size = 65536
+
+cdef object _json_whitespace = re.compile(r'[ \t\n\r]*').match
+
+# Matches what may remain of a number cut off by the end of the buffer.
+cdef object _json_number_tail = re.compile(r'[0-9.eE+\-]*\Z').match
+
+class _SkipJSONValue(Exception): pass
+
+cdef class _JSONWriter(object):
+
+    cdef object write
+    cdef list out
+    cdef size_t out_size
+    cdef object encode
+    cdef object indent
+    cdef bint prune_empty
+    cdef object non_json
+    cdef set active
+    cdef str key
+
+    def __init__(self, stream, indent, bint prune_empty, non_json):
+        self.write = stream.write if stream is not None else None
+        self.out = []
+        self.out_size = 0
+        self.indent = None if indent is None else ' ' * indent
+        self.prune_empty = prune_empty
+        self.non_json = non_json
+        self.active = set()
+        self.key = None
+
+        self.encode = json.JSONEncoder(
+            indent = indent, default = self._default,
+            separators = ((', ', ': ') if indent is None else (',', ': '))).encode
+
+    def _default(self, v):
+        if isinstance(v, TreeDict):
+            return (<TreeDict>v).convertTo('nested_dict')
+        elif self.non_json == 'error':
+            raise TypeError("Value of '%s' contains an object of type %s, which can't be "
+                            "converted to JSON; see the `non_json` parameter."
+                            % (self.key, type(v).__name__))
+        elif self.non_json == 'skip':
+            raise _SkipJSONValue()
+        elif self.non_json == 'repr':
+            return repr(v)
+        else:
+            return self.non_json(v)
+
+    cdef _emit(self, s):
+        self.out.append(s)
+        self.out_size += len(s)
+
+        if self.write is not None and self.out_size >= _json_chunk_size:
+            self._flush()
+
+    cdef _flush(self):
+        self.write(''.join(self.out))
+        self.out = []
+        self.out_size = 0
+
+    cdef _writeTree(self, TreeDict t, str key, str cur_indent):
+
+        cdef _PTreeNode pn
+        cdef list entries = []
+        cdef str inner = None if self.indent is None else cur_indent + self.indent
+        cdef bint first = True
+
+        if id(t) in self.active:
+            raise ValueError("Tree '%s' contains itself, which can't be written as JSON." % key)
+
+        self.active.add(id(t))
+
+        t._load()
+
+        for k, pnv in (t._param_dict.iteritems() if IS_PYTHON2 else t._param_dict.items()):
+            pn = <_PTreeNode>pnv
+
+            if pn.isDanglingTree() or (self.prune_empty and pn.isTree() and pn.tree().isEmpty()):
+                continue
+
+            entries.append( (pn._order_position, k, pn) )
+
+        entries.sort()
+
+        self._emit('{')
+
+        for pos, k, pnv in entries:
+            pn = <_PTreeNode>pnv
+            self.key = k if key is None else key + '.' + k
+
+            if pn.isTree():
+                text = None
+            else:
+                try:
+                    text = self.encode(pn.value())
+                except _SkipJSONValue:
+                    continue
+
+                if inner is not None:
+                    text = text.replace('\n', '\n' + inner)
+
+            if not first:
+                self._emit(',' if inner is not None else ', ')
+
+            first = False
+
+            if inner is not None:
+                self._emit('\n' + inner)
+
+            self._emit(self.encode(k) + ': ')
+
+            if text is None:
+                self._writeTree(pn.tree(), self.key, inner)
+            else:
+                self._emit(text)
+
+        if inner is not None and not first:
+            self._emit('\n' + cur_indent)
+
+        self._emit('}')
+
+        self.active.remove(id(t))
+
+cdef _writeJSON(TreeDict t, stream, indent, bint prune_empty, non_json):
+
+    cdef _JSONWriter w = _JSONWriter(stream, indent, prune_empty, non_json)
+
+    w._writeTree(t, None, '')
+
+    if stream is None:
+        return ''.join(w.out)
+
+    w._flush()
+
+cdef class _JSONReader(object):
+
+    cdef object read
+    cdef object decoder
+    cdef object raw_decode
+    cdef object buf
+    cdef Py_ssize_t pos
+    cdef Py_ssize_t offset
+    cdef object mapping_function
+
+    def __init__(self, source, mapping_function):
+        self.read = getattr(source, 'read', None)
+        self.decoder = None
+        self.raw_decode = json.JSONDecoder().raw_decode
+        self.pos = 0
+        self.offset = 0
+        self.mapping_function = mapping_function
+
+        if self.read is not None:
+            self.buf = ''
+        elif not IS_PYTHON2 and isinstance(source, (bytes, bytearray)):
+            self.buf = bytes(source).decode('utf-8')
+        else:
+            self.buf = source
+
+    cdef bint _fill(self, Py_ssize_t n) except -1:
+        # Appends at least n more characters, or a chunk, to the
+        # unread part of the buffer; returns False at the end of the
+        # source.
+
+        if self.read is None:
+            return False
+
+        while True:
+            raw = data = self.read(max(n, _json_chunk_size))
+
+            if not IS_PYTHON2 and isinstance(data, bytes):
+                if self.decoder is None:
+                    self.decoder = codecs.getincrementaldecoder('utf-8')()
+
+                # A read may end partway through a character.
+                data = self.decoder.decode(raw, not raw)
+
+            if data or not raw:
+                break
+
+        if not data:
+            self.read = None
+            return False
+
+        self.offset += self.pos
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+
+        return True
+
+    cdef _error(self, str msg):
+        raise ValueError("Invalid JSON at position %d: %s" % (self.offset + self.pos, msg))
+
+    cdef object _peek(self):
+
+        while True:
+            self.pos = _json_whitespace(self.buf, self.pos).end()
+
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+
+            if not self._fill(0):
+                return None
+
+    cdef object _value(self):
+
+        # A value is parsed again with more data if it's cut off by
+        # the end of the buffer.  As a number may be cut off and still
+        # parse, e.g. "12." as 12, this is also done for any value
+        # followed only by what could continue a number.  The amount
+        # read is doubled each time, so long values are only parsed a
+        # few times.
+        while True:
+            try:
+                v, end = self.raw_decode(self.buf, self.pos)
+            except ValueError, e:
+                if self._fill(len(self.buf)):
+                    continue
+
+                self._error(str(e))
+
+            if (_json_number_tail(self.buf, end) is not None
+                and self._fill(len(self.buf))):
+                continue
+
+            self.pos = end
+            return v
+
+    cdef _readObject(self, TreeDict t):
+
+        # Reads the members of an object into t; the opening brace has
+        # been read.
+
+        if self._peek() == '}':
+            self.pos += 1
+            return
+
+        while True:
+            if self._peek() != '"':
+                self._error("expected a string key.")
+
+            k = validateKey(self._value())
+
+            if self._peek() != ':':
+                self._error("expected ':'.")
+
+            self.pos += 1
+
+            if self._peek() == '{':
+                self.pos += 1
+                self._readObject(t.makeBranch(k))
+            else:
+                v = self._value()
+
+                if self.mapping_function is not None:
+                    v = self.mapping_function(v)
+
+                t._set(k, v, 0)
+
+            c = self._peek()
+
+            if c == ',':
+                self.pos += 1
+            elif c == '}':
+                self.pos += 1
+                return
+            else:
+                self._error("expected ',' or '}'.")
+
+cdef TreeDict _readJSON(source, mapping_function):
+
+    cdef _JSONReader r = _JSONReader(source, mapping_function)
+    cdef TreeDict p = newTreeDict(s_default_tree_name, False)
+
+    if r._peek() != '{':
+        r._error("a TreeDict must be read from a JSON object.")
+
+    r.pos += 1
+    r._readObject(p)
+
+    if r._peek() is not None:
+        r._error("extra data after the object.")
+
+    return p
+
+################################################################################
+# Mapped files, as written by TreeDict.saveMapped().  These start with
+# the magic bytes, the version, and the offset and frozen flags of the
+# root node as 8 byte little-endian integers.  Each node then has the
+# same layout as in the binary format, except that strings are stored
+# in place and a branch entry gives the offset and frozen flags of the
+# branch's node; the branches are read only when first accessed.
+
+cdef bytes _mapped_magic = b"TDM"
+DEF _mapped_version = 1
+cdef object _mapped_header = struct.Struct("<QQ")
+DEF _mapped_header_size = 20
+
+cdef bytearray _mappedBytes(TreeDict t):
+
+    cdef _BinaryWriter w = _BinaryWriter()
+    cdef size_t root
+
+    w.out = bytearray(_mapped_magic)
+    w.out.append(_mapped_version)
+    w.out += b"\0" * (_mapped_header_size - len(w.out))
+    w.string_index = None
+
+    root = w._writeMappedNode(t)
+    _mapped_header.pack_into(w.out, len(_mapped_magic) + 1, root, t._flags & f_freeze_flags)
+
+    return w.out
+
+cdef _saveMapped(TreeDict t, path):
+
+    with open(path, 'wb') as f:
+        f.write(_mappedBytes(t))
+
+cdef TreeDict _openMapped(path):
+
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+
+    return _openMappedBuffer(mm, None, None)
+
+cdef TreeDict _openMappedBuffer(buf, str name, owner):
+
+    # Reads the tree in place from `buf`, which must not change while
+    # the tree is used.  If name is given, the root gets that name
+    # and is registered for getTree().  The reader keeps `owner`, the
+    # object `buf` comes from, so the memory is released along with
+    # the tree.
+
+    cdef _BinaryReader r = _BinaryReader(buf, True)
+    cdef TreeDict p
+
+    r.owner = owner
+
+    if r._raw(len(_mapped_magic)) != _mapped_magic:
+        r._corrupt()
+
+    if r._byte() != _mapped_version:
+        raise ValueError("Unsupported TreeDict mapped file version.")
+
+    if r.end < _mapped_header_size:
+        r._corrupt()
+
+    root, flags = _mapped_header.unpack_from(buf, len(_mapped_magic) + 1)
+
+    r._seek(root)
+
+    if name is None:
+        p = newTreeDict(r._string(), False)
+    else:
+        p = newTreeDict(name, True)
+
+    r._newMappedNode(p, None, root, flags)
+
+    return p
+
+################################################################################
+# Trees shared between processes by publishShared() and attachShared().
+# A published tree is written in the mapped file format to a shared
+# memory block named after the tree, and attached trees read their
+# nodes from the block in place.
+
+# Blocks published by this process, by tree name, with the id of the
+# publishing process; forked children inherit the dict but must not
+# remove the blocks.
+cdef dict _published_blocks = {}
+
+cdef bint _unpublish_at_exit = False
+
+cdef str _sharedBlockName(str name):
+    # Block names are limited to 30 characters on some systems, so the
+    # tree name is hashed.
+    return "treedict_" + md5(name.encode("utf-8")).hexdigest()[:20]
+
+cdef _checkSharedMemory():
+    if shared_memory is None:
+        raise NotImplementedError(
+            "Sharing trees between processes requires multiprocessing.shared_memory.")
+
+cdef tuple _attachBlock(str name):
+
+    # Returns a buffer over the block and the object owning it, which
+    # must be kept while the buffer is used.  Only the publisher may
+    # register the block with a resource tracker, as trackers remove
+    # the blocks registered with them when their processes exit.
+    # Before Python 3.13, SharedMemory always registers it, so on
+    # POSIX systems the block is mapped here directly; Windows has no
+    # tracker.
+
+    cdef str block_name = _sharedBlockName(name)
+
+    try:
+        if sys.version_info >= (3, 13):
+            block = shared_memory.SharedMemory(name = block_name, track = False)
+            buf = block.buf
+
+        elif _posixshmem is not None:
+            fd = _posixshmem.shm_open("/" + block_name, os.O_RDONLY, 0o600)
+
+            try:
+                block = buf = mmap.mmap(fd, os.fstat(fd).st_size, access = mmap.ACCESS_READ)
+            finally:
+                os.close(fd)
+
+        else:
+            block = shared_memory.SharedMemory(name = block_name)
+            buf = block.buf
+
+    except (OSError, ValueError):
+        raise KeyError("No tree named '%s' has been published." % name)
+
+    return (buf, block)
+
+def publishShared(str name, TreeDict tree):
+    """
+    Publishes the frozen tree `tree` under `name` in shared memory,
+    so other processes on the machine can open it with
+    :func:`attachShared`.  The tree is written once in the format of
+    :meth:`TreeDict.saveMapped`; attached trees read their branches
+    from the shared memory in place, so workers in a pool do not
+    each unpickle their own copy of it.
+
+    Publishing under the same name again replaces the tree for later
+    calls to :func:`attachShared`; trees already attached keep the
+    old one.  The shared memory is released by
+    :func:`unpublishShared`, or when this process exits.
+
+    Example::
+
+        >>> import treedict
+        >>> t = treedict.getTree('config')
+        >>> t.set('db.host', 'localhost', 'db.port', 5432)
+        >>> t.freeze()
+        >>> treedict.publishShared('config', t)
+
+    and then, in a worker process::
+
+        >>> import treedict
+        >>> treedict.attachShared('config').db.port
+        5432
+        >>> treedict.getTree('config').db.host
+        'localhost'
+    """
+
+    global _unpublish_at_exit
+
+    try:
+        checkKeyNotNone(name)
+        _checkSharedMemory()
+
+        if tree is None:
+            raise TypeError("TreeDict instance expected, got NoneType.")
+
+        if not tree.isFrozen():
+            raise ValueError("Only frozen trees can be published to shared memory.")
+
+        data = _mappedBytes(tree)
+
+        unpublishShared(name)
+
+        shm = shared_memory.SharedMemory(
+            name = _sharedBlockName(name), create = True, size = len(data))
+
+        shm.buf[:len(data)] = data
+        _published_blocks[name] = (shm, os.getpid())
+
+        if not _unpublish_at_exit:
+            atexit.register(_unpublishAll)
+            _unpublish_at_exit = True
+
+    except Exception, e:
+        if DEBUG_MODE: raise
+        else: raise e
+
+def attachShared(str name):
+    """
+    Returns the tree published under `name` by :func:`publishShared`,
+    possibly in another process.  The tree is frozen, and its
+    branches are read from the shared memory only when first
+    accessed.  It is also registered, replacing any tree of the same
+    name, so :func:`getTree` returns it in this process.  A KeyError
+    is raised if no tree has been published under `name`.
+    """
+
+    cdef TreeDict p
+
+    try:
+        checkKeyNotNone(name)
+        _checkSharedMemory()
+
+        buf, block = _attachBlock(name)
+
+        if name in _tree_lookup_dict:
+            (<TreeDict>_tree_lookup_dict.pop(name))._setRegisteredFlag(False)
+
+        p = _openMappedBuffer(buf, name, block)
+        registerTreeByName(name, p)
+
+        return p
+
+    except Exception, e:
+        if DEBUG_MODE: raise
+        else: raise e
+
+def unpublishShared(str name):
+    """
+    Removes the tree published under `name` by this process from
+    shared memory.  Trees that other processes have already attached
+    remain valid.  Returns True if a tree was removed, and False if
+    this process has not published one under `name`.
+    """
+
+    if name not in _published_blocks:
+        return False
+
+    shm, pid = _published_blocks.pop(name)
+
+    if pid != os.getpid():
+        return False
+
+    shm.close()
+    shm.unlink()
+
+    return True
+
+def _unpublishAll():
+    for name in list(_published_blocks):
+        try:
+            unpublishShared(name)
+        except OSError:
+            pass
+
+cdef class _BinaryReader(object):
+
+    cdef object data
+    cdef const unsigned char[:] view
+    cdef const unsigned char* buf
+    cdef Py_ssize_t pos
+    cdef Py_ssize_t end
+    cdef list strings
+
+    # Owns the memory of a mapped buffer, if not data itself.  It is
+    # declared last so it is released after the views of data.
+    cdef object owner
+
+    def __init__(self, buf, bint mapped = False):
+        # A mapped buffer is read in place; otherwise the data is
+        # copied so it can't change under the reader.
+        self.data = buf if mapped else bytes(buf)
+        self.view = self.data
+        self.buf = &self.view[0] if len(self.view) != 0 else NULL
+        self.pos = 0
+        self.end = len(self.view)
+        self.strings = None
+
+    cdef _seek(self, size_t pos):
+        if pos >= <size_t>self.end:
+            self._corrupt()
+
+        self.pos = pos
+
+    cdef _newMappedNode(self, TreeDict b, TreeDict parent, size_t offset, flagtype flags):
+
+        b._param_dict = None
+        b._branches = None
+
+        if parent is not None:
+            b._setParent(parent)
+
+        b._flags |= (flags & f_freeze_flags)
+
+        if parent is not None:
+            b._flags |= (parent._flags & (f_freeze_flags | f_is_registered))
+
+        b._aux_dict[s_mapped_source] = (self, offset)
+
+    cdef _loadMappedNode(self, TreeDict p, size_t offset):
+
+        cdef Py_ssize_t saved_pos = self.pos
+        cdef dict d = {}
+        cdef list branches = []
+        cdef TreeDict b
+        cdef _PTreeNode pn
+        cdef size_t i, n, op, next_pos
+        cdef int t
+        cdef str k
+
+        self._seek(offset)
+        self._string()
+        self._varint()
+        next_pos = self._varint()
+        n = self._varint()
+
+        for i from 0 <= i < n:
+            k = self._string()
+            t = self._byte()
+            op = self._varint()
+
+            if t == t_Branch:
+                b = newTreeDict(k, False)
+                child = self._varint()
+                self._newMappedNode(b, p, child, <flagtype>self._varint())
+                branches.append(b)
+                pn = newPTreeNodeExact(b, t, op)
+
+            elif t_Mutable_Simple <= t <= t_Tree:
+                pn = newPTreeNodeExact(self._readValue(), t, op)
+
+                if t == t_Tree and not isinstance(pn._v, TreeDict):
+                    self._corrupt()
+
+                if pn.isMutable():
+                    p._n_mutable += 1
+
+            else:
+                self._corrupt()
+
+            d[k] = pn
+
+        p._branches = branches
+        p._next_item_order_position = next_pos
+        p._param_dict = d
+
+        self.pos = saved_pos
+
+    cdef _corrupt(self):
+        raise ValueError("Data is not a valid TreeDict binary string, or is truncated.")
+
+    cdef inline int _byte(self) except -1:
+        if self.pos >= self.end:
+            self._corrupt()
+
+        self.pos += 1
+        return self.buf[self.pos - 1]
+
+    cdef unsigned long long _varint(self) except? 0xffffffffffffffff:
+        cdef unsigned long long v = 0
+        cdef int shift = 0
+        cdef int c
 
-        """
-        return self._getListFromIter(self.iterbranches())
+        while True:
+            if shift > 63:
+                self._corrupt()
 
+            c = self._byte()
+            v |= (<unsigned long long>(c & 0x7f)) << shift
 
-    ################################################################################
-    # Methods relating to testing on this class
+            if c < 0x80:
+                return v
 
-    def getClosestKey(self, str key, int n = 0, bint recursive = True, branch_mode = 'none'):
-        """
-        Returns the closest match(s) in the tree to the key `key`.
+            shift += 7
 
-        If ``n >= 1``, then a list of the `n` closest strings is
-        returned.  If ``n <= 0``, then a single string, the closest
-        match, is returned.  The search algorithm is faster for
-        ``n=0`` or ``n=1``.
+    cdef bytes _raw(self, Py_ssize_t n):
+        if n < 0 or self.pos + n > self.end:
+            self._corrupt()
 
-        The optional behavior is just like with the iterators, with
-        the default being to examine, recursively, the keys of all
-        leaves for close matches.
+        self.pos += n
+        return bytes(self.data[self.pos - n : self.pos])
 
-        The algorithm used is based on the closest edit distance to
-        the query key `key`, with extra weighting given to branch
-        boundaries.
+    cdef inline str _string(self):
 
-        Example::
+        cdef Py_ssize_t sl
 
-            >>> t = TreeDict()
-            >>> t.alpha.x1 = 1
-            >>> t.alpha.y1 = 1
-            >>> t.alpha.zzz = 1
-            >>> t.beta.x = 1
-            >>> t.gamma.beta = 1
-            >>> "alpah.x" in t
-            False
-            >>> t.getClosestKey("alpah.x")
-            'alpha.x1'
-            >>> t.getClosestKey("alpah.x", 1)
-            ['alpha.x1']
-            >>> t.getClosestKey("alpah.x", 3)
-            ['alpha.x1', 'beta.x', 'alpha.y1']
+        if self.strings is None:
+            sl = <Py_ssize_t>self._varint()
 
-        """
+            if IS_PYTHON2:
+                return str(self._raw(sl).decode('utf-8'))
 
-        checkKeyNotNone(key)
+            if sl < 0 or self.pos + sl > self.end:
+                self._corrupt()
 
-        cdef TreeDictIterator pti = self.iterkeys(recursive, branch_mode)
+            self.pos += sl
+            return PyUnicode_DecodeUTF8(<const char*>(self.buf + self.pos - sl), sl, NULL)
 
-        cdef size_t_v buf = new_size_t_v(100)
+        cdef unsigned long long idx = self._varint()
 
-        if buf.d == NULL:
-            raise MemoryError
+        if idx >= <unsigned long long>len(self.strings):
+            self._corrupt()
 
-        try:
-            if n <= 0:
-                return self._getSingleClosest(key, pti, &buf)
-            elif n == 1:
-                v = self._getSingleClosest(key, pti, &buf)
-                if v is None:
-                    return []
-                else:
-                    return [v]
-            else:
-                return self._getListOfClosest(key, <size_t>n, pti, &buf)
-        finally:
-            free_size_t_v(&buf)
+        return <str>self.strings[<Py_ssize_t>idx]
 
+    cpdef TreeDict readTree(self):
 
-    cdef list _getListOfClosest(self, str key, size_t n, TreeDictIterator pti, size_t_v *bufp):
+        cdef size_t i, n
+        cdef Py_ssize_t sl
 
-        cdef str k
-        cdef long cost, highest_cost_cutoff = -(2**(sizeof(long) - 2) )
-        cdef size_t n_els = 0
-        cdef tuple t
-        cdef list kl = []
+        if self._raw(len(_binary_magic)) != _binary_magic:
+            self._corrupt()
 
-        while True:
-            if not pti._loadNext():
-                break
+        if self._byte() != _binary_version:
+            raise ValueError("Unsupported TreeDict binary format version.")
 
-            k = pti.currentKey()
-            cost = name_match_distance(bufp, key, k)
+        n = self._varint()
 
-            # put it on the heap; use -cost so pop gets rid of the
-            # highest cost one.
-            if n_els < n:
-                heappush(kl, (-cost, k) )
+        self.strings = []
 
-                if cost > highest_cost_cutoff:
-                    highest_cost_cutoff = cost
+        for i from 0 <= i < n:
+            sl = <Py_ssize_t>self._varint()
 
-                n_els += 1
+            if IS_PYTHON2:
+                self.strings.append(str(self._raw(sl).decode('utf-8')))
             else:
-                if cost < highest_cost_cutoff:
-                    t = <tuple>heapreplace(kl, (-cost, k) )
+                if sl < 0 or self.pos + sl > self.end:
+                    self._corrupt()
 
-                    highest_cost_cutoff = min2_long(highest_cost_cutoff,
-                                                    max2_long(-(<long>(t[0])), cost))
+                self.strings.append(PyUnicode_DecodeUTF8(<const char*>(self.buf + self.pos), sl, NULL))
+                self.pos += sl
 
-        cdef size_t i
+        cdef TreeDict t = self._readNode(None)
 
-        return [k for v, k in
-                reversed([heappop(kl) for i in range(len(kl))])]
+        if self.pos != self.end:
+            self._corrupt()
 
+        return t
 
-    cdef str _getSingleClosest(self, str key, TreeDictIterator pti, size_t_v *bufp):
+    cdef TreeDict _readNode(self, TreeDict parent):
 
-        cdef str k, best_match = None
-        cdef long cost = 0, best_cost = -(2**(sizeof(long) - 2) )
-        cdef bint first = True
+        cdef TreeDict b, p = newTreeDict(self._string(), False)
+        cdef flagtype flags = <flagtype>self._varint()
+        cdef size_t next_pos = self._varint()
+        cdef size_t i, n = self._varint()
+        cdef dict d = p._param_dict
+        cdef _PTreeNode pn
+        cdef int t
+        cdef size_t op
+        cdef str k
 
-        while True:
-            if not pti._loadNext():
-                break
+        if parent is not None:
+            p._setParent(parent)
+
+        for i from 0 <= i < n:
+            k = self._string()
+            t = self._byte()
+            op = self._varint()
+
+            if t == t_Branch:
+                b = self._readNode(p)
+                p._branches.append(b)
+                pn = newPTreeNodeExact(b, t, op)
+
+            elif t_Mutable_Simple <= t <= t_Tree:
+                pn = newPTreeNodeExact(self._readValue(), t, op)
+
+                if t == t_Tree and not isinstance(pn._v, TreeDict):
+                    self._corrupt()
+
+                if pn.isMutable():
+                    p._n_mutable += 1
+
+            else:
+                self._corrupt()
+
+            d[k] = pn
+
+        p._next_item_order_position = next_pos
+        p._flags |= (flags & f_freeze_flags)
 
-            k = pti.currentKey()
-            cost = name_match_distance(bufp, key, k)
+        return p
 
-            if first or cost < best_cost:
-                first      = False
-                best_cost  = cost
-                best_match = k
+    cdef _readValue(self):
 
-        return best_match
+        cdef int vt = self._byte()
+        cdef unsigned long long u
 
+        if vt == v_None:
+            return None
+        elif vt == v_True:
+            return True
+        elif vt == v_False:
+            return False
+        elif vt == v_Int:
+            u = self._varint()
+            return <long long>((u >> 1) ^ (-(u & 1)))
+        elif vt == v_Float:
+            if self.pos + 8 > self.end:
+                self._corrupt()
+
+            self.pos += 8
+            return _unpack_double(self.data, self.pos - 8)[0]
+        elif vt == v_Str:
+            return self._string()
+        elif vt == v_Bytes:
+            return self._raw(<Py_ssize_t>self._varint())
+        elif vt == v_Pickle:
+            return loads(self._raw(<Py_ssize_t>self._varint()))
+        else:
+            self._corrupt()
 
 ################################################################################
 # Unpickling
@@ -4383,6 +8160,48 @@ def _TreeDict_unpickler(
 
     return p
 
+def _TreeDict_lazy_unpickler(tuple state):
+
+    cdef TreeDict p = newTreeDict(state[0], False)
+
+    p._flags = state[2]
+    _setLazyPickleState(p, state)
+
+    return p
+
+cdef _setLazyPickleState(TreeDict p, tuple state):
+
+    # Branches become unloaded nodes holding their pickled state,
+    # which _load() unpickles on first access.  The flags of a node
+    # are set when it is created, as they may change before it is
+    # loaded; a parent frozen in the meantime passes that on.
+
+    cdef dict d = {}
+    cdef list branches = []
+    cdef TreeDict b
+    cdef tuple item
+
+    for item in <list>state[1]:
+        if len(item) == 2:
+            d[item[0]] = item[1]
+        else:
+            b = newTreeDict(item[0], False)
+            b._param_dict = None
+            b._branches = None
+            b._flags = item[2] | (p._flags & f_freeze_flags)
+            b._setParent(p)
+            b._aux_dict[s_pickled_source] = item[3]
+
+            branches.append(b)
+            d[item[0]] = newPTreeNodeExact(b, t_Branch, item[1])
+
+    p._branches = branches
+    p._aux_dict.update(<dict>state[3])
+    p._n_mutable = state[4]
+    p._next_item_order_position = state[5]
+    p._n_dangling = state[6]
+    p._param_dict = d
+
 
 ######################################################################
 # Now an interactive version that works well with ipython.
@@ -4461,6 +8280,8 @@ class InteractiveTreeDict(object):
         cdef str k
         cdef _PTreeNode pn
 
+        ptree._load()
+
         ptree_param_dict_items = ptree._param_dict.iteritems() if IS_PYTHON2 else ptree._param_dict.items()
         for k, pn in ptree_param_dict_items:
 
@@ -4492,6 +8313,426 @@ class InteractiveTreeDict(object):
     def _setAttrDirect(self, str key, v):
         object.__setattr__(self, key, v)
 
+################################################################################
+# Overlays of several trees
+
+cdef class _OverlayRoot(object):
+    # State shared by all the nodes of one overlay.  The version is
+    # bumped on each write so nodes know to look up their layers again.
+
+    cdef list layers
+    cdef TreeDict top
+    cdef size_t version
+
+cdef OverlayTreeDict _newOverlay(list ll):
+
+    cdef _OverlayRoot root = _OverlayRoot.__new__(_OverlayRoot)
+
+    root.top = newTreeDict((<TreeDict>ll[0])._name, False)
+    root.layers = [root.top] + ll[::-1]
+    root.version = 0
+
+    return _newOverlayNode(root, "", root.layers)
+
+cdef OverlayTreeDict _newOverlayNode(_OverlayRoot root, str path, list layers):
+
+    cdef OverlayTreeDict o = OverlayTreeDict.__new__(OverlayTreeDict)
+
+    o._root = root
+    o._path = path
+    o._layers = layers
+    o._version = root.version
+
+    return o
+
+cdef tuple _overlayLookup(list layers, str k):
+    # Returns (pn, None) if k resolves to a value, (None, branches) if
+    # it resolves to branches, and (None, None) if it is not present.
+    # Branches in higher layers are merged with those below down to
+    # the first layer holding a value for k, or to a branch of the top
+    # layer that replaced a value there.
+
+    cdef TreeDict t
+    cdef _PTreeNode pn
+    cdef list branches = None
+
+    for t in layers:
+        pn = t._getLocalPTNode(k)
+
+        if pn is None or pn.isDanglingBranch():
+            continue
+
+        if not pn.isBranch():
+            if branches is None:
+                return (pn, None)
+            break
+
+        if branches is None:
+            branches = [pn.tree()]
+        else:
+            branches.append(pn.tree())
+
+        if s_overlay_shadow in pn.tree()._aux_dict:
+            break
+
+    return (None, branches)
+
+cdef list _overlayKeys(list layers):
+    # The local keys in the order they would have in a tree built by
+    # updating the lowest layer with the ones above it.
+
+    cdef TreeDict t
+    cdef _PTreeNode pn
+    cdef list keys = []
+    cdef set seen = set()
+
+    for t in reversed(layers):
+        t._load()
+
+        for k, pnv in (t._param_dict.iteritems() if IS_PYTHON2 else t._param_dict.items()):
+            pn = <_PTreeNode>pnv
+
+            if k not in seen and not pn.isDanglingBranch():
+                seen.add(k)
+                keys.append(k)
+
+    return keys
+
+cdef class OverlayTreeDict(object):
+    """
+    A read-through view of several trees laid over each other, as
+    created by :meth:`TreeDict.overlay`.  Values and branches are
+    retrieved as with a TreeDict, through attributes, :meth:`get` or
+    indexing, and each lookup takes the value from the highest layer
+    holding the key.  A branch present in several layers gives another
+    OverlayTreeDict over those branches.
+
+    Values set on the overlay are written to its own top layer, which
+    is returned by :meth:`topLayer`.  Values cannot be deleted from an
+    overlay.  Tree values, i.e. TreeDict instances held as values
+    rather than as branches, are treated as any other value.
+    """
+
+    cdef _OverlayRoot _root
+    cdef str _path
+    cdef list _layers
+    cdef size_t _version
+
+    def __init__(self, *args, **kwargs):
+        raise TypeError("Overlays are created by TreeDict.overlay().")
+
+    cdef list _getLayers(self):
+
+        cdef list layers
+        cdef str k
+        cdef tuple r
+
+        if self._version == self._root.version:
+            return self._layers
+
+        layers = self._root.layers
+
+        if self._path:
+            for k in strsplit(self._path, '.'):
+                r = _overlayLookup(layers, k)
+                layers = r[1] if r[1] is not None else []
+
+        self._layers = layers
+        self._version = self._root.version
+
+        return layers
+
+    cdef _lookup(self, str key, bint create_missing):
+        # Returns the value or the overlay node for key; returns
+        # _NoDefault if key is not present and create_missing is
+        # False.
+
+        cdef list layers = self._getLayers()
+        cdef list names = strsplit(key, '.')
+        cdef tuple r = None
+        cdef size_t i
+
+        for i from 0 <= i < len(names):
+            r = _overlayLookup(layers, <str>names[i])
+
+            if r[0] is not None:
+                if i == len(names) - 1:
+                    return (<_PTreeNode>r[0]).value()
+                layers = []
+            elif r[1] is not None:
+                layers = <list>r[1]
+            else:
+                layers = []
+
+        if r[1] is None and not create_missing:
+            return _NoDefault
+
+        return _newOverlayNode(self._root, self._path + key if not self._path
+                               else self._path + "." + key, layers)
+
+    def __getattr__(self, str k):
+
+        if k.startswith("__"):
+            raise AttributeError(k)
+
+        try:
+            return self._lookup(k, True)
+        except Exception, e:
+            if DEBUG_MODE: raise
+            else: raise e
+
+    def get(self, str key, default_value = _NoDefault):
+        """
+        Returns the value associated with `key`, or an overlay of the
+        branches at `key`.  If `key` is not present, `default_value`
+        is returned if given; otherwise, a KeyError is raised.
+        """
+
+        checkKeyNotNone(key)
+
+        v = self._lookup(key, False)
+
+        if v is _NoDefault:
+            if default_value is not _NoDefault:
+                return default_value
+            else:
+                raise KeyError(repr(key))
+
+        return v
+
+    def __getitem__(self, key):
+        return self.get(validateKey(key))
+
+    def __contains__(self, key):
+        return self._lookup(validateKey(key), False) is not _NoDefault
+
+    def __setattr__(self, str k, v):
+        self.set(k, v)
+
+    def __setitem__(self, key, v):
+        self.set(validateKey(key), v)
+
+    def set(self, str key, value):
+        """
+        Sets `key` to `value` in the top layer of the overlay.
+        """
+
+        cdef TreeDict top = self._root.top
+        cdef TreeDict t = top
+        cdef _PTreeNode pn
+        cdef str fk
+        cdef list names
+        cdef size_t i, n_shadowing = 0
+
+        try:
+            fk = validateKey(self._path + "." + key if self._path else key)
+            names = strsplit(fk, '.')
+
+            # A branch that replaces a value in the top layer hides the
+            # layers below, as it would when updating with the layers
+            # in turn.
+            for i from 0 <= i < len(names) - 1:
+                pn = t._getLocalPTNode(<str>names[i])
+
+                if pn is None or pn.isDanglingBranch():
+                    break
+
+                if not pn.isBranch():
+                    if not pn.isTree():
+                        n_shadowing = i + 1
+                    break
+
+                t = pn.tree()
+
+            top._set(fk, value, 0)
+
+            if n_shadowing != 0:
+                t = top.get('.'.join(names[:n_shadowing]))
+                t._aux_dict[s_overlay_shadow] = True
+
+            self._root.version += 1
+        except Exception, e:
+            if DEBUG_MODE: raise
+            else: raise e
+
+    def topLayer(self):
+        """
+        Returns the root of the tree holding the values set on the
+        overlay.
+        """
+        return self._root.top
+
+    ########################################
+    # Lists of the contents
+
+    cdef _flattenInto(self, list layers, list l, str prefix,
+                      bint recursive, int branch_mode, int itertype):
+
+        cdef tuple r
+        cdef str k, fk
+
+        for k in _overlayKeys(layers):
+            r = _overlayLookup(layers, k)
+            fk = k if prefix is None else prefix + k
+
+            if r[0] is not None:
+                if branch_mode != i_BranchMode_Only:
+                    _flatEmit(l, None, None, fk, (<_PTreeNode>r[0]).value(), itertype)
+
+            elif r[1] is not None:
+                if branch_mode == i_BranchMode_None and not recursive:
+                    continue
+
+                if branch_mode != i_BranchMode_None:
+                    _flatEmit(l, None, None, fk,
+                              _newOverlayNode(self._root,
+                                              self._path + "." + fk if self._path else fk,
+                                              <list>r[1]), itertype)
+                if recursive:
+                    self._flattenInto(<list>r[1], l, fk + '.', recursive,
+                                      branch_mode, itertype)
+
+    cdef list _getList(self, bint recursive, branch_mode, int itertype):
+        cdef list l = []
+        self._flattenInto(self._getLayers(), l, None, recursive,
+                          self._root.top._getBranchMode(branch_mode), itertype)
+        return l
+
+    def keys(self, bint recursive = True, branch_mode = 'none'):
+        """
+        Returns a list of the keys in the overlay, in the same order
+        as the keys of :meth:`materialize()`.  `recursive` and
+        `branch_mode` are as for :meth:`TreeDict.keys`.
+        """
+        return self._getList(recursive, branch_mode, i_Keys)
+
+    def values(self, bint recursive = True, branch_mode = 'none'):
+        """
+        As :meth:`keys`, but returns the values.
+        """
+        return self._getList(recursive, branch_mode, i_Values)
+
+    def items(self, bint recursive = True, branch_mode = 'none'):
+        """
+        As :meth:`keys`, but returns ``(key, value)`` pairs.
+        """
+        return self._getList(recursive, branch_mode, i_Items)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def size(self, bint recursive = True, branch_mode = 'none'):
+        """
+        Returns the number of keys in the overlay; see :meth:`keys`.
+        """
+        return len(self._getList(recursive, branch_mode, i_Keys))
+
+    ########################################
+    # Flattening and hashing
+
+    def materialize(self):
+        """
+        Returns a new TreeDict holding the values of this node of the
+        overlay.  As with a copy, the values themselves are shared
+        with the layers.
+        """
+
+        cdef TreeDict p = newTreeDict(self._root.top._name if not self._path
+                                      else strsplit(self._path, '.')[-1], False)
+
+        try:
+            _overlayMaterialize(self._getLayers(), p)
+            return p
+        except Exception, e:
+            if DEBUG_MODE: raise
+            else: raise e
+
+    def hash(self):
+        """
+        Returns the hash of the overlay, which is equal to the hash of
+        the tree returned by :meth:`materialize()`; see
+        :meth:`TreeDict.hash`.  The hash is computed from the layers
+        without building that tree.
+        """
+
+        h = md5()
+
+        try:
+            _overlayRunFullHash(self._getLayers(), getattr(h, 'update'))
+        except Exception, e:
+            if DEBUG_MODE: raise
+            else: raise e
+
+        return self._root.top._encode_hash(h.digest())
+
+    def __repr__(self):
+        return "OverlayTreeDict <%s>" % (self._path if self._path else self._root.top._name)
+
+cdef _overlayMaterialize(list layers, TreeDict p):
+
+    cdef tuple r
+
+    for k in _overlayKeys(layers):
+        r = _overlayLookup(layers, k)
+
+        if r[0] is not None:
+            p._setLocal(k, (<_PTreeNode>r[0]).value(), 0)
+        else:
+            _overlayMaterialize(<list>r[1], p.makeBranch(k))
+
+cdef _overlayRunFullHash(list layers, hf):
+
+    # Follows TreeDict._runFullHash and _getImmutableItemsHash over the
+    # merged keys of the layers.
+
+    cdef TreeDict t = layers[0] if layers else newTreeDict(s_default_tree_name, False)
+    cdef _PTreeNode pn
+    cdef list entries = []
+    cdef tuple r
+
+    for k in _overlayKeys(layers):
+        r = _overlayLookup(layers, k)
+        entries.append( (k, r[0], r[1]) )
+
+    # Keys are unique, so only they get compared
+    entries.sort()
+
+    ih = md5()
+    ihf = getattr(ih, 'update')
+
+    for k, pnv, b in entries:
+        if pnv is not None and (<_PTreeNode>pnv).isImmutable():
+            pn = <_PTreeNode>pnv
+            try:
+                t._update_hash_with_key(ihf, k)
+                t._update_hash_with_context(ihf, pn)
+                pn.runImmutableHash(ihf)
+            except HashError, he:
+                he.prependKey(k)
+                raise
+
+    hf(ih.hexdigest().encode('utf-8'))
+
+    for k, pnv, b in entries:
+        try:
+            if pnv is None:
+                t._update_hash_with_key(hf, k)
+                hf("$BRANCH$".encode('utf-8'))
+                _overlayRunFullHash(<list>b, hf)
+
+            elif not (<_PTreeNode>pnv).isImmutable():
+                pn = <_PTreeNode>pnv
+                t._update_hash_with_key(hf, k)
+                t._update_hash_with_context(hf, pn)
+                pn.runFullHash(hf)
+
+        except HashError, he:
+            he.prependKey(k)
+            raise
+
 ################################################################################
 # A few small side functions mainly for testing
 